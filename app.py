@@ -1,4 +1,5 @@
 from flask import Flask, request, Response, jsonify
+from werkzeug.wsgi import wrap_file
 import requests
 from urllib.parse import urlparse, urljoin, quote, unquote, quote_plus
 import re
@@ -9,15 +10,34 @@ import os
 import random
 import time
 from cachetools import TTLCache
+from collections import OrderedDict
 from dotenv import load_dotenv
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from urllib3.exceptions import EmptyPoolError
 import psutil
-from threading import Thread, Lock
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Thread, Lock, Condition, local
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 import hashlib
+import heapq
+from bisect import bisect_left
 import logging
+import signal
+import socket
+import mmap
+import struct
+import tempfile
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, FrozenSet, Mapping, Optional, Tuple
 from datetime import datetime
+from functools import lru_cache
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: niente flock, il backend di cache condiviso non è disponibile
+    fcntl = None
 
 app = Flask(__name__)
 
@@ -25,12 +45,105 @@ load_dotenv()
 
 # --- Classe VavooResolver per gestire i link Vavoo ---
 class VavooResolver:
+    # Dopo un ping fallito i thread non ritentano per questi secondi
+    SIGNATURE_FAILURE_BACKOFF = 10
+
     def __init__(self):
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'MediaHubMX/2'
         })
+        # addonSig condiviso da tutti i thread, rinnovato prima della scadenza
+        self._signature = None
+        self._signature_expires_at = 0
+        self._signature_lock = Lock()
+        self._refresh_lock = Lock()
+        self._refresh_in_progress = False
+        self._signature_failed_at = 0
+        self.signature_fetches = 0
+        self.signature_failures = 0
     
+    def _get_signature_timing(self):
+        """Restituisce (ttl, margine di refresh anticipato) dell'addonSig dalla configurazione"""
+        config = config_manager.get_config()
+        return config.get('VAVOO_SIGNATURE_TTL', 600), config.get('VAVOO_SIGNATURE_REFRESH_MARGIN', 60)
+
+    def _fetch_signature(self):
+        """Richiede un nuovo addonSig e lo salva in cache. Va chiamata con _signature_lock acquisito"""
+        signature = self.getAuthSignature()
+        self.signature_fetches += 1
+        if signature:
+            ttl, _ = self._get_signature_timing()
+            self._signature = signature
+            self._signature_expires_at = time.time() + ttl
+            self._signature_failed_at = 0
+        else:
+            # Condivide l'esito con i thread in coda sul lock: fino alla fine
+            # del backoff nessuno ripete il ping da 20 secondi
+            self._signature_failed_at = time.time()
+            self.signature_failures += 1
+        return signature
+
+    def _in_failure_backoff(self):
+        return time.time() - self._signature_failed_at < self.SIGNATURE_FAILURE_BACKOFF
+
+    def _background_refresh(self):
+        try:
+            _, margin = self._get_signature_timing()
+            with self._signature_lock:
+                # Un altro thread potrebbe averlo già rinnovato
+                if time.time() < self._signature_expires_at - margin:
+                    return
+                if self._fetch_signature():
+                    app.logger.info("addonSig Vavoo rinnovato in background")
+        except Exception as e:
+            app.logger.error(f"Errore nel rinnovo in background dell'addonSig Vavoo: {e}")
+        finally:
+            with self._refresh_lock:
+                self._refresh_in_progress = False
+
+    def get_signature(self, rejected_signature=None):
+        """
+        Restituisce l'addonSig dalla cache. Poco prima della scadenza avvia un
+        solo rinnovo in background; se è scaduto (o è stato rifiutato) lo
+        rinnova in modo sincrono, con una sola richiesta ping per tutti i thread.
+        Dopo un ping fallito restituisce None senza ritentare per
+        SIGNATURE_FAILURE_BACKOFF secondi.
+        """
+        _, margin = self._get_signature_timing()
+        signature = self._signature
+        now = time.time()
+        if signature and signature != rejected_signature and now < self._signature_expires_at:
+            if now >= self._signature_expires_at - margin and not self._in_failure_backoff():
+                with self._refresh_lock:
+                    start_refresh = not self._refresh_in_progress
+                    self._refresh_in_progress = True
+                if start_refresh:
+                    Thread(target=self._background_refresh, daemon=True).start()
+            return signature
+
+        if self._in_failure_backoff():
+            return None
+
+        with self._signature_lock:
+            # Rilegge dopo il lock: il rinnovo (o un ping fallito) potrebbe
+            # essere già stato fatto da un altro thread
+            signature = self._signature
+            if signature and signature != rejected_signature and time.time() < self._signature_expires_at:
+                return signature
+            if self._in_failure_backoff():
+                return None
+            return self._fetch_signature()
+
+
+    def signature_stats(self):
+        return {
+            "cached": self._signature is not None,
+            "expires_in": max(0, round(self._signature_expires_at - time.time())) if self._signature else 0,
+            "ping_requests": self.signature_fetches,
+            "ping_failures": self.signature_failures
+        }
+
     def getAuthSignature(self):
         """Funzione che replica esattamente quella dell'addon utils.py"""
         headers = {
@@ -118,18 +231,10 @@ class VavooResolver:
             return None
             
         # Solo metodo principale per il proxy
-        signature = self.getAuthSignature()
+        signature = self.get_signature()
         if not signature:
             return None
             
-        headers = {
-            "user-agent": "MediaHubMX/2",
-            "accept": "application/json",
-            "content-type": "application/json; charset=utf-8", 
-            "content-length": "115",
-            "accept-encoding": "gzip",
-            "mediahubmx-signature": signature
-        }
         data = {
             "language": "de",
             "region": "AT", 
@@ -138,7 +243,24 @@ class VavooResolver:
         }
         
         try:
-            resp = self.session.post("https://vavoo.to/mediahubmx-resolve.json", json=data, headers=headers, timeout=20)
+            for attempt in range(2):
+                headers = {
+                    "user-agent": "MediaHubMX/2",
+                    "accept": "application/json",
+                    "content-type": "application/json; charset=utf-8", 
+                    "content-length": "115",
+                    "accept-encoding": "gzip",
+                    "mediahubmx-signature": signature
+                }
+                resp = self.session.post("https://vavoo.to/mediahubmx-resolve.json", json=data, headers=headers, timeout=20)
+                if resp.status_code in (401, 403) and attempt == 0:
+                    # Firma rifiutata: forza il rinnovo (una sola volta per tutti i thread) e riprova
+                    app.logger.warning(f"addonSig Vavoo rifiutato ({resp.status_code}), rinnovo forzato")
+                    signature = self.get_signature(rejected_signature=signature)
+                    if not signature:
+                        return None
+                    continue
+                break
             resp.raise_for_status()
             
             result = resp.json()
@@ -158,28 +280,867 @@ class VavooResolver:
 vavoo_resolver = VavooResolver()
 
 # --- Configurazione Cache ---
+def get_memory_limit_bytes():
+    """Limite di memoria del container (cgroup v2/v1) o, in assenza, la RAM totale"""
+    for limit_file in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(limit_file, 'r') as f:
+                value = f.read().strip()
+            if value and value != 'max':
+                limit = int(value)
+                # cgroup v1 senza limite riporta un valore enorme
+                if 0 < limit < (1 << 60):
+                    return limit
+        except (OSError, ValueError):
+            continue
+    return psutil.virtual_memory().total
+
+def segment_key_hash(key):
+    """Hash della chiave di un segmento: indice degli slot condivisi e nome dei file su disco"""
+    return hashlib.md5(key.encode()).digest()
+
+class SegmentCache:
+    """
+    Cache dei segmenti limitata in byte (e non in numero di voci), con TTL per
+    voce ed eviction LRU. I byte occupati sono aggiornati ad ogni inserimento
+    e rimozione, senza mai riscansionare la cache. Le voci ancora valide
+    espulse per fare spazio (o troppo grandi per il budget) vengono passate a
+    spill(key_hash, value, ttl), di norma il livello su disco.
+    """
+    def __init__(self, max_bytes, ttl, max_entries=None, spill=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.spill = spill
+        self._entries = OrderedDict()  # {key: (value, expires_at)}
+        self._lock = Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected = 0
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self.current_bytes -= len(value)
+        return value
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Inserisce una voce; restituisce False se da sola supera il budget"""
+        size = len(value)
+        ttl = ttl if ttl is not None else self.ttl
+        if size > self.max_bytes:
+            self.rejected += 1
+            if self.spill:
+                self.spill(segment_key_hash(key), value, ttl)
+            return False
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, now + ttl)
+            self.current_bytes += size
+            # Eviction LRU finché non si rientra nel budget in byte (e nel numero di voci)
+            while self.current_bytes > self.max_bytes or (self.max_entries and len(self._entries) > self.max_entries):
+                oldest_key, (oldest_value, expires_at) = next(iter(self._entries.items()))
+                self._remove(oldest_key)
+                if expires_at <= now:
+                    self.expirations += 1
+                else:
+                    self.evictions += 1
+                    evicted.append((oldest_key, oldest_value, expires_at - now))
+        # Scrittura sul livello inferiore fuori dal lock
+        if self.spill:
+            for evicted_key, evicted_value, remaining in evicted:
+                self.spill(segment_key_hash(evicted_key), evicted_value, remaining)
+        return True
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def _purge_expired(self):
+        """Rimuove le voci scadute (l'ordine è LRU, non di scadenza: scansione completa). Va chiamata con _lock acquisito"""
+        now = time.monotonic()
+        expired = [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            self._remove(key)
+        self.expirations += len(expired)
+
+    def __len__(self):
+        """Numero di voci valide: le scadute vengono rimosse prima del conteggio"""
+        with self._lock:
+            self._purge_expired()
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            # Byte e voci riportati escludono le voci scadute
+            self._purge_expired()
+            lookups = self.hits + self.misses
+            return {
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "rejected": self.rejected,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+class SharedSegmentStore:
+    """
+    Cache condivisa tra i worker gunicorn dello stesso host: un file mmap (di
+    norma in /dev/shm) diviso in slot di dimensione fissa, con una tabella di
+    voci (hash chiave, lunghezza, scadenza, ultimo uso) e un contatore di
+    generazione nell'header. Ogni processo tiene un indice locale hash -> slot
+    e lo ricostruisce solo quando la generazione cambia; le scritture sono
+    serializzate con fcntl.flock tra processi e con un Lock tra thread.
+    Un file esistente non viene mai troncato (altri worker possono averlo
+    mappato): il nome del file contiene la geometria, vedi get_shared_cache_path.
+    """
+    REJECT_LOG_INTERVAL = 60
+    MAGIC = b'TVPXSHM1'
+    HEADER = struct.Struct('<8sIIQQ')  # magic, slot_size, slot_count, generation, clock
+    HEADER_SIZE = 4096
+    ENTRY = struct.Struct('<16sI4xdQ')  # key_hash, data_len, expires_at, last_used
+
+    def __init__(self, path, slot_size, slot_count, ttl, spill=None):
+        self.path = path
+        self.spill = spill  # Come in SegmentCache: riceve le voci valide espulse o troppo grandi
+        self.slot_size = slot_size
+        self.slot_count = slot_count
+        self.max_bytes = slot_size * slot_count
+        self.ttl = ttl
+        self._table_offset = self.HEADER_SIZE
+        self._data_offset = self.HEADER_SIZE + self.ENTRY.size * slot_count
+        self._file_size = self._data_offset + self.max_bytes
+        self._lock = Lock()
+        self._pid = None
+        self._fd = None
+        self._mm = None
+        self._generation = None
+        self._index = {}  # {key_hash: slot}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+        self._last_reject_log = 0
+
+    def open(self):
+        """Apre il file per questo processo: dopo un fork flock va rifatto su un nuovo descrittore"""
+        if self._pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            file_size = os.fstat(fd).st_size
+            if file_size == 0:
+                os.ftruncate(fd, self._file_size)
+            elif file_size != self._file_size:
+                raise OSError(f"{self.path} ha dimensione {file_size} invece di {self._file_size}")
+            mm = mmap.mmap(fd, self._file_size)
+            magic, slot_size, slot_count, _, _ = self.HEADER.unpack_from(mm, 0)
+            if magic == bytes(len(self.MAGIC)):
+                # File appena creato: inizializza l'header
+                self.HEADER.pack_into(mm, 0, self.MAGIC, self.slot_size, self.slot_count, 1, 0)
+            elif (magic, slot_size, slot_count) != (self.MAGIC, self.slot_size, self.slot_count):
+                mm.close()
+                raise OSError(f"{self.path} è stato creato con un'altra geometria ({slot_size} byte x {slot_count} slot)")
+        except OSError:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            raise
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd, self._mm, self._pid = fd, mm, os.getpid()
+        self._generation = None
+
+    def _read_header(self):
+        _, _, _, generation, clock = self.HEADER.unpack_from(self._mm, 0)
+        return generation, clock
+
+    def _write_header(self, generation, clock):
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, self.slot_size, self.slot_count, generation, clock)
+
+    def _read_entry(self, slot):
+        return self.ENTRY.unpack_from(self._mm, self._table_offset + slot * self.ENTRY.size)
+
+    def _write_entry(self, slot, key_hash, data_len, expires_at, last_used):
+        self.ENTRY.pack_into(self._mm, self._table_offset + slot * self.ENTRY.size, key_hash, data_len, expires_at, last_used)
+
+    def _sync_index(self):
+        """Ricostruisce l'indice locale se un altro processo ha modificato la tabella"""
+        generation, _ = self._read_header()
+        if generation == self._generation:
+            return
+        now = time.time()
+        index = {}
+        for slot in range(self.slot_count):
+            key_hash, data_len, expires_at, _ = self._read_entry(slot)
+            if data_len and expires_at > now:
+                index[key_hash] = slot
+        self._index = index
+        self._generation = generation
+
+
+    def get(self, key, default=None):
+        key_hash = segment_key_hash(key)
+        with self._lock:
+            self.open()
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                self._sync_index()
+                slot = self._index.get(key_hash)
+                if slot is not None:
+                    entry_hash, data_len, expires_at, _ = self._read_entry(slot)
+                    if entry_hash == key_hash and data_len and expires_at > time.time():
+                        offset = self._data_offset + slot * self.slot_size
+                        value = self._mm[offset:offset + data_len]
+                        # Aggiornamento LRU senza lock esclusivo: al peggio l'ordine è approssimato
+                        generation, clock = self._read_header()
+                        self._write_entry(slot, entry_hash, data_len, expires_at, clock + 1)
+                        self._write_header(generation, clock + 1)
+                        self.hits += 1
+                        return value
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """Inserisce una voce; restituisce False se non entra in uno slot"""
+        if len(value) > self.slot_size:
+            self.rejected += 1
+            now = time.monotonic()
+            if now - self._last_reject_log >= self.REJECT_LOG_INTERVAL:
+                self._last_reject_log = now
+                app.logger.warning(
+                    f"Segmento di {len(value) // 1024}KB non cachato: supera lo slot della cache condivisa "
+                    f"({self.slot_size // 1024}KB, {self.rejected} rifiutati finora). Aumentare CACHE_SHARED_SLOT_KB."
+                )
+            if self.spill:
+                self.spill(segment_key_hash(key), value, ttl if ttl is not None else self.ttl)
+            return False
+        key_hash = segment_key_hash(key)
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        evicted = None
+        with self._lock:
+            self.open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self._sync_index()
+                generation, clock = self._read_header()
+                slot = self._index.get(key_hash)
+                if slot is None:
+                    slot = self._find_slot()
+                    victim_hash, victim_len, victim_expires_at, _ = self._read_entry(slot)
+                    if self.spill and victim_len and victim_expires_at > time.time():
+                        victim_offset = self._data_offset + slot * self.slot_size
+                        evicted = (victim_hash, self._mm[victim_offset:victim_offset + victim_len], victim_expires_at - time.time())
+                offset = self._data_offset + slot * self.slot_size
+                self._mm[offset:offset + len(value)] = value
+                self._write_entry(slot, key_hash, len(value), expires_at, clock + 1)
+                self._write_header(generation + 1, clock + 1)
+                self._index[key_hash] = slot
+                self._generation = generation + 1
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        if evicted:
+            self.spill(*evicted)
+        return True
+
+    def _find_slot(self):
+        """Slot libero o scaduto, altrimenti quello usato meno di recente (richiede LOCK_EX)"""
+        now = time.time()
+        victim = None
+        victim_last_used = None
+        for slot in range(self.slot_count):
+            key_hash, data_len, expires_at, last_used = self._read_entry(slot)
+            if not data_len or expires_at <= now:
+                if data_len:
+                    self._index.pop(key_hash, None)
+                return slot
+            if victim is None or last_used < victim_last_used:
+                victim, victim_last_used = slot, last_used
+        self._index.pop(self._read_entry(victim)[0], None)
+        self.evictions += 1
+        return victim
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        key_hash = segment_key_hash(key)
+        with self._lock:
+            self.open()
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                self._sync_index()
+                slot = self._index.get(key_hash)
+                return slot is not None and self._read_entry(slot)[2] > time.time()
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def __len__(self):
+        with self._lock:
+            self.open()
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                self._sync_index()
+                return len(self._index)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def clear(self):
+        with self._lock:
+            self.open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                generation, clock = self._read_header()
+                self._mm[self._table_offset:self._data_offset] = bytes(self._data_offset - self._table_offset)
+                self._write_header(generation + 1, clock)
+                self._index = {}
+                self._generation = generation + 1
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def stats(self):
+        used_bytes = 0
+        with self._lock:
+            self.open()
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                self._sync_index()
+                for slot in self._index.values():
+                    used_bytes += self._read_entry(slot)[1]
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        lookups = self.hits + self.misses
+        return {
+            "backend": "shared",
+            "path": self.path,
+            "bytes": used_bytes,
+            "max_bytes": self.max_bytes,
+            "slot_size": self.slot_size,
+            "slots": self.slot_count,
+            "evictions": self.evictions,
+            "rejected": self.rejected,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+class DiskSegmentCache:
+    """
+    Secondo livello della cache TS su disco: riceve i segmenti ancora validi
+    espulsi dalla cache in memoria (spill), così il disco estende la memoria
+    invece di duplicarla. Un file per segmento (nome = md5 della chiave)
+    scritto in modo atomico con os.replace. La scadenza è mtime + ttl e l'LRU
+    usa l'atime, impostato esplicitamente ad ogni hit. La directory può essere
+    condivisa tra i worker: l'occupazione viene stimata localmente e, superato
+    il budget, una scansione riporta la directory a LOW_WATER del budget.
+    """
+    SUFFIX = '.seg'
+    TMP_SUFFIX = '.tmp'
+    LOW_WATER = 0.9
+
+    def __init__(self, directory, max_bytes, ttl):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._approx_bytes = 0
+        self._enforce_budget()
+
+    def _path(self, key):
+        return self._hash_path(segment_key_hash(key))
+
+    def _hash_path(self, key_hash):
+        return os.path.join(self.directory, key_hash.hex() + self.SUFFIX)
+
+    def open(self, key):
+        """Restituisce (file, size) aperto in lettura se il segmento è su disco e valido, altrimenti None"""
+        path = self._path(key)
+        try:
+            segment_file = open(path, 'rb')
+        except OSError:
+            self.misses += 1
+            return None
+        stat = os.fstat(segment_file.fileno())
+        now = time.time()
+        if stat.st_mtime + self.ttl <= now:
+            segment_file.close()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.misses += 1
+            return None
+        try:
+            # atime = ultimo uso, usato per l'eviction LRU
+            os.utime(path, (now, stat.st_mtime))
+        except OSError:
+            pass
+        self.hits += 1
+        return segment_file, stat.st_size
+
+    def set(self, key, value, ttl=None):
+        return self.spill(segment_key_hash(key), value, ttl)
+
+    def spill(self, key_hash, value, ttl=None):
+        """Scrive un segmento identificato dall'hash della chiave; ttl è la validità residua"""
+        if len(value) > self.max_bytes:
+            return False
+        path = self._hash_path(key_hash)
+        try:
+            previous_size = os.stat(path).st_size
+        except OSError:
+            previous_size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=self.TMP_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(value)
+            if ttl is not None and ttl < self.ttl:
+                # La scadenza è mtime + self.ttl: la voce espulsa conserva la sua
+                now = time.time()
+                os.utime(tmp_path, (now, now + ttl - self.ttl))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            app.logger.error(f"Errore nella scrittura del segmento su disco: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        with self._lock:
+            self._approx_bytes += len(value) - previous_size
+            self.writes += 1
+            over_budget = self._approx_bytes > self.max_bytes
+        if over_budget:
+            self._enforce_budget()
+        return True
+
+    def _enforce_budget(self):
+        """Rimuove i file scaduti e poi i meno usati finché non si scende a LOW_WATER del budget"""
+        with self._lock:
+            now = time.time()
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                try:
+                    stat = entry.stat()
+                    if entry.name.endswith(self.TMP_SUFFIX):
+                        # Scritture interrotte da un crash
+                        if now - stat.st_mtime > 60:
+                            os.remove(entry.path)
+                        continue
+                    if not entry.name.endswith(self.SUFFIX):
+                        continue
+                    if stat.st_mtime + self.ttl <= now:
+                        os.remove(entry.path)
+                        continue
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+                total += stat.st_size
+
+            # Anche se la stima era in eccesso si scende comunque a LOW_WATER:
+            # la prossima scansione arriva solo dopo (1 - LOW_WATER) del budget di scritture
+            target = int(self.max_bytes * self.LOW_WATER)
+            if total > target:
+                entries.sort()
+                for _, size, path in entries:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                    total -= size
+                    self.evictions += 1
+            self._approx_bytes = total
+
+    def clear(self):
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(self.SUFFIX):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+            self._approx_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "directory": self.directory,
+            "bytes": self._approx_bytes,
+            "max_bytes": self.max_bytes,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+class ResolutionCache:
+    """
+    Cache dei link risolti (DaddyLive, Vavoo, ...) con TTL per voce. Tiene un
+    indice inverso URL risolto -> chiavi, così quando un URL risolto smette
+    di funzionare (403/404) tutte le voci che lo puntano vengono invalidate.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # {key: (result, expires_at)}
+        self._keys_by_resolved_url = {}  # {resolved_url: set(key)}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _remove(self, key):
+        result, _ = self._entries.pop(key)
+        resolved_url = result.get("resolved_url")
+        keys = self._keys_by_resolved_url.get(resolved_url)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_resolved_url[resolved_url]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, result, ttl=None):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result, time.monotonic() + (ttl if ttl is not None else self.ttl))
+            self._keys_by_resolved_url.setdefault(result.get("resolved_url"), set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_resolved(self, resolved_url):
+        """Rimuove tutte le voci che puntano a resolved_url; restituisce quante ne ha rimosse"""
+        with self._lock:
+            keys = list(self._keys_by_resolved_url.get(resolved_url, ()))
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def expires_in(self, key):
+        """Secondi mancanti alla scadenza della voce, None se assente o già scaduta"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            remaining = entry[1] - time.monotonic()
+            return remaining if remaining > 0 else None
+
+    def __setitem__(self, key, result):
+        self.set(key, result)
+
+    def __getitem__(self, key):
+        result = self.get(key)
+        if result is None:
+            raise KeyError(key)
+        return result
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def pop(self, key, default=None):
+        """Rimuove la voce (anche se scaduta) e la restituisce"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_resolved_url.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+class PlaylistCache:
+    """
+    Cache delle playlist M3U8 riscritte con semantica stale-while-revalidate:
+    scaduto il TTL, la voce resta servibile per stale_grace secondi mentre
+    un solo refresh in background per chiave la aggiorna.
+    """
+    def __init__(self, maxsize, ttl, stale_grace=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_grace = stale_grace
+        self._entries = OrderedDict()  # {key: (content, fresh_until, stale_until, media_sequence)}
+        self._refreshing = set()
+        self._lock = Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.background_refreshes = 0
+
+    def lookup(self, key):
+        """Restituisce (content, is_fresh); content è None se la voce manca o è oltre la grace"""
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is None or entry[2] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None, False
+            self._entries.move_to_end(key)
+            if entry[1] > now:
+                self.hits += 1
+                return entry[0], True
+            self.stale_hits += 1
+            return entry[0], False
+
+    def set(self, key, content, ttl=None, media_sequence=None):
+        ttl = ttl if ttl is not None else self.ttl
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (content, now + ttl, now + ttl + self.stale_grace, media_sequence)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_media_sequence(self, key):
+        """#EXT-X-MEDIA-SEQUENCE della versione in cache (anche se scaduta), None se sconosciuto"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[3] if entry is not None else None
+
+    def begin_refresh(self, key):
+        """True se il chiamante deve avviare il refresh di key (uno solo alla volta per chiave)"""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            self.background_refreshes += 1
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def __setitem__(self, key, content):
+        self.set(key, content)
+
+    def __getitem__(self, key):
+        content, is_fresh = self.lookup(key)
+        if content is None or not is_fresh:
+            raise KeyError(key)
+        return content
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "stale_grace": self.stale_grace,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "background_refreshes": self.background_refreshes,
+                "refreshing": len(self._refreshing),
+                "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0
+            }
+
+def get_ts_cache_budget(config):
+    """Budget in byte della cache TS: CACHE_MAXBYTES_TS_MB, eventualmente ridotto a una % della memoria del container"""
+    max_bytes = int(config.get('CACHE_MAXBYTES_TS_MB', 256)) * 1024 * 1024
+    memory_percent = float(config.get('CACHE_MAX_MEMORY_PERCENT_TS', 0) or 0)
+    if memory_percent > 0:
+        max_bytes = min(max_bytes, int(get_memory_limit_bytes() * memory_percent / 100))
+    return max_bytes
+
+SHARED_KEY_SLOT_SIZE = 1024  # Le chiavi AES-128 sono di 16 byte
+
+def get_shared_cache_path(directory, name, slot_size, slot_count):
+    """
+    Percorso del file della cache condivisa, con la geometria nel nome: un
+    cambio di CACHE_SHARED_SLOT_KB o del budget crea un file nuovo invece di
+    ridimensionare quello che i worker della generazione precedente hanno
+    ancora mappato. I file con altra geometria vengono solo scollegati: chi
+    li ha mappati continua a usarli finché non termina.
+    """
+    filename = f"{name}-{slot_size // 1024}k-{slot_count}.shm"
+    try:
+        for entry in os.scandir(directory):
+            stale = entry.name == f"{name}.cache" or (entry.name.startswith(f"{name}-") and entry.name.endswith('.shm'))
+            if stale and entry.name != filename:
+                os.unlink(entry.path)
+    except OSError as e:
+        app.logger.warning(f"Pulizia dei file di cache condivisa in {directory} non riuscita: {e}")
+    return os.path.join(directory, filename)
+
+def create_shared_caches(config, spill=None):
+    """
+    Crea TS_CACHE e KEY_CACHE condivise tra i worker dello stesso host
+    (CACHE_BACKEND=shared). Restituisce None se il backend non è utilizzabile.
+    spill riceve i segmenti espulsi dalla cache TS.
+    """
+    if fcntl is None:
+        app.logger.warning("CACHE_BACKEND=shared non disponibile su questa piattaforma (fcntl mancante), uso cache locali.")
+        return None
+    directory = config.get('CACHE_SHARED_DIR', '/dev/shm')
+    if not os.path.isdir(directory):
+        directory = tempfile.gettempdir()
+    slot_size = config.get('CACHE_SHARED_SLOT_KB', 4096) * 1024
+    ts_slot_count = max(1, get_ts_cache_budget(config) // slot_size)
+    key_slot_count = config['CACHE_MAXSIZE_KEY']
+    try:
+        ts_cache = SharedSegmentStore(
+            get_shared_cache_path(directory, 'tvproxy_ts', slot_size, ts_slot_count),
+            slot_size=slot_size,
+            slot_count=ts_slot_count,
+            ttl=config['CACHE_TTL_TS'],
+            spill=spill
+        )
+        key_cache = SharedSegmentStore(
+            get_shared_cache_path(directory, 'tvproxy_key', SHARED_KEY_SLOT_SIZE, key_slot_count),
+            slot_size=SHARED_KEY_SLOT_SIZE,
+            slot_count=key_slot_count,
+            ttl=config['CACHE_TTL_KEY']
+        )
+        ts_cache.open()
+        key_cache.open()
+    except OSError as e:
+        app.logger.error(f"Impossibile creare la cache condivisa in {directory}: {e}, uso cache locali.")
+        return None
+    return ts_cache, key_cache
+
+def create_disk_cache(config):
+    """Crea il livello su disco della cache TS se CACHE_DISK_DIR è configurata"""
+    directory = config.get('CACHE_DISK_DIR', '')
+    if not directory:
+        return None
+    try:
+        disk_cache = DiskSegmentCache(directory, max_bytes=config.get('CACHE_DISK_MAX_MB', 2048) * 1024 * 1024, ttl=config['CACHE_TTL_TS'])
+    except OSError as e:
+        app.logger.error(f"Impossibile usare {directory} per la cache su disco: {e}")
+        return None
+    app.logger.info(f"Cache TS su disco ABILITATA in {directory} ({disk_cache.max_bytes / (1024*1024):.0f}MB).")
+    return disk_cache
+
 def setup_all_caches():
-    global M3U8_CACHE, TS_CACHE, KEY_CACHE, RESOLVED_LINKS_CACHE
+    global M3U8_CACHE, TS_CACHE, TS_DISK_CACHE, KEY_CACHE, RESOLVED_LINKS_CACHE
     try:
-        config = config_manager.load_config()
+        config = config_manager.get_config()
         if config.get('CACHE_ENABLED', True):
-            M3U8_CACHE = TTLCache(maxsize=config['CACHE_MAXSIZE_M3U8'], ttl=config['CACHE_TTL_M3U8'])
-            TS_CACHE = TTLCache(maxsize=config['CACHE_MAXSIZE_TS'], ttl=config['CACHE_TTL_TS'])
-            KEY_CACHE = TTLCache(maxsize=config['CACHE_MAXSIZE_KEY'], ttl=config['CACHE_TTL_KEY'])
-            RESOLVED_LINKS_CACHE = TTLCache(maxsize=config['CACHE_MAXSIZE_RESOLVED_LINKS'], ttl=config['CACHE_TTL_RESOLVED_LINKS'])
-            app.logger.info("Cache ABILITATA su tutte le risorse.")
+            M3U8_CACHE = PlaylistCache(maxsize=config['CACHE_MAXSIZE_M3U8'], ttl=config['CACHE_TTL_M3U8'], stale_grace=config['CACHE_STALE_GRACE_M3U8'])
+            # Playlist e link risolti restano per worker: sono piccoli e legati agli header della richiesta
+            # Il disco riceve solo ciò che la cache in memoria espelle
+            TS_DISK_CACHE = create_disk_cache(config)
+            spill = TS_DISK_CACHE.spill if TS_DISK_CACHE else None
+            shared_caches = create_shared_caches(config, spill) if config.get('CACHE_BACKEND', 'local') == 'shared' else None
+            if shared_caches:
+                TS_CACHE, KEY_CACHE = shared_caches
+                app.logger.info(f"Cache TS e chiavi condivise tra i worker in {os.path.dirname(TS_CACHE.path)}.")
+            else:
+                TS_CACHE = SegmentCache(max_bytes=get_ts_cache_budget(config), ttl=config['CACHE_TTL_TS'], max_entries=config['CACHE_MAXSIZE_TS'], spill=spill)
+                KEY_CACHE = TTLCache(maxsize=config['CACHE_MAXSIZE_KEY'], ttl=config['CACHE_TTL_KEY'])
+            RESOLVED_LINKS_CACHE = ResolutionCache(maxsize=config['CACHE_MAXSIZE_RESOLVED_LINKS'], ttl=config['CACHE_TTL_RESOLVED_LINKS'])
+            app.logger.info(f"Cache ABILITATA su tutte le risorse (cache TS: {TS_CACHE.max_bytes / (1024*1024):.0f}MB).")
         else:
             M3U8_CACHE = {}
             TS_CACHE = {}
+            TS_DISK_CACHE = None
             KEY_CACHE = {}
             RESOLVED_LINKS_CACHE = {}
             app.logger.warning("TUTTE LE CACHE DISABILITATE: stream diretto attivo.")
     except NameError:
         # Fallback se config_manager non è ancora disponibile
-        M3U8_CACHE = TTLCache(maxsize=100, ttl=300)
-        TS_CACHE = TTLCache(maxsize=1000, ttl=60)
+        M3U8_CACHE = PlaylistCache(maxsize=100, ttl=300)
+        TS_CACHE = SegmentCache(max_bytes=128 * 1024 * 1024, ttl=60, max_entries=1000)
+        TS_DISK_CACHE = None
         KEY_CACHE = TTLCache(maxsize=50, ttl=3600)
-        RESOLVED_LINKS_CACHE = TTLCache(maxsize=1000, ttl=3600)
+        RESOLVED_LINKS_CACHE = ResolutionCache(maxsize=1000, ttl=3600)
         app.logger.info("Cache inizializzata con valori di fallback.")
 
 # --- Configurazione Generale ---
@@ -220,7 +1181,84 @@ def setup_logging():
 setup_logging()
 
 # --- Configurazione Manager ---
+def parse_proxy_list(proxy_value, label=''):
+    """Converte una stringa di proxy separati da virgola in una lista di URL normalizzati"""
+    prefix = f"Proxy {label} " if label else "Proxy "
+    proxies_found = []
+
+    if not proxy_value or not proxy_value.strip():
+        return proxies_found
+
+    # Separa i proxy se ce ne sono più di uno
+    proxy_list = [p.strip() for p in proxy_value.split(',') if p.strip()]
+
+    for proxy in proxy_list:
+        # Gestione automatica del tipo di proxy
+        if proxy.startswith('socks5://'):
+            # Converti SOCKS5 in SOCKS5H per risoluzione DNS remota
+            final_proxy_url = 'socks5h' + proxy[len('socks5'):]
+            app.logger.info(f"{prefix}SOCKS5 convertito: {proxy} -> {final_proxy_url}")
+        elif proxy.startswith('socks5h://'):
+            final_proxy_url = proxy
+            app.logger.info(f"{prefix}SOCKS5H configurato: {proxy}")
+        elif proxy.startswith('http://') or proxy.startswith('https://'):
+            final_proxy_url = proxy
+            app.logger.info(f"{prefix}HTTP/HTTPS configurato: {proxy}")
+        else:
+            # Se non ha protocollo, assume HTTP
+            final_proxy_url = f"http://{proxy}"
+            app.logger.info(f"{prefix}senza protocollo, convertito in HTTP: {proxy} -> {final_proxy_url}")
+
+        proxies_found.append(final_proxy_url)
+
+    return proxies_found
+
+def parse_cache_key_rules(rules_value):
+    """
+    Converte CACHE_KEY_IGNORE_PARAMS ("*:token,expires;cdn.example.com:hdnts")
+    in una tupla di coppie (dominio, parametri da ignorare). "*" vale per tutti gli host.
+    """
+    rules = {}
+    for rule in str(rules_value or '').split(';'):
+        domain, sep, params = rule.partition(':')
+        domain = domain.strip().lower().strip('.')
+        if not sep or not domain:
+            continue
+        names = {p.strip().lower() for p in params.split(',') if p.strip()}
+        if names:
+            rules[domain] = rules.get(domain, frozenset()) | names
+    return tuple(rules.items())
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """
+    Fotografia immutabile della configurazione. Viene costruita una sola volta
+    (all'avvio o al reload) e sostituita in blocco, così le route non rileggono
+    file e variabili d'ambiente ad ogni richiesta.
+    """
+    values: Mapping[str, Any]
+    proxy_list: Tuple[str, ...] = ()
+    daddy_proxy_list: Tuple[str, ...] = ()
+    no_proxy_domains: FrozenSet[str] = frozenset()
+    cache_enabled: bool = False
+    request_timeout: int = 45
+    cache_key_rules: Tuple[Tuple[str, FrozenSet[str]], ...] = ()
+    file_mtime: Optional[float] = None
+    loaded_at: float = 0.0
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values
+
 class ConfigManager:
+    # Ogni quanto (secondi) controllare l'mtime del file di configurazione
+    MTIME_CHECK_INTERVAL = 2.0
+
     def __init__(self):
         self.config_file = 'proxy_config.json'
         self.default_config = {
@@ -233,11 +1271,21 @@ class ConfigManager:
             'POOL_CONNECTIONS': 50,
             'POOL_MAXSIZE': 300,
             'CACHE_TTL_M3U8': 5,
+            'CACHE_STALE_GRACE_M3U8': 30,
+            'CACHE_TTL_M3U8_VOD': 3600,
             'CACHE_TTL_TS': 600,
             'CACHE_TTL_KEY': 600,
             'CACHE_MAXSIZE_M3U8': 500,
             'CACHE_MAXSIZE_TS': 8000,
+            'CACHE_MAXBYTES_TS_MB': 256,
+            'CACHE_MAX_MEMORY_PERCENT_TS': 0.0,
             'CACHE_MAXSIZE_KEY': 1000,
+            'CACHE_BACKEND': 'local',
+            'CACHE_SHARED_DIR': '/dev/shm',
+            'CACHE_SHARED_SLOT_KB': 4096,
+            'CACHE_DISK_DIR': '',
+            'CACHE_DISK_MAX_MB': 2048,
+            'CACHE_KEY_IGNORE_PARAMS': '',
             'CACHE_ENABLED' : False,
             'NO_PROXY_DOMAINS': 'github.com,raw.githubusercontent.com',
             'PREBUFFER_ENABLED': False,
@@ -246,10 +1294,43 @@ class ConfigManager:
             'PREBUFFER_CLEANUP_INTERVAL': 300,
             'PREBUFFER_MAX_MEMORY_PERCENT': 30.0,
             'PREBUFFER_EMERGENCY_THRESHOLD': 99.9,
+            'PREFETCH_WORKERS': 4,
+            'PREFETCH_MAX_INFLIGHT_MB': 32,
+            'PREFETCH_IDLE_TIMEOUT': 30,
             'CACHE_TTL_RESOLVED_LINKS': 3600,
+            'CACHE_TTL_RESOLVED_DADDYLIVE': 600,
+            'CACHE_TTL_RESOLVED_VAVOO': 300,
             'CACHE_MAXSIZE_RESOLVED_LINKS': 1000,
             'PARALLEL_WORKERS_MAX': 100,
+            'VAVOO_SIGNATURE_TTL': 600,
+            'VAVOO_SIGNATURE_REFRESH_MARGIN': 60,
+            'DADDY_STAGE_TTL_PLAYER': 3600,
+            'DADDY_STAGE_TTL_IFRAME': 3600,
+            'DADDY_STAGE_TTL_AUTH': 300,
+            'DADDY_STAGE_TTL_SERVER_KEY': 600,
+            'HOT_CHANNEL_REFRESH_ENABLED': True,
+            'HOT_CHANNEL_WINDOW': 600,
+            'HOT_CHANNEL_REFRESH_MARGIN': 60,
+            'HOT_CHANNEL_MAX_WORKERS': 4,
+            'HEDGE_ENABLED': False,
+            'HEDGE_BUDGET_PERCENT': 5,
+            'HEDGE_MIN_DELAY_MS': 300,
+            'TIMEOUT_CONNECT_MIN': 2,
+            'TIMEOUT_CONNECT_MAX': 10,
+            'TIMEOUT_READ_MIN': 3,
+            'TIMEOUT_READ_MAX': 30,
         }
+        self._snapshot = None
+        self._snapshot_lock = Lock()
+        self._last_mtime_check = 0.0
+        self._reload_requested = False
+
+    def _get_file_mtime(self):
+        """Restituisce l'mtime del file di configurazione, o None se non esiste"""
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
         
     def load_config(self):
         """Carica la configurazione combinando proxy da file e variabili d'ambiente"""
@@ -283,18 +1364,25 @@ class ConfigManager:
                 env_value = os.environ.get(key)
                 if env_value is not None:
                     # Converti il tipo appropriato
-                    if key in ['VERIFY_SSL', 'CACHE_ENABLED', 'PREBUFFER_ENABLED']:
+                    if key in ['VERIFY_SSL', 'CACHE_ENABLED', 'PREBUFFER_ENABLED', 'HOT_CHANNEL_REFRESH_ENABLED', 'HEDGE_ENABLED']:
                         config[key] = env_value.lower() in ('true', '1', 'yes')
                     elif key in ['REQUEST_TIMEOUT', 'KEEP_ALIVE_TIMEOUT', 'MAX_KEEP_ALIVE_REQUESTS', 
-                                'POOL_CONNECTIONS', 'POOL_MAXSIZE', 'CACHE_TTL_M3U8', 'CACHE_TTL_TS', 
-                                'CACHE_TTL_KEY', 'CACHE_TTL_RESOLVED_LINKS', 'CACHE_MAXSIZE_M3U8', 'CACHE_MAXSIZE_TS', 
+                                'POOL_CONNECTIONS', 'POOL_MAXSIZE', 'CACHE_TTL_M3U8', 'CACHE_STALE_GRACE_M3U8', 'CACHE_TTL_M3U8_VOD', 'CACHE_TTL_TS', 
+                                'CACHE_TTL_KEY', 'CACHE_TTL_RESOLVED_LINKS', 'CACHE_TTL_RESOLVED_DADDYLIVE', 'CACHE_TTL_RESOLVED_VAVOO',
+                                'CACHE_MAXSIZE_M3U8', 'CACHE_MAXSIZE_TS', 
                                 'CACHE_MAXSIZE_KEY', 'CACHE_MAXSIZE_RESOLVED_LINKS', 'PARALLEL_WORKERS_MAX',
-                                'PREBUFFER_MAX_SEGMENTS', 'PREBUFFER_MAX_SIZE_MB', 'PREBUFFER_CLEANUP_INTERVAL']:
+                                'PREBUFFER_MAX_SEGMENTS', 'PREBUFFER_MAX_SIZE_MB', 'PREBUFFER_CLEANUP_INTERVAL',
+                                'PREFETCH_WORKERS', 'PREFETCH_MAX_INFLIGHT_MB', 'PREFETCH_IDLE_TIMEOUT',
+                                'CACHE_MAXBYTES_TS_MB', 'CACHE_SHARED_SLOT_KB', 'CACHE_DISK_MAX_MB', 'VAVOO_SIGNATURE_TTL', 'VAVOO_SIGNATURE_REFRESH_MARGIN',
+                                'DADDY_STAGE_TTL_PLAYER', 'DADDY_STAGE_TTL_IFRAME', 'DADDY_STAGE_TTL_AUTH',
+                                'DADDY_STAGE_TTL_SERVER_KEY', 'HOT_CHANNEL_WINDOW', 'HOT_CHANNEL_REFRESH_MARGIN',
+                                'HOT_CHANNEL_MAX_WORKERS', 'HEDGE_MIN_DELAY_MS']:
                         try:
                             config[key] = int(env_value)
                         except ValueError:
                             app.logger.warning(f"Valore non valido per {key}: {env_value}")
-                    elif key in ['PREBUFFER_MAX_MEMORY_PERCENT', 'PREBUFFER_EMERGENCY_THRESHOLD']:
+                    elif key in ['PREBUFFER_MAX_MEMORY_PERCENT', 'PREBUFFER_EMERGENCY_THRESHOLD', 'CACHE_MAX_MEMORY_PERCENT_TS', 'HEDGE_BUDGET_PERCENT',
+                                 'TIMEOUT_CONNECT_MIN', 'TIMEOUT_CONNECT_MAX', 'TIMEOUT_READ_MIN', 'TIMEOUT_READ_MAX']:
                         try:
                             config[key] = float(env_value)
                         except ValueError:
@@ -304,11 +1392,73 @@ class ConfigManager:
         
         return config
     
+    def _build_snapshot(self):
+        """Costruisce una nuova ConfigSnapshot a partire da file e variabili d'ambiente"""
+        file_mtime = self._get_file_mtime()
+        config = self.load_config()
+
+        no_proxy_domains = frozenset(
+            d.strip().lower() for d in str(config.get('NO_PROXY_DOMAINS', '')).split(',') if d.strip()
+        )
+
+        try:
+            request_timeout = int(config.get('REQUEST_TIMEOUT', 45))
+        except (TypeError, ValueError):
+            request_timeout = 45
+
+        return ConfigSnapshot(
+            values=MappingProxyType(config),
+            proxy_list=tuple(parse_proxy_list(config.get('PROXY', ''))),
+            daddy_proxy_list=tuple(parse_proxy_list(config.get('DADDY_PROXY', ''), 'DaddyLive')),
+            no_proxy_domains=no_proxy_domains,
+            cache_enabled=bool(config.get('CACHE_ENABLED', True)),
+            request_timeout=request_timeout,
+            cache_key_rules=parse_cache_key_rules(config.get('CACHE_KEY_IGNORE_PARAMS', '')),
+            file_mtime=file_mtime,
+            loaded_at=time.time()
+        )
+
+    def reload(self):
+        """Ricostruisce la snapshot e la sostituisce in modo atomico"""
+        with self._snapshot_lock:
+            snapshot = self._build_snapshot()
+            self._snapshot = snapshot
+            self._last_mtime_check = time.time()
+            self._reload_requested = False
+        app.logger.info(f"Configurazione (ri)caricata: {len(snapshot.proxy_list)} proxy generali, "
+                        f"{len(snapshot.daddy_proxy_list)} proxy DaddyLive, "
+                        f"{len(snapshot.no_proxy_domains)} domini NO_PROXY")
+        return snapshot
+
+    def request_reload(self):
+        """Richiede un reload alla prossima lettura (sicuro da chiamare in un signal handler)"""
+        self._reload_requested = True
+
+    def get_config(self):
+        """
+        Restituisce la snapshot corrente della configurazione. Il file viene
+        ricontrollato solo ogni MTIME_CHECK_INTERVAL secondi e riletto solo se
+        l'mtime è cambiato o se è stato richiesto un reload.
+        """
+        snapshot = self._snapshot
+        if snapshot is None or self._reload_requested:
+            return self.reload()
+
+        now = time.time()
+        if now - self._last_mtime_check >= self.MTIME_CHECK_INTERVAL:
+            self._last_mtime_check = now
+            if self._get_file_mtime() != snapshot.file_mtime:
+                app.logger.info("File di configurazione modificato, ricarico la configurazione")
+                return self.reload()
+
+        return snapshot
+    
     def save_config(self, config):
         """Salva la configurazione nel file JSON"""
         try:
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(config, f, indent=4)
+            self.reload()
             return True
         except Exception as e:
             app.logger.error(f"Errore nel salvataggio della configurazione: {e}")
@@ -316,27 +1466,265 @@ class ConfigManager:
     
     def apply_config_to_app(self, config):
         """Applica la configurazione all'app Flask"""
+        # Non copiare i valori in os.environ: in load_config le variabili
+        # d'ambiente hanno la precedenza sul file, e rispecchiarvi la
+        # configurazione congelerebbe i valori impedendo il reload.
         for key, value in config.items():
             if hasattr(app, 'config'):
                 app.config[key] = value
-            os.environ[key] = str(value)
         return True
 
 config_manager = ConfigManager()
 
+def handle_reload_signal(signum, frame):
+    """Handler SIGHUP: forza il reload della configurazione alla prossima richiesta"""
+    config_manager.request_reload()
+
+try:
+    signal.signal(signal.SIGHUP, handle_reload_signal)
+except (AttributeError, ValueError):
+    # SIGHUP non disponibile (Windows) o import fuori dal main thread
+    pass
+
+# --- Scheduler globale del pre-buffering ---
+class PrefetchScheduler:
+    """
+    Scheduler unico del pre-buffering: un pool fisso di worker serve tutti gli
+    stream da una coda a priorità ordinata per distanza del segmento dal
+    playhead del viewer. Deduplica i segmenti per stream, limita i byte in
+    download contemporaneamente e abbandona gli stream rimasti inattivi.
+    """
+    DEFAULT_SEGMENT_SIZE = 1024 * 1024  # Stima finché non si conosce la dimensione reale
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, manager):
+        self.manager = manager
+        self._heap = []  # [(distance, order, stream_id, sequence, cache_key, segment_url, headers)]
+        self._pending = set()  # {(stream_id, cache_key)} in coda o in download
+        self._playheads = {}  # {stream_id: (sequence dell'ultimo segmento richiesto da ogni viewer, ...)}
+        self._last_activity = {}  # {stream_id: monotonic}
+        self._segment_sizes = {}  # {stream_id: dimensione media dei segmenti}
+        self._inflight_bytes = 0
+        self._order = 0
+        self._reprioritize = False
+        self._cond = Condition()
+        self._workers = []
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.deduplicated = 0
+
+    def _get_limits(self):
+        config = config_manager.get_config()
+        return (
+            max(1, config.get('PREFETCH_WORKERS', 4)),
+            config.get('PREFETCH_MAX_INFLIGHT_MB', 32) * 1024 * 1024,
+            config.get('PREFETCH_IDLE_TIMEOUT', 30)
+        )
+
+    def _ensure_workers(self):
+        workers, _, _ = self._get_limits()
+        while len(self._workers) < workers:
+            worker = Thread(target=self._worker, name=f"prefetch_worker_{len(self._workers)}", daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def submit(self, stream_id, sequence, cache_key, segment_url, headers):
+        """Accoda un segmento; False se è già in coda o in download per lo stream"""
+        with self._cond:
+            key = (stream_id, cache_key)
+            if key in self._pending:
+                self.deduplicated += 1
+                return False
+            self._last_activity[stream_id] = time.monotonic()
+            # Senza playhead noto si assume che il viewer parta dal primo segmento accodato
+            self._playheads.setdefault(stream_id, (sequence - 1,))
+            self._pending.add(key)
+            heapq.heappush(self._heap, (self._distance_locked(stream_id, sequence), self._order, stream_id, sequence, cache_key, segment_url, headers))
+            self._order += 1
+            self.submitted += 1
+            self._ensure_workers()
+            self._cond.notify()
+            return True
+
+    def touch(self, stream_id):
+        """Segna lo stream come attivo (playlist letta)"""
+        with self._cond:
+            self._last_activity[stream_id] = time.monotonic()
+
+    def _distance_locked(self, stream_id, sequence):
+        """Distanza del segmento dal viewer più vicino che non l'ha ancora superato (0 = superato da tutti)"""
+        playheads = self._playheads.get(stream_id, (sequence - 1,))
+        return min((sequence - playhead for playhead in playheads if playhead < sequence), default=0)
+
+    def update_playheads(self, stream_id, playheads):
+        """Aggiorna le posizioni dei viewer: i segmenti superati da tutti vengono scartati, gli altri riordinati"""
+        playheads = tuple(sorted(playheads))
+        with self._cond:
+            self._last_activity[stream_id] = time.monotonic()
+            if playheads and playheads != self._playheads.get(stream_id):
+                self._playheads[stream_id] = playheads
+                self._reprioritize = True
+                self._cond.notify_all()
+
+    def is_active(self, stream_id):
+        _, _, idle_timeout = self._get_limits()
+        with self._cond:
+            return time.monotonic() - self._last_activity.get(stream_id, 0) <= idle_timeout
+
+    def cancel_stream(self, stream_id):
+        with self._cond:
+            remaining = [item for item in self._heap if item[2] != stream_id]
+            self.cancelled += len(self._heap) - len(remaining)
+            self._heap = remaining
+            heapq.heapify(self._heap)
+            self._pending = {key for key in self._pending if key[0] != stream_id}
+            self._playheads.pop(stream_id, None)
+            self._last_activity.pop(stream_id, None)
+            self._segment_sizes.pop(stream_id, None)
+
+    def cancel_all(self):
+        with self._cond:
+            self.cancelled += len(self._heap)
+            self._heap.clear()
+            self._pending.clear()
+            self._playheads.clear()
+            self._last_activity.clear()
+            self._segment_sizes.clear()
+
+    def _next_locked(self, max_inflight_bytes, idle_timeout):
+        """Estrae il segmento più vicino a un playhead, se il budget di byte lo consente"""
+        if self._reprioritize:
+            self._heap = [
+                (self._distance_locked(stream_id, sequence), order, stream_id, sequence, cache_key, segment_url, headers)
+                for _, order, stream_id, sequence, cache_key, segment_url, headers in self._heap
+            ]
+            heapq.heapify(self._heap)
+            self._reprioritize = False
+
+        now = time.monotonic()
+        while self._heap:
+            distance, _, stream_id, sequence, cache_key, segment_url, headers = self._heap[0]
+            if distance <= 0 or now - self._last_activity.get(stream_id, 0) > idle_timeout:
+                # Già superato dal viewer o stream inattivo: non serve più
+                heapq.heappop(self._heap)
+                self._pending.discard((stream_id, cache_key))
+                self.cancelled += 1
+                continue
+            estimate = self._segment_sizes.get(stream_id, self.DEFAULT_SEGMENT_SIZE)
+            if self._inflight_bytes and self._inflight_bytes + estimate > max_inflight_bytes:
+                return None
+            heapq.heappop(self._heap)
+            self._inflight_bytes += estimate
+            return stream_id, cache_key, segment_url, headers, estimate
+        return None
+
+    def _download(self, stream_id, segment_url, headers):
+        proxy_config = get_proxy_for_url(segment_url)
+        proxy_key = proxy_config['http'] if proxy_config else None
+        
+        response = make_persistent_request(
+            segment_url,
+            headers=headers,
+            timeout=get_dynamic_timeout(segment_url),
+            proxy_url=proxy_key,
+            allow_redirects=True,
+            stream=True
+        )
+        try:
+            response.raise_for_status()
+            started = time.monotonic()
+            chunks = []
+            for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                if not self.is_active(stream_id):
+                    return None
+                chunks.append(chunk)
+            content = b''.join(chunks)
+            report_proxy_transfer(proxy_key, len(content), time.monotonic() - started)
+            return content
+        except requests.exceptions.ChunkedEncodingError:
+            report_proxy_failure(proxy_key)
+            raise
+        finally:
+            response.close()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    _, max_inflight_bytes, idle_timeout = self._get_limits()
+                    item = self._next_locked(max_inflight_bytes, idle_timeout)
+                    if item is not None:
+                        break
+                    self._cond.wait(timeout=1.0)
+            
+            stream_id, cache_key, segment_url, headers, reserved = item
+            content = None
+            try:
+                if self.manager.is_wanted(stream_id, cache_key) and self.manager.check_memory_usage():
+                    content = self._download(stream_id, segment_url, headers)
+                    if content is not None:
+                        self.manager.store_segment(stream_id, cache_key, content)
+            except Exception as e:
+                app.logger.error(f"Errore nel pre-buffering del segmento {segment_url}: {e}")
+                with self._cond:
+                    self.failed += 1
+            finally:
+                with self._cond:
+                    self._inflight_bytes -= reserved
+                    self._pending.discard((stream_id, cache_key))
+                    if content is not None:
+                        self.completed += 1
+                        previous = self._segment_sizes.get(stream_id)
+                        size = len(content)
+                        self._segment_sizes[stream_id] = size if previous is None else int(previous * 0.7 + size * 0.3)
+                    self._cond.notify_all()
+
+    def stats(self):
+        workers, max_inflight_bytes, idle_timeout = self._get_limits()
+        with self._cond:
+            return {
+                "workers": len(self._workers),
+                "max_workers": workers,
+                "queued": len(self._heap),
+                "inflight_bytes": self._inflight_bytes,
+                "max_inflight_bytes": max_inflight_bytes,
+                "streams": len(self._last_activity),
+                "idle_timeout": idle_timeout,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+                "deduplicated": self.deduplicated
+            }
+
 # --- Sistema di Pre-Buffering per Evitare Buffering ---
 class PreBufferManager:
+    MEMORY_SAMPLE_INTERVAL = 2  # Secondi tra due letture di psutil.virtual_memory()
+    
     def __init__(self):
-        self.pre_buffer = {}  # {stream_id: {segment_url: content}}
+        # I segmenti sono indicizzati per URL normalizzato (normalize_cache_key)
+        self.pre_buffer = {}  # {stream_id: {segment_key: content}}
+        self.segment_index = {}  # {segment_key: stream_id}, per servire i segmenti a qualunque viewer
         self.pre_buffer_lock = Lock()
-        self.pre_buffer_threads = {}  # {stream_id: thread}
+        # Byte nel buffer, aggiornati ad ogni inserimento/rimozione
+        self.stream_bytes = {}  # {stream_id: bytes}
+        self.total_bytes = 0
+        self.stream_state = {}  # {stream_id: {last_sequence, sequences, fetched, viewers, last_poll}}
+        self.scheduler = PrefetchScheduler(self)
+        self.buffer_hits = 0
+        self.buffer_misses = 0
         self.last_cleanup_time = time.time()
+        self.memory_percent = 0.0
+        self.memory_total = 0
+        self.sample_memory()
         self.update_config()
     
     def update_config(self):
         """Aggiorna la configurazione dal config manager"""
         try:
-            config = config_manager.load_config()
+            config = config_manager.get_config()
             
             # Assicurati che tutti i valori numerici siano convertiti correttamente
             max_segments = config.get('PREBUFFER_MAX_SEGMENTS', 3)
@@ -380,21 +1768,55 @@ class PreBufferManager:
                 'emergency_cleanup_threshold': 90.0
             }
     
-    def check_memory_usage(self):
-        """Controlla l'uso di memoria e attiva cleanup se necessario"""
+    def sample_memory(self):
+        """Legge la memoria di sistema; chiamato a intervalli dal thread di campionamento"""
         try:
             memory = psutil.virtual_memory()
-            memory_percent = memory.percent
-            
-            # Calcola la dimensione totale del buffer
-            with self.pre_buffer_lock:
-                total_buffer_size = sum(
-                    sum(len(content) for content in segments.values())
-                    for segments in self.pre_buffer.values()
-                )
-                buffer_memory_percent = (total_buffer_size / memory.total) * 100
+            self.memory_percent = memory.percent
+            self.memory_total = memory.total
+        except Exception as e:
+            app.logger.error(f"Errore nella lettura della memoria di sistema: {e}")
+    
+    def sample_memory_loop(self):
+        while True:
+            time.sleep(self.MEMORY_SAMPLE_INTERVAL)
+            self.sample_memory()
+    
+    def _add_segment_locked(self, stream_id, segment_url, content):
+        segments = self.pre_buffer.setdefault(stream_id, {})
+        previous = segments.get(segment_url)
+        if previous is not None:
+            self._account_locked(stream_id, -len(previous))
+        segments[segment_url] = content
+        self.segment_index[segment_url] = stream_id
+        self._account_locked(stream_id, len(content))
+    
+    def _remove_segment_locked(self, stream_id, segment_url):
+        content = self.pre_buffer[stream_id].pop(segment_url)
+        self.segment_index.pop(segment_url, None)
+        self._account_locked(stream_id, -len(content))
+        return content
+    
+    def _remove_stream_locked(self, stream_id):
+        """Rimuove il buffer dello stream; restituisce i byte liberati"""
+        for segment_url in self.pre_buffer.pop(stream_id, {}):
+            self.segment_index.pop(segment_url, None)
+        freed = self.stream_bytes.pop(stream_id, 0)
+        self.total_bytes -= freed
+        return freed
+    
+    def _account_locked(self, stream_id, delta):
+        self.stream_bytes[stream_id] = self.stream_bytes.get(stream_id, 0) + delta
+        self.total_bytes += delta
+    
+    def check_memory_usage(self):
+        """Controlla l'uso di memoria e attiva cleanup se necessario (O(1): contatori e ultimo campione)"""
+        try:
+            memory_percent = self.memory_percent
+            memory_total = self.memory_total or 1
+            buffer_memory_percent = (self.total_bytes / memory_total) * 100
             
-            app.logger.info(f"Memoria sistema: {memory_percent:.1f}%, Buffer: {buffer_memory_percent:.1f}%")
+            app.logger.debug(f"Memoria sistema: {memory_percent:.1f}%, Buffer: {buffer_memory_percent:.1f}%")
             
             # Cleanup di emergenza se la RAM supera la soglia
             emergency_threshold = self.pre_buffer_config['emergency_cleanup_threshold']
@@ -420,12 +1842,13 @@ class PreBufferManager:
         """Pulizia di emergenza - rimuove tutti i buffer"""
         with self.pre_buffer_lock:
             streams_cleared = len(self.pre_buffer)
-            total_size = sum(
-                sum(len(content) for content in segments.values())
-                for segments in self.pre_buffer.values()
-            )
+            total_size = self.total_bytes
             self.pre_buffer.clear()
-            self.pre_buffer_threads.clear()
+            self.segment_index.clear()
+            self.stream_bytes.clear()
+            self.total_bytes = 0
+            self.stream_state.clear()
+        self.scheduler.cancel_all()
         
         app.logger.warning(f"Pulizia di emergenza completata: {streams_cleared} stream, {total_size / (1024*1024):.1f}MB liberati")
     
@@ -435,21 +1858,14 @@ class PreBufferManager:
             if len(self.pre_buffer) <= 1:
                 return
             
-            # Calcola la dimensione di ogni stream
-            stream_sizes = {}
-            for stream_id, segments in self.pre_buffer.items():
-                stream_size = sum(len(content) for content in segments.values())
-                stream_sizes[stream_id] = stream_size
-            
             # Rimuovi gli stream più grandi fino a liberare abbastanza memoria
             target_reduction = self.pre_buffer_config['max_buffer_size'] * 0.5  # Riduci del 50%
-            current_total = sum(stream_sizes.values())
             
-            if current_total <= target_reduction:
+            if self.total_bytes <= target_reduction:
                 return
             
             # Ordina per dimensione (più grandi prima)
-            sorted_streams = sorted(stream_sizes.items(), key=lambda x: x[1], reverse=True)
+            sorted_streams = sorted(self.stream_bytes.items(), key=lambda x: x[1], reverse=True)
             
             freed_memory = 0
             streams_to_remove = []
@@ -462,127 +1878,191 @@ class PreBufferManager:
             
             # Rimuovi gli stream selezionati
             for stream_id in streams_to_remove:
-                if stream_id in self.pre_buffer:
-                    del self.pre_buffer[stream_id]
-                if stream_id in self.pre_buffer_threads:
-                    del self.pre_buffer_threads[stream_id]
+                self._remove_stream_locked(stream_id)
+                self.stream_state.pop(stream_id, None)
             
             app.logger.info(f"Pulizia automatica: {len(streams_to_remove)} stream rimossi, {freed_memory / (1024*1024):.1f}MB liberati")
+        
+        for stream_id in streams_to_remove:
+            self.scheduler.cancel_stream(stream_id)
     
     def get_stream_id_from_url(self, url):
         """Estrae un ID stream univoco dall'URL"""
         # Usa l'hash dell'URL come stream ID
         return hashlib.md5(url.encode()).hexdigest()[:12]
     
+    def parse_segments(self, m3u8_content, base_url):
+        """Restituisce ([(sequence, segment_url)], endlist) numerando i segmenti da #EXT-X-MEDIA-SEQUENCE"""
+        media_sequence = 0
+        endlist = False
+        segments = []
+        for line in m3u8_content.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+                try:
+                    media_sequence = int(line.split(':', 1)[1])
+                except ValueError:
+                    pass
+            elif line == '#EXT-X-ENDLIST':
+                endlist = True
+            elif not line.startswith('#'):
+                segments.append(urljoin(base_url, line))
+        return [(media_sequence + index, url) for index, url in enumerate(segments)], endlist
+    
     def pre_buffer_segments(self, m3u8_content, base_url, headers, stream_id):
-        """Pre-scarica i segmenti successivi in background"""
+        """
+        Accoda per il pre-buffering i segmenti apparsi dall'ultima lettura della
+        playlist. Alla prima lettura di una live prende gli ultimi N segmenti
+        (quelli vicini al live edge che il player chiederà), poi solo quelli con
+        media sequence nuova; i segmenti già accodati non vengono mai riscaricati.
+        Il download avviene nel pool dello scheduler globale.
+        """
         # Controlla se il pre-buffering è abilitato
         if not self.pre_buffer_config.get('enabled', True):
             app.logger.info(f"Pre-buffering disabilitato per stream {stream_id}")
             return
         
-        # Controlla l'uso di memoria prima di iniziare
-        if not self.check_memory_usage():
-            app.logger.warning(f"Memoria insufficiente, pre-buffering saltato per stream {stream_id}")
-            return
-        
         try:
-            # Trova i segmenti nel M3U8
-            segment_urls = []
-            for line in m3u8_content.splitlines():
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    segment_url = urljoin(base_url, line)
-                    segment_urls.append(segment_url)
-            
-            if not segment_urls:
+            segments, endlist = self.parse_segments(m3u8_content, base_url)
+            if not segments:
                 return
+            # Buffer e stato usano la chiave normalizzata, il download l'URL originale
+            segments = [(seq, normalize_cache_key(url), url) for seq, url in segments]
             
-            # Pre-scarica i primi N segmenti
             max_segments = self.pre_buffer_config['max_segments']
-            app.logger.info(f"Pre-buffering per stream {stream_id}: {len(segment_urls)} segmenti disponibili, max_segments={max_segments}")
-            segments_to_buffer = segment_urls[:max_segments]
             
-            def buffer_worker():
-                try:
-                    current_buffer_size = 0
-                    
-                    for segment_url in segments_to_buffer:
-                        # Controlla memoria prima di ogni segmento
-                        if not self.check_memory_usage():
-                            app.logger.warning(f"Memoria insufficiente durante pre-buffering, interrotto per stream {stream_id}")
-                            break
-                        
-                        # Controlla se il segmento è già nel buffer
-                        with self.pre_buffer_lock:
-                            if stream_id in self.pre_buffer and segment_url in self.pre_buffer[stream_id]:
-                                continue
-                        
-                        try:
-                            # Scarica il segmento
-                            proxy_config = get_proxy_for_url(segment_url)
-                            proxy_key = proxy_config['http'] if proxy_config else None
-                            
-                            response = make_persistent_request(
-                                segment_url,
-                                headers=headers,
-                                timeout=get_dynamic_timeout(segment_url),
-                                proxy_url=proxy_key,
-                                allow_redirects=True
-                            )
-                            response.raise_for_status()
-                            
-                            segment_content = response.content
-                            segment_size = len(segment_content)
-                            
-                            # Controlla se il buffer non supera il limite
-                            if current_buffer_size + segment_size > self.pre_buffer_config['max_buffer_size']:
-                                app.logger.warning(f"Buffer pieno per stream {stream_id}, salto segmento {segment_url}")
-                                break
-                            
-                            # Aggiungi al buffer
-                            with self.pre_buffer_lock:
-                                if stream_id not in self.pre_buffer:
-                                    self.pre_buffer[stream_id] = {}
-                                self.pre_buffer[stream_id][segment_url] = segment_content
-                                current_buffer_size += segment_size
-                            
-                            app.logger.info(f"Segmento pre-buffato: {segment_url} ({segment_size} bytes) per stream {stream_id}")
-                            
-                        except Exception as e:
-                            app.logger.error(f"Errore nel pre-buffering del segmento {segment_url}: {e}")
-                            continue
-                    
-                    app.logger.info(f"Pre-buffering completato per stream {stream_id}: {len(segments_to_buffer)} segmenti")
-                    
-                except Exception as e:
-                    app.logger.error(f"Errore nel worker di pre-buffering per stream {stream_id}: {e}")
-                finally:
-                    # Rimuovi il thread dalla lista
-                    with self.pre_buffer_lock:
-                        if stream_id in self.pre_buffer_threads:
-                            del self.pre_buffer_threads[stream_id]
+            with self.pre_buffer_lock:
+                state = self.stream_state.get(stream_id)
+                first_sequence = segments[0][0]
+                last_sequence = segments[-1][0]
+                if state is None or last_sequence < state['last_sequence'] - len(segments):
+                    # Primo poll (o sequenza ripartita): VOD dall'inizio, live dal live edge
+                    state = {'last_sequence': first_sequence - 1, 'fetched': set(), 'viewers': {}}
+                    self.stream_state[stream_id] = state
+                    new_segments = segments[:max_segments] if endlist else segments[-max_segments:]
+                else:
+                    # Finestra scorrevole: solo i prossimi N segmenti nuovi
+                    new_segments = [segment for segment in segments if segment[0] > state['last_sequence']][-max_segments:]
+                
+                state['last_poll'] = time.time()
+                state['last_sequence'] = max(state['last_sequence'], last_sequence)
+                state['sequences'] = {key: seq for seq, key, _ in segments}
+                
+                # Scarta ciò che è uscito dalla playlist
+                state['fetched'] &= state['sequences'].keys()
+                buffered = self.pre_buffer.get(stream_id)
+                if buffered:
+                    for segment_key in [key for key in buffered if key not in state['sequences']]:
+                        self._remove_segment_locked(stream_id, segment_key)
+                
+                new_segments = [segment for segment in new_segments if segment[1] not in state['fetched']]
+                state['fetched'].update(key for _, key, _ in new_segments)
             
-            # Avvia il thread di pre-buffering
-            buffer_thread = Thread(target=buffer_worker, daemon=True)
-            buffer_thread.start()
+            self.scheduler.touch(stream_id)
+            for sequence, segment_key, segment_url in new_segments:
+                self.scheduler.submit(stream_id, sequence, segment_key, segment_url, headers)
             
-            with self.pre_buffer_lock:
-                self.pre_buffer_threads[stream_id] = buffer_thread
+            if new_segments:
+                app.logger.info(f"Pre-buffering per stream {stream_id}: {len(new_segments)} nuovi segmenti, max_segments={max_segments}")
             
         except Exception as e:
             app.logger.error(f"Errore nell'avvio del pre-buffering per stream {stream_id}: {e}")
     
-    def get_buffered_segment(self, segment_url, stream_id):
-        """Recupera un segmento dal buffer se disponibile"""
+    def is_wanted(self, stream_id, segment_url):
+        """True se il segmento è ancora nella finestra della playlist e non è già nel buffer"""
         with self.pre_buffer_lock:
-            if stream_id in self.pre_buffer and segment_url in self.pre_buffer[stream_id]:
-                content = self.pre_buffer[stream_id][segment_url]
-                # Rimuovi dal buffer dopo l'uso
-                del self.pre_buffer[stream_id][segment_url]
-                app.logger.info(f"Segmento servito dal buffer: {segment_url} per stream {stream_id}")
-                return content
-        return None
+            state = self.stream_state.get(stream_id)
+            if state is None or segment_url not in state['fetched']:
+                return False
+            return segment_url not in self.pre_buffer.get(stream_id, {})
+    
+    def store_segment(self, stream_id, segment_url, segment_content):
+        """Salva nel buffer un segmento scaricato dallo scheduler"""
+        segment_size = len(segment_content)
+        with self.pre_buffer_lock:
+            state = self.stream_state.get(stream_id)
+            if state is None or segment_url not in state['fetched']:
+                # Stream rimosso o segmento uscito dalla finestra durante il download
+                return False
+            # Controlla se il buffer non supera il limite
+            if self.stream_bytes.get(stream_id, 0) + segment_size > self.pre_buffer_config['max_buffer_size']:
+                app.logger.warning(f"Buffer pieno per stream {stream_id}, salto segmento {segment_url}")
+                return False
+            self._add_segment_locked(stream_id, segment_url, segment_content)
+            self._trim_segments_locked(stream_id, state)
+            if segment_url not in self.pre_buffer[stream_id]:
+                # Il segmento appena scaricato era il più lontano dal playhead
+                return False
+        
+        app.logger.info(f"Segmento pre-buffato: {segment_url} ({segment_size} bytes) per stream {stream_id}")
+        return True
+    
+    def _trim_segments_locked(self, stream_id, state):
+        """
+        Riporta lo stream entro max_segments in base alla distanza dal playhead
+        più arretrato (o, senza viewer, dal segmento più vecchio in buffer):
+        escono prima i segmenti già superati, poi quelli più lontani davanti.
+        Va chiamata con pre_buffer_lock acquisito.
+        """
+        segments = self.pre_buffer[stream_id]
+        excess = len(segments) - self.pre_buffer_config['max_segments']
+        if excess <= 0:
+            return
+        sequences = state['sequences']
+        playheads = [playhead for playhead, _ in state['viewers'].values()]
+        playhead = min(playheads) if playheads else min(sequences.get(url, 0) for url in segments)
+
+        def eviction_order(url):
+            sequence = sequences.get(url)
+            if sequence is None or sequence < playhead:
+                return (0, sequence or 0)
+            return (1, playhead - sequence)
+
+        for url in sorted(segments, key=eviction_order)[:excess]:
+            self._remove_segment_locked(stream_id, url)
+
+    def report_playhead(self, stream_id, segment_url, viewer_id):
+        """
+        Registra il segmento chiesto dal viewer. I segmenti superati da tutti
+        i viewer attivi dello stream escono dal buffer; le posizioni vengono
+        passate allo scheduler per la priorità dei download.
+        """
+        idle_timeout = config_manager.get_config().get('PREFETCH_IDLE_TIMEOUT', 30)
+        with self.pre_buffer_lock:
+            stream_id = stream_id or self.segment_index.get(segment_url)
+            state = self.stream_state.get(stream_id)
+            sequence = state['sequences'].get(segment_url) if state else None
+            if sequence is None:
+                return
+            
+            now = time.time()
+            viewers = state['viewers']
+            viewers[viewer_id] = (sequence, now)
+            for inactive_viewer in [vid for vid, (_, last_seen) in viewers.items() if now - last_seen > idle_timeout]:
+                del viewers[inactive_viewer]
+            playheads = [playhead for playhead, _ in viewers.values()]
+            
+            min_playhead = min(playheads)
+            buffered = self.pre_buffer.get(stream_id)
+            if buffered:
+                for buffered_url in [url for url in buffered if state['sequences'].get(url, min_playhead) < min_playhead]:
+                    self._remove_segment_locked(stream_id, buffered_url)
+        
+        self.scheduler.update_playheads(stream_id, playheads)
+    
+    def get_buffered_segment(self, segment_url):
+        """Recupera un segmento dal buffer condiviso; resta disponibile per gli altri viewer"""
+        with self.pre_buffer_lock:
+            stream_id = self.segment_index.get(segment_url)
+            content = self.pre_buffer[stream_id].get(segment_url) if stream_id else None
+            if content is None:
+                self.buffer_misses += 1
+                return None
+            self.buffer_hits += 1
+        app.logger.info(f"Segmento servito dal buffer: {segment_url} per stream {stream_id}")
+        return content
     
     def cleanup_old_buffers(self):
         """Pulisce i buffer vecchi"""
@@ -597,15 +2077,20 @@ class PreBufferManager:
                     current_time = time.time()
                     streams_to_remove = []
                     
-                    for stream_id, segments in self.pre_buffer.items():
-                        # Rimuovi stream senza thread attivo e con buffer vecchio
-                        if stream_id not in self.pre_buffer_threads:
+                    for stream_id in set(self.pre_buffer) | set(self.stream_state):
+                        # Rimuovi stream la cui playlist non viene più letta
+                        state = self.stream_state.get(stream_id)
+                        if state is None or current_time - state['last_poll'] > self.pre_buffer_config['cleanup_interval']:
                             streams_to_remove.append(stream_id)
                     
                     for stream_id in streams_to_remove:
-                        del self.pre_buffer[stream_id]
+                        self._remove_stream_locked(stream_id)
+                        self.stream_state.pop(stream_id, None)
                         app.logger.info(f"Buffer pulito per stream {stream_id}")
                 
+                for stream_id in streams_to_remove:
+                    self.scheduler.cancel_stream(stream_id)
+                
             except Exception as e:
                 app.logger.error(f"Errore nella pulizia del buffer: {e}")
 
@@ -744,6 +2229,10 @@ def download_m3u_playlist_streaming(url):
 cleanup_thread = Thread(target=pre_buffer_manager.cleanup_old_buffers, daemon=True)
 cleanup_thread.start()
 
+# Campiona la memoria di sistema a intervalli invece che ad ogni segmento
+memory_sampler_thread = Thread(target=pre_buffer_manager.sample_memory_loop, daemon=True)
+memory_sampler_thread.start()
+
 
 
 # --- Variabili globali per cache e sessioni ---
@@ -751,13 +2240,281 @@ cleanup_thread.start()
 # Inizializza cache globali (verranno sovrascritte da setup_all_caches)
 M3U8_CACHE = {}
 TS_CACHE = {}
+TS_DISK_CACHE = None  # Livello su disco opzionale sotto TS_CACHE
 KEY_CACHE = {}
 RESOLVED_LINKS_CACHE = {}  # Cache per i link risolti
 
-# Pool globale di sessioni per connessioni persistenti
-SESSION_POOL = {}
-SESSION_LOCK = Lock()
+# --- Deduplica dei download upstream in corso (single-flight) ---
+class InFlightFetch:
+    """
+    Download upstream in corso per una singola risorsa. Il leader vi aggiunge i
+    chunk man mano che li riceve, le richieste concorrenti per la stessa
+    risorsa li leggono da qui invece di aprire un'altra connessione upstream.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.status_code = None
+        self.condition = Condition()
+
+    def append(self, chunk):
+        with self.condition:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.condition.notify_all()
+
+    def finish(self, error=None, status_code=None):
+        """Segna il download come terminato (con successo se error è None)"""
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.status_code = status_code
+            self.condition.notify_all()
+
+    def wait_for_data(self, timeout):
+        """Attende il primo chunk o la fine del download. False se scade il timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.chunks or self.done, timeout)
+
+    def wait_until_done(self, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.done, timeout)
+
+    def failed_without_data(self):
+        return self.done and self.error is not None and not self.chunks
+
+    def content(self):
+        with self.condition:
+            return b"".join(self.chunks)
+
+    def iter_chunks(self, timeout):
+        """Restituisce tutti i chunk dall'inizio, seguendo il download mentre è in corso"""
+        index = 0
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: index < len(self.chunks) or self.done, timeout):
+                    app.logger.warning(f"Timeout in attesa di dati dal download condiviso: {self.key}")
+                    return
+                pending = self.chunks[index:]
+                done = self.done
+            # I chunk vengono restituiti fuori dal lock per non bloccare il leader
+            for chunk in pending:
+                yield chunk
+            index += len(pending)
+            if done and not pending:
+                return
+
+class SingleFlightRegistry:
+    """Registro dei download in corso: una sola richiesta upstream per chiave"""
+    def __init__(self):
+        self._inflight = {}
+        self._lock = Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key):
+        """Restituisce (fetch, is_leader). Il leader deve chiamare release() al termine"""
+        with self._lock:
+            fetch = self._inflight.get(key)
+            if fetch is not None:
+                self.followers += 1
+                return fetch, False
+            fetch = InFlightFetch(key)
+            self._inflight[key] = fetch
+            self.leaders += 1
+            return fetch, True
+
+    def release(self, key, fetch):
+        with self._lock:
+            if self._inflight.get(key) is fetch:
+                del self._inflight[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._inflight),
+                "upstream_fetches": self.leaders,
+                "coalesced_requests": self.followers
+            }
+
+SEGMENT_FLIGHTS = SingleFlightRegistry()
+KEY_FLIGHTS = SingleFlightRegistry()
+
+# Pool fisso per i download dei segmenti dei leader: con molti segmenti distinti
+# in volo i download oltre il limite restano in coda invece di aprire un thread
+# ciascuno (i client agganciati attendono comunque al massimo ts_wait_timeout)
+SEGMENT_DOWNLOAD_WORKERS = 64
+SEGMENT_DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=SEGMENT_DOWNLOAD_WORKERS, thread_name_prefix="segment_download")
+
+def serve_disk_segment(disk_entry):
+    """Serve un segmento dal disco tramite wsgi.file_wrapper (sendfile), senza copiarlo nell'heap Python"""
+    segment_file, size = disk_entry
+    response = Response(wrap_file(request.environ, segment_file), content_type="video/mp2t", direct_passthrough=True)
+    response.content_length = size
+    return response
+
+def serve_inflight_fetch(fetch, content_type, timeout):
+    """Risposta per una richiesta agganciata a un download già in corso"""
+    if not fetch.wait_for_data(timeout):
+        return "Errore: Timeout in attesa del download condiviso", 504
+    if fetch.failed_without_data():
+        return f"Errore durante il download condiviso: {fetch.error}", fetch.status_code or 502
+    return Response(fetch.iter_chunks(timeout), content_type=content_type)
+
+SEGMENT_RESUME_ATTEMPTS = 2  # Riprese con Range dopo un'interruzione a metà segmento
+SEGMENT_RESUME_LOCK = Lock()
+SEGMENT_RESUME_STATS = {'resumes': 0, 'recovered': 0, 'failed': 0}
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-\d+/(\d+|\*)')
+
+class SegmentTruncatedError(Exception):
+    """Il corpo del segmento è terminato prima della Content-Length dichiarata"""
+    pass
+
+def get_expected_length(response_headers):
+    """Lunghezza attesa del corpo dalla Content-Length; None se assente o se il corpo è compresso"""
+    if response_headers.get('Content-Encoding', 'identity').lower() != 'identity':
+        return None
+    try:
+        return int(response_headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+
+def get_resume_skip(status_code, response_headers, offset, expected_length=None):
+    """
+    Byte da scartare all'inizio di una risposta di ripresa richiesta da offset:
+    0 per un 206 che riparte esattamente da offset, offset per un 200 (upstream
+    che ignora Range). None se la risposta non è utilizzabile, anche quando la
+    sua lunghezza totale differisce da expected_length: è un altro oggetto e
+    i due corpi non vanno uniti.
+    """
+    if status_code == 206:
+        match = CONTENT_RANGE_RE.match(response_headers.get('Content-Range', ''))
+        if not match or int(match.group(1)) != offset:
+            return None
+        if expected_length is not None and match.group(2) != '*' and int(match.group(2)) != expected_length:
+            return None
+        return 0
+    if status_code == 200:
+        length = get_expected_length(response_headers)
+        if expected_length is not None and length is not None and length != expected_length:
+            return None
+        return offset
+    return None
+
+def get_resumed_length(status_code, response_headers, offset):
+    """Lunghezza totale del segmento dedotta da una risposta di ripresa, se nota"""
+    if status_code == 206:
+        match = CONTENT_RANGE_RE.match(response_headers.get('Content-Range', ''))
+        if match and match.group(2) != '*':
+            return int(match.group(2))
+        remaining = get_expected_length(response_headers)
+        return offset + remaining if remaining is not None else None
+    return get_expected_length(response_headers)
+
+def open_segment_resume(ts_url, headers, offset, timeout, tried_proxies, expected_length=None):
+    """
+    Richiede il segmento da offset (Range: bytes=offset-) tramite un proxy non
+    ancora tentato, o una nuova richiesta diretta. Restituisce
+    (response, proxy_url, skip) oppure None se la ripresa non è possibile.
+    """
+    proxy_config = get_proxy_with_fallback(ts_url, tried_proxies)
+    proxy_url = proxy_config['http'] if proxy_config else None
+    resume_headers = dict(headers or {})
+    resume_headers['Range'] = f'bytes={offset}-'
+    try:
+        response = make_persistent_request(ts_url, headers=resume_headers, timeout=timeout, proxy_url=proxy_url, stream=True, allow_redirects=True)
+    except requests.RequestException as e:
+        app.logger.warning(f"Ripresa del segmento TS fallita: {ts_url} ({e})")
+        return None
+    skip = get_resume_skip(response.status_code, response.headers, offset, expected_length)
+    if skip is None:
+        app.logger.warning(f"Risposta di ripresa non valida (HTTP {response.status_code}, {response.headers.get('Content-Range')}) per: {ts_url}")
+        response.close()
+        report_proxy_failure(proxy_url)
+        return None
+    return response, proxy_url, skip
 
+def download_segment_to_fetch(fetch, response, cache_key, ts_url, cache_enabled, proxy_url=None, headers=None, timeout=REQUEST_TIMEOUT):
+    """
+    Scarica il corpo del segmento nel buffer condiviso alla velocità dell'upstream,
+    indipendentemente da quanto velocemente leggono i client. La connessione
+    upstream viene rilasciata appena il segmento è completo e la cache viene
+    riempita senza attendere il viewer più lento.
+
+    Se la lettura si blocca o la connessione cade a metà corpo, il download
+    riprende dal byte già ricevuto con una richiesta Range tramite un altro
+    proxy: i client continuano a leggere lo stesso flusso senza interruzioni.
+    In cache finiscono solo i segmenti della lunghezza dichiarata.
+    """
+    completed = False
+    error = None
+    expected_length = get_expected_length(response.headers)
+    tried_proxies = {proxy_url}
+    skip = 0
+    resumes = 0
+    try:
+        while True:
+            started = time.monotonic()
+            received = fetch.size
+            try:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if skip:
+                        # Upstream senza supporto Range: scarta la parte già inoltrata ai client
+                        dropped = min(skip, len(chunk))
+                        chunk = chunk[dropped:]
+                        skip -= dropped
+                    if chunk:
+                        fetch.append(chunk)
+                if expected_length is not None and fetch.size < expected_length:
+                    raise SegmentTruncatedError(f"ricevuti {fetch.size} byte su {expected_length}")
+                completed = expected_length is None or fetch.size == expected_length
+                if not completed:
+                    error = f"lunghezza inattesa: {fetch.size} byte invece di {expected_length}"
+                    app.logger.warning(f"Segmento TS di lunghezza inattesa, non cachato: {ts_url} ({error})")
+                report_proxy_transfer(proxy_url, fetch.size - received, time.monotonic() - started)
+                break
+            except (requests.RequestException, SegmentTruncatedError) as e:
+                response.close()
+                if expected_length is not None and fetch.size == expected_length:
+                    # Tutti i byte dichiarati sono arrivati: l'errore è solo in chiusura (EOF, terminatore chunked)
+                    completed = True
+                    report_proxy_transfer(proxy_url, fetch.size - received, time.monotonic() - started)
+                    break
+                error = str(e)
+                report_proxy_failure(proxy_url)
+                if resumes >= SEGMENT_RESUME_ATTEMPTS:
+                    app.logger.warning(f"Download del segmento TS interrotto: {ts_url} ({e})")
+                    break
+                resumes += 1
+                app.logger.warning(f"Download del segmento TS interrotto a {fetch.size} byte, ripresa {resumes}/{SEGMENT_RESUME_ATTEMPTS}: {ts_url} ({e})")
+                resumed = open_segment_resume(ts_url, headers, fetch.size, timeout, tried_proxies, expected_length)
+                if resumed is None:
+                    break
+                response, proxy_url, skip = resumed
+                tried_proxies.add(proxy_url)
+                if expected_length is None:
+                    expected_length = get_resumed_length(response.status_code, response.headers, fetch.size)
+                with SEGMENT_RESUME_LOCK:
+                    SEGMENT_RESUME_STATS['resumes'] += 1
+    finally:
+        try:
+            response.close()
+            ts_content = fetch.content() if completed else None
+            if cache_enabled and ts_content and len(ts_content) > 1024:
+                TS_CACHE[cache_key] = ts_content
+                app.logger.info(f"Segmento TS cachato ({len(ts_content)} bytes) per: {ts_url}")
+            if resumes:
+                with SEGMENT_RESUME_LOCK:
+                    SEGMENT_RESUME_STATS['recovered' if completed else 'failed'] += 1
+        except Exception as e:
+            # Un errore della cache (es. OSError del livello condiviso o su disco) non deve lasciare il download appeso
+            app.logger.error(f"Errore nel salvataggio in cache del segmento TS {ts_url}: {e}")
+        finally:
+            fetch.finish(error=None if completed else (error or "download interrotto"))
+            SEGMENT_FLIGHTS.release(cache_key, fetch)
 
 
 # --- Configurazione Proxy ---
@@ -766,134 +2523,442 @@ PROXY_LIST = []
 def setup_proxies():
     """Carica la lista di proxy dalla variabile PROXY unificata."""
     global PROXY_LIST
-    proxies_found = []
 
-    # Carica configurazione
-    config = config_manager.load_config()
-    proxy_value = config.get('PROXY', '')
-
-    if proxy_value and proxy_value.strip():
-        # Separa i proxy se ce ne sono più di uno
-        proxy_list = [p.strip() for p in proxy_value.split(',') if p.strip()]
-        
-        for proxy in proxy_list:
-            # Gestione automatica del tipo di proxy
-            if proxy.startswith('socks5://'):
-                # Converti SOCKS5 in SOCKS5H per risoluzione DNS remota
-                final_proxy_url = 'socks5h' + proxy[len('socks5'):]
-                app.logger.info(f"Proxy SOCKS5 convertito: {proxy} -> {final_proxy_url}")
-            elif proxy.startswith('socks5h://'):
-                final_proxy_url = proxy
-                app.logger.info(f"Proxy SOCKS5H configurato: {proxy}")
-            elif proxy.startswith('http://') or proxy.startswith('https://'):
-                final_proxy_url = proxy
-                app.logger.info(f"Proxy HTTP/HTTPS configurato: {proxy}")
-            else:
-                # Se non ha protocollo, assume HTTP
-                if not proxy.startswith('http://') and not proxy.startswith('https://'):
-                    final_proxy_url = f"http://{proxy}"
-                    app.logger.info(f"Proxy senza protocollo, convertito in HTTP: {proxy} -> {final_proxy_url}")
-                else:
-                    final_proxy_url = proxy
-                    app.logger.info(f"Proxy configurato: {proxy}")
-            
-            proxies_found.append(final_proxy_url)
-        
-        app.logger.info(f"Trovati {len(proxies_found)} proxy generali. Verranno usati a rotazione per ogni richiesta.")
-
-    PROXY_LIST = proxies_found
+    # La lista è già normalizzata nella snapshot di configurazione
+    PROXY_LIST = list(config_manager.get_config().proxy_list)
 
     if PROXY_LIST:
-        app.logger.info(f"Totale di {len(PROXY_LIST)} proxy generali configurati.")
+        app.logger.info(f"Totale di {len(PROXY_LIST)} proxy generali configurati. Verranno usati a rotazione per ogni richiesta.")
     else:
         app.logger.info("Nessun proxy generale configurato.")
 
 def get_daddy_proxy_list():
-    """Carica la lista di proxy specifici per DaddyLive."""
-    config = config_manager.load_config()
-    daddy_proxy_value = config.get('DADDY_PROXY', '')
-    daddy_proxies = []
-
-    if daddy_proxy_value and daddy_proxy_value.strip():
-        # Separa i proxy se ce ne sono più di uno
-        proxy_list = [p.strip() for p in daddy_proxy_value.split(',') if p.strip()]
-        
-        for proxy in proxy_list:
-            # Gestione automatica del tipo di proxy
-            if proxy.startswith('socks5://'):
-                # Converti SOCKS5 in SOCKS5H per risoluzione DNS remota
-                final_proxy_url = 'socks5h' + proxy[len('socks5'):]
-                app.logger.info(f"Proxy DaddyLive SOCKS5 convertito: {proxy} -> {final_proxy_url}")
-            elif proxy.startswith('socks5h://'):
-                final_proxy_url = proxy
-                app.logger.info(f"Proxy DaddyLive SOCKS5H configurato: {proxy}")
-            elif proxy.startswith('http://') or proxy.startswith('https://'):
-                final_proxy_url = proxy
-                app.logger.info(f"Proxy DaddyLive HTTP/HTTPS configurato: {proxy}")
-            else:
-                # Se non ha protocollo, assume HTTP
-                if not proxy.startswith('http://') and not proxy.startswith('https://'):
-                    final_proxy_url = f"http://{proxy}"
-                    app.logger.info(f"Proxy DaddyLive senza protocollo, convertito in HTTP: {proxy} -> {final_proxy_url}")
-                else:
-                    final_proxy_url = proxy
-                    app.logger.info(f"Proxy DaddyLive configurato: {proxy}")
-            
-            daddy_proxies.append(final_proxy_url)
-        
-        app.logger.info(f"Trovati {len(daddy_proxies)} proxy DaddyLive. Verranno usati a rotazione per contenuti DaddyLive.")
-    
-    return daddy_proxies
+    """Restituisce la lista di proxy specifici per DaddyLive."""
+    return list(config_manager.get_config().daddy_proxy_list)
+
+# --- Routing upstream precompilato ---
+# Pattern DaddyLive compilati una sola volta (prima venivano ricompilati ad ogni chiamata)
+DADDYLIVE_PREMIUM_RE = re.compile(r'/premium(\d+)/mono\.m3u8$')
+DADDYLIVE_PLAYER_RE = re.compile(r'/(?:watch|stream|cast|player)/stream-(\d+)\.php')
+
+def is_daddylive_url(url):
+    """Verifica se l'URL appartiene a DaddyLive (newkso.ru, /stream-, /premiumN/mono.m3u8)"""
+    lowered = url.lower()
+    if 'newkso.ru' in lowered or '/stream-' in lowered:
+        return True
+    # Il controllo endswith evita di eseguire la regex sulla quasi totalità degli URL
+    return url.endswith('/mono.m3u8') and DADDYLIVE_PREMIUM_RE.search(url) is not None
+
+def extract_url_host(url):
+    """Estrae l'host (in minuscolo, senza porta né credenziali) da un URL senza passare da urlparse"""
+    authority = url.partition('://')[2].split('/', 1)[0].split('?', 1)[0].split('#', 1)[0]
+    host = authority.rpartition('@')[2]
+    if host.startswith('['):
+        return host[1:host.find(']')].lower()
+    return host.partition(':')[0].lower()
+
+class DomainSuffixTrie:
+    """Trie sulle etichette del dominio (invertite) per match per suffisso di host"""
+    _TERMINAL = object()
+
+    def __init__(self, domains=()):
+        self.root = {}
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        domain = domain.strip().lower()
+        # Le voci host:porta valgono per l'host: il match avviene su host senza porta
+        if domain.startswith('['):
+            domain = domain[1:domain.find(']')]
+        elif domain.count(':') == 1:
+            domain = domain.partition(':')[0]
+        domain = domain.strip('.')
+        if not domain:
+            return
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        node[self._TERMINAL] = True
+
+    def matches(self, host):
+        """True se host coincide con un dominio registrato o ne è un sottodominio"""
+        node = self.root
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                return False
+            if self._TERMINAL in node:
+                return True
+        return False
 
-def get_proxy_for_url(url):
-    config = config_manager.load_config()
-    no_proxy_domains = [d.strip() for d in config.get('NO_PROXY_DOMAINS', '').split(',') if d.strip()]
-    
-    # Controlla se è un URL DaddyLive
-    is_daddylive = (
-        'newkso.ru' in url.lower() or 
-        '/stream-' in url.lower() or
-        re.search(r'/premium(\d+)/mono\.m3u8$', url) is not None
-    )
-    
-    # Se è DaddyLive, usa i proxy specifici
-    if is_daddylive:
-        daddy_proxies = get_daddy_proxy_list()
-        if daddy_proxies:
-            chosen_proxy = random.choice(daddy_proxies)
-            return {'http': chosen_proxy, 'https': chosen_proxy}
-    
-    # Altrimenti usa i proxy generali
-    if not PROXY_LIST:
-        return None
-    
-    try:
-        parsed_url = urlparse(url)
-        if any(domain in parsed_url.netloc for domain in no_proxy_domains):
+def mask_proxy_url(proxy_url):
+    """URL del proxy senza credenziali, per statistiche e log"""
+    scheme, sep, rest = proxy_url.partition('://')
+    return f"{scheme}{sep}{rest.rpartition('@')[2]}" if sep else proxy_url.rpartition('@')[2]
+
+class ProxySelector:
+    """
+    Sceglie il proxy in base alle misure delle richieste reali: per ogni proxy
+    tiene una EWMA di successo, time-to-first-byte e throughput. Tra due
+    candidati casuali vince quello col tempo atteso più basso (power of two
+    choices). I proxy che falliscono restano fuori rotazione per un cooldown,
+    poi una singola richiesta di prova decide se rientrano.
+    """
+    ALPHA = 0.2
+    EJECT_AFTER_FAILURES = 3
+    MIN_SUCCESS_RATE = 0.5
+    MIN_REQUESTS_FOR_RATE = 5
+    BASE_COOLDOWN = 15  # Secondi, raddoppiano ad ogni prova fallita
+    MAX_COOLDOWN = 300
+    PROBE_TIMEOUT = 30  # Una prova senza esito dopo questo tempo viene ripetuta
+    REFERENCE_BYTES = 1024 * 1024  # Dimensione tipica di un segmento per stimare il tempo di download
+    MIN_TRANSFER_BYTES = 64 * 1024  # Trasferimenti più piccoli non misurano il throughput
+
+    def __init__(self):
+        self._health = {}  # {proxy_url: stato}
+        self._lock = Lock()
+        self.ejections = 0
+        self.probes = 0
+
+    def _get_health_locked(self, proxy_url):
+        health = self._health.get(proxy_url)
+        if health is None:
+            health = {
+                'success': 1.0, 'ttfb': None, 'throughput': None, 'requests': 0, 'errors': 0,
+                'consecutive_failures': 0, 'ejected_until': None, 'probe_started': None,
+                'cooldown': self.BASE_COOLDOWN
+            }
+            self._health[proxy_url] = health
+        return health
+
+    def _ewma(self, previous, value):
+        return value if previous is None else previous + self.ALPHA * (value - previous)
+
+    def _cost_locked(self, proxy_url):
+        """Tempo atteso per un segmento, penalizzato dal tasso di errore (0 per i proxy mai misurati)"""
+        health = self._health[proxy_url]
+        transfer = self.REFERENCE_BYTES / health['throughput'] if health['throughput'] else 0.0
+        return ((health['ttfb'] or 0.0) + transfer) / max(health['success'], 0.05)
+
+    def choose(self, proxies, exclude=()):
+        """Sceglie tra proxies (URL) evitando quelli in exclude finché ne restano altri"""
+        candidates = [proxy for proxy in proxies if proxy not in exclude] or list(proxies)
+        if not candidates:
             return None
-    except Exception:
-        pass
-    
-    chosen_proxy = random.choice(PROXY_LIST)
-    return {'http': chosen_proxy, 'https': chosen_proxy}
+        now = time.monotonic()
+        with self._lock:
+            available = []
+            for proxy in candidates:
+                health = self._get_health_locked(proxy)
+                if health['ejected_until'] is None:
+                    available.append(proxy)
+                elif now >= health['ejected_until'] and (health['probe_started'] is None or now - health['probe_started'] > self.PROBE_TIMEOUT):
+                    # Cooldown scaduto: questa richiesta fa da prova
+                    health['probe_started'] = now
+                    self.probes += 1
+                    return proxy
+            if not available:
+                # Tutti fuori rotazione: meglio quello che rientra per primo che nessun proxy
+                return min(candidates, key=lambda proxy: self._health[proxy]['ejected_until'])
+            if len(available) == 1:
+                return available[0]
+            first, second = random.sample(available, 2)
+            return first if self._cost_locked(first) <= self._cost_locked(second) else second
+
+    def report_success(self, proxy_url, ttfb):
+        with self._lock:
+            health = self._get_health_locked(proxy_url)
+            health['requests'] += 1
+            health['success'] = self._ewma(health['success'], 1.0)
+            health['ttfb'] = self._ewma(health['ttfb'], ttfb)
+            health['consecutive_failures'] = 0
+            reinstated = health['ejected_until'] is not None
+            if reinstated:
+                health['ejected_until'] = None
+                health['probe_started'] = None
+                health['cooldown'] = self.BASE_COOLDOWN
+        if reinstated:
+            app.logger.info(f"Proxy di nuovo in rotazione: {mask_proxy_url(proxy_url)}")
+
+    def report_failure(self, proxy_url):
+        with self._lock:
+            health = self._get_health_locked(proxy_url)
+            health['requests'] += 1
+            health['errors'] += 1
+            health['success'] = self._ewma(health['success'], 0.0)
+            health['consecutive_failures'] += 1
+            probe_failed = health['probe_started'] is not None
+            if probe_failed:
+                health['cooldown'] = min(health['cooldown'] * 2, self.MAX_COOLDOWN)
+            elif health['ejected_until'] is not None:
+                return
+            elif health['consecutive_failures'] < self.EJECT_AFTER_FAILURES and not (
+                    health['requests'] >= self.MIN_REQUESTS_FOR_RATE and health['success'] < self.MIN_SUCCESS_RATE):
+                return
+            health['ejected_until'] = time.monotonic() + health['cooldown']
+            health['probe_started'] = None
+            self.ejections += 1
+            cooldown = health['cooldown']
+        app.logger.warning(f"Proxy escluso dalla rotazione per {cooldown}s: {mask_proxy_url(proxy_url)}")
+
+    def report_transfer(self, proxy_url, size, duration):
+        """Registra il throughput di un corpo scaricato per intero"""
+        if size < self.MIN_TRANSFER_BYTES or duration <= 0:
+            return
+        with self._lock:
+            health = self._get_health_locked(proxy_url)
+            health['throughput'] = self._ewma(health['throughput'], size / duration)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "ejections": self.ejections,
+                "probes": self.probes,
+                "proxies": {
+                    mask_proxy_url(proxy): {
+                        "success_rate": round(health['success'], 3),
+                        "ttfb_ms": round(health['ttfb'] * 1000, 1) if health['ttfb'] is not None else None,
+                        "throughput_kbps": round(health['throughput'] * 8 / 1000, 1) if health['throughput'] else None,
+                        "requests": health['requests'],
+                        "errors": health['errors'],
+                        "ejected_for": round(max(health['ejected_until'] - now, 0), 1) if health['ejected_until'] is not None else None
+                    }
+                    for proxy, health in self._health.items()
+                }
+            }
 
-def get_proxy_with_fallback(url, max_retries=3):
-    """Ottiene un proxy con fallback automatico in caso di errore"""
-    if not PROXY_LIST:
-        return None
-    
-    # Prova diversi proxy in caso di errore
-    for attempt in range(max_retries):
-        try:
-            proxy_config = get_proxy_for_url(url)
-            if proxy_config:
-                return proxy_config
-        except Exception:
-            continue
-    
-    return None
+PROXY_SELECTOR = ProxySelector()
+
+def report_proxy_transfer(proxy_url, size, duration):
+    if proxy_url:
+        PROXY_SELECTOR.report_transfer(proxy_url, size, duration)
+
+def report_proxy_failure(proxy_url):
+    if proxy_url:
+        PROXY_SELECTOR.report_failure(proxy_url)
+
+class UpstreamRouter:
+    """
+    Tabella di routing costruita dalla snapshot di configurazione: decide per
+    ogni URL se usare un proxy DaddyLive, un proxy generale o la connessione
+    diretta (NO_PROXY). Le decisioni per host sono memorizzate in una piccola LRU.
+    """
+    HOST_CACHE_SIZE = 1024
+
+    def __init__(self, config):
+        self.config = config
+        self.no_proxy_trie = DomainSuffixTrie(config.no_proxy_domains)
+        # Dizionari proxy precalcolati: nessuna allocazione sul percorso caldo
+        self.proxy_configs = {p: {'http': p, 'https': p} for p in config.proxy_list + config.daddy_proxy_list}
+        self.general_proxies = config.proxy_list
+        self.daddy_proxies = config.daddy_proxy_list
+        self.is_no_proxy_host = lru_cache(maxsize=self.HOST_CACHE_SIZE)(self.no_proxy_trie.matches)
+
+    def get_proxy(self, url, exclude=()):
+        """
+        Restituisce la configurazione proxy per l'URL, o None per la connessione
+        diretta. La scelta tra più proxy è delegata a PROXY_SELECTOR; exclude
+        contiene gli URL dei proxy già tentati.
+        """
+        # Se è DaddyLive, usa i proxy specifici
+        if self.daddy_proxies and is_daddylive_url(url):
+            return self.proxy_configs[PROXY_SELECTOR.choose(self.daddy_proxies, exclude)]
+
+        # Altrimenti usa i proxy generali
+        if not self.general_proxies:
+            return None
+
+        if self.is_no_proxy_host(extract_url_host(url)):
+            return None
+
+        return self.proxy_configs[PROXY_SELECTOR.choose(self.general_proxies, exclude)]
+
+    def stats(self):
+        info = self.is_no_proxy_host.cache_info()
+        return {
+            "general_proxies": len(self.general_proxies),
+            "daddy_proxies": len(self.daddy_proxies),
+            "no_proxy_domains": len(self.config.no_proxy_domains),
+            "host_cache": {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
+        }
+
+UPSTREAM_ROUTER = None
+
+def get_upstream_router():
+    """Restituisce il router corrente, ricostruendolo solo se la configurazione è cambiata"""
+    global UPSTREAM_ROUTER
+    config = config_manager.get_config()
+    router = UPSTREAM_ROUTER
+    if router is None or router.config is not config:
+        router = UpstreamRouter(config)
+        UPSTREAM_ROUTER = router
+    return router
+
+def get_proxy_for_url(url):
+    return get_upstream_router().get_proxy(url)
+
+class CacheKeyNormalizer:
+    """
+    Calcola la chiave di cache di un URL togliendo i parametri di query volatili
+    (token, scadenze, firme) indicati in CACHE_KEY_IGNORE_PARAMS, così lo stesso
+    segmento firmato in modi diversi occupa una sola voce di cache. L'ordine
+    dei parametri rimasti è preservato; le richieste upstream usano sempre l'URL originale.
+    """
+    KEY_CACHE_SIZE = 4096
+
+    def __init__(self, config):
+        self.config = config
+        self.rules = dict(config.cache_key_rules)
+        self.global_params = self.rules.pop('*', frozenset())
+        self.ignored_params_for_host = lru_cache(maxsize=UpstreamRouter.HOST_CACHE_SIZE)(self._ignored_params_for_host)
+        self.normalize = lru_cache(maxsize=self.KEY_CACHE_SIZE)(self._normalize)
+        self.enabled = bool(self.global_params or self.rules)
+
+    def _ignored_params_for_host(self, host):
+        """Parametri da ignorare per l'host: regola globale più quelle del dominio e dei domini padre"""
+        params = self.global_params
+        labels = host.split('.')
+        for index in range(len(labels)):
+            domain_params = self.rules.get('.'.join(labels[index:]))
+            if domain_params:
+                params = params | domain_params
+        return params
+
+    def _normalize(self, url):
+        base, _, query = url.partition('?')
+        query, hash_sign, fragment = query.partition('#')
+        ignored = self.ignored_params_for_host(extract_url_host(base))
+        if not ignored:
+            return url
+        kept = [param for param in query.split('&') if param and param.partition('=')[0].lower() not in ignored]
+        normalized = f"{base}?{'&'.join(kept)}" if kept else base
+        return f"{normalized}{hash_sign}{fragment}"
+
+    def get_key(self, url):
+        """Chiave di cache per l'URL (l'URL stesso se non ci sono regole o parametri)"""
+        if not self.enabled or '?' not in url:
+            return url
+        return self.normalize(url)
+
+    def stats(self):
+        info = self.normalize.cache_info()
+        return {
+            "enabled": self.enabled,
+            "global_params": sorted(self.global_params),
+            "host_rules": {domain: sorted(params) for domain, params in self.rules.items()},
+            "key_cache": {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
+        }
+
+CACHE_KEY_NORMALIZER = None
+
+def get_cache_key_normalizer():
+    """Restituisce il normalizzatore corrente, ricostruendolo solo se la configurazione è cambiata"""
+    global CACHE_KEY_NORMALIZER
+    config = config_manager.get_config()
+    normalizer = CACHE_KEY_NORMALIZER
+    if normalizer is None or normalizer.config is not config:
+        normalizer = CacheKeyNormalizer(config)
+        CACHE_KEY_NORMALIZER = normalizer
+    return normalizer
+
+def normalize_cache_key(url):
+    return get_cache_key_normalizer().get_key(url)
+
+def get_proxy_with_fallback(url, exclude=()):
+    """Ottiene un proxy diverso da quelli già tentati (exclude), se ne restano"""
+    return get_upstream_router().get_proxy(url, exclude)
+
+UPSTREAM_CONNECT_STATE = local()  # Tempo di connessione, attesa massima del pool e UpstreamAttempt della richiesta corrente, per thread
 
-def create_robust_session():
+class UpstreamAttempt:
+    """
+    Richiesta upstream annullabile prima dell'arrivo delle header: registra la
+    connessione urllib3 usata dal thread della richiesta, così cancel() può
+    chiuderne il socket e sbloccare subito il thread in attesa della risposta.
+    """
+    def __init__(self):
+        self.cancelled = False
+        self.connection = None
+        self._lock = Lock()
+
+    def attach(self, connection):
+        with self._lock:
+            self.connection = connection
+            cancelled = self.cancelled
+        if cancelled:
+            self._abort(connection)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            connection = self.connection
+        if connection is not None:
+            self._abort(connection)
+
+    @staticmethod
+    def _abort(connection):
+        sock = getattr(connection, 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def attach_upstream_connection(connection):
+    attempt = getattr(UPSTREAM_CONNECT_STATE, 'attempt', None)
+    if attempt is not None:
+        attempt.attach(connection)
+_TIMED_CONNECTION_CLASSES = {}
+
+def get_timed_connection_class(connection_cls):
+    """Sottoclasse della connessione urllib3 che misura connect() (TCP + handshake TLS/SOCKS)"""
+    timed_cls = _TIMED_CONNECTION_CLASSES.get(connection_cls)
+    if timed_cls is None:
+        class TimedConnection(connection_cls):
+            def connect(self):
+                start = time.monotonic()
+                super().connect()
+                UPSTREAM_CONNECT_STATE.connect_time = time.monotonic() - start
+                # Il socket esiste solo ora: se la richiesta è stata annullata durante il connect viene chiuso qui
+                attach_upstream_connection(self)
+        TimedConnection.__name__ = f"Timed{connection_cls.__name__}"
+        timed_cls = _TIMED_CONNECTION_CLASSES.setdefault(connection_cls, TimedConnection)
+    return timed_cls
+
+class MeteredHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter che misura il tempo di apertura delle nuove connessioni dei suoi
+    pool. Con pool_block=True l'attesa di una connessione libera è limitata da
+    UPSTREAM_CONNECT_STATE.pool_timeout (il connect timeout della richiesta):
+    requests non passa pool_timeout e urllib3 altrimenti attenderebbe per sempre.
+    """
+    def _instrument(self, pool):
+        if not getattr(pool, 'connect_timed', False):
+            pool.ConnectionCls = get_timed_connection_class(pool.ConnectionCls)
+            urlopen = pool.urlopen
+            def bounded_urlopen(*args, **kwargs):
+                kwargs.setdefault('pool_timeout', getattr(UPSTREAM_CONNECT_STATE, 'pool_timeout', None) or REQUEST_TIMEOUT)
+                return urlopen(*args, **kwargs)
+            pool.urlopen = bounded_urlopen
+            get_conn = pool._get_conn
+            def tracked_get_conn(*args, **kwargs):
+                connection = get_conn(*args, **kwargs)
+                attach_upstream_connection(connection)
+                return connection
+            pool._get_conn = tracked_get_conn
+            pool.connect_timed = True
+        return pool
+
+    def get_connection(self, url, proxies=None):
+        return self._instrument(super().get_connection(url, proxies))
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        # requests >= 2.32 usa questo metodo al posto di get_connection
+        return self._instrument(super().get_connection_with_tls_context(request, verify, proxies=proxies, cert=cert))
+
+def create_robust_session(pool_maxsize=POOL_MAXSIZE):
     """Crea una sessione con configurazione robusta e keep-alive per connessioni persistenti."""
     session = requests.Session()
     
@@ -904,129 +2969,626 @@ def create_robust_session():
     })
     
     # Configurazione retry automatico
+    # I read timeout non vengono ripetuti qui: con i timeout adattivi ritenta il chiamante, che può cambiare proxy
     retry_strategy = Retry(
         total=3,
+        read=0,
         backoff_factor=1,
         status_forcelist=[429, 500, 502, 503, 504],
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    # pool_block: pool_maxsize è un limite reale di connessioni per host, non solo di quelle keep-alive inattive
+    adapter = MeteredHTTPAdapter(max_retries=retry_strategy, pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize, pool_block=True)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     
     return session
 
+class LatencyHistogram:
+    """
+    Istogramma a bucket esponenziali (da 5 ms a circa 3 minuti) di una latenza.
+    Superata la finestra i conteggi vengono dimezzati, così i percentili
+    seguono l'andamento recente senza conservare i singoli campioni.
+    """
+    BOUNDS = tuple(0.005 * 1.25 ** i for i in range(48))
+    WINDOW = 500
 
-def get_persistent_session(proxy_url=None):
-    """Ottiene una sessione persistente dal pool o ne crea una nuova"""
-    global SESSION_POOL, SESSION_LOCK
-    
-    # Usa proxy_url come chiave, o 'default' se non c'è proxy
-    pool_key = proxy_url if proxy_url else 'default'
-    
-    with SESSION_LOCK:
-        if pool_key not in SESSION_POOL:
-            session = create_robust_session()
-            
-            if session is None:
-                app.logger.error(f"Impossibile creare sessione per: {pool_key}")
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+    def record(self, value):
+        self.counts[bisect_left(self.BOUNDS, value)] += 1
+        self.total += 1
+        if self.total > self.WINDOW:
+            self.counts = [count // 2 for count in self.counts]
+            self.total = sum(self.counts)
+
+    def percentile(self, q):
+        """Limite superiore del bucket che contiene il percentile q (0-1), None se vuoto"""
+        if not self.total:
+            return None
+        threshold = q * self.total
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return self.BOUNDS[min(index, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+class LatencyTracker:
+    """Istogrammi di latenza per chiave (es. host e tipo di risorsa), con LRU sul numero di chiavi"""
+    MAX_KEYS = 1024
+
+    def __init__(self):
+        self._histograms = OrderedDict()
+        self._lock = Lock()
+
+    def record(self, key, value):
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram()
+                if len(self._histograms) > self.MAX_KEYS:
+                    self._histograms.popitem(last=False)
+            else:
+                self._histograms.move_to_end(key)
+            histogram.record(value)
+
+    def percentile(self, key, q, min_samples=1):
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None or histogram.total < min_samples:
                 return None
+            return histogram.percentile(q)
+
+    def stats(self, limit=50):
+        with self._lock:
+            items = sorted(self._histograms.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+            return {
+                "|".join(key): {
+                    "samples": histogram.total,
+                    "p50_ms": round(histogram.percentile(0.5) * 1000, 1),
+                    "p95_ms": round(histogram.percentile(0.95) * 1000, 1)
+                }
+                for key, histogram in items
+            }
+
+def get_resource_type(url):
+    """Tipo di risorsa dall'estensione del path: ts, m3u8, key o other"""
+    path = url.split('?', 1)[0].split('#', 1)[0].lower()
+    if path.endswith('.ts') or path.endswith('.m4s') or path.endswith('.aac'):
+        return 'ts'
+    if path.endswith('.m3u8') or path.endswith('.m3u'):
+        return 'm3u8'
+    if path.endswith('.key'):
+        return 'key'
+    return 'other'
+
+UPSTREAM_TTFB = LatencyTracker()  # {(host, tipo di risorsa): time-to-first-byte}
+UPSTREAM_CONNECT_TIME = LatencyTracker()  # {(host,): tempo di apertura connessione}
+
+class UpstreamConnectionManager:
+    """
+    Sessioni persistenti per (proxy, schema, host). Una richiesta fallita non
+    distrugge la sessione: urllib3 scarta solo la connessione rotta e le altre
+    connessioni keep-alive (anche verso lo stesso proxy) restano riutilizzabili.
+    Ogni pool apre al massimo max_per_host connessioni: oltre, la richiesta
+    attende che se ne liberi una per non più del suo connect timeout e poi
+    fallisce con ConnectionError. I pool meno usati di recente vengono chiusi
+    oltre MAX_POOLS.
+    """
+    MAX_POOLS = 256
+
+    def __init__(self, max_per_host=POOL_MAXSIZE):
+        self.max_per_host = max_per_host
+        self._sessions = OrderedDict()  # {(proxy, scheme, host): session}
+        self._metrics = {}  # {(proxy, scheme, host): contatori}
+        self._lock = Lock()
+        self.evicted_pools = 0
+
+    @staticmethod
+    def _new_metrics():
+        return {
+            "requests": 0, "errors": 0, "pool_exhausted": 0, "new_connections": 0, "connect_time": 0.0,
+            "ttfb_new": 0.0, "ttfb_new_count": 0, "ttfb_reused": 0.0, "ttfb_reused_count": 0
+        }
+
+    def get_session(self, pool_key):
+        with self._lock:
+            session = self._sessions.get(pool_key)
+            if session is not None:
+                self._sessions.move_to_end(pool_key)
+                return session
             
-            # Configura proxy se fornito
+            proxy_url = pool_key[0]
+            session = create_robust_session(self.max_per_host)
             if proxy_url:
                 session.proxies.update({'http': proxy_url, 'https': proxy_url})
+            self._sessions[pool_key] = session
+            self._metrics.setdefault(pool_key, self._new_metrics())
             
-            SESSION_POOL[pool_key] = session
-            app.logger.info(f"Nuova sessione persistente creata per: {pool_key}")
+            while len(self._sessions) > self.MAX_POOLS:
+                old_key, old_session = self._sessions.popitem(last=False)
+                self._metrics.pop(old_key, None)
+                old_session.close()
+                self.evicted_pools += 1
         
-        return SESSION_POOL[pool_key]
+        app.logger.info(f"Nuova sessione persistente creata per: {self._describe(pool_key)}")
+        return session
 
-def make_persistent_request(url, headers=None, timeout=None, proxy_url=None, **kwargs):
-    """Effettua una richiesta usando connessioni persistenti"""
-    session = get_persistent_session(proxy_url)
-    
-    if session is None:
-        app.logger.error("Impossibile ottenere sessione persistente")
-        raise Exception("Impossibile ottenere sessione persistente")
-    
-    # Headers per keep-alive
-    request_headers = {
-        'Connection': 'keep-alive',
-        'Keep-Alive': f'timeout={KEEP_ALIVE_TIMEOUT}, max={MAX_KEEP_ALIVE_REQUESTS}'
-    }
-    
-    if headers:
-        request_headers.update(headers)
-    
-    try:
-        response = session.get(
-            url, 
-            headers=request_headers, 
-            timeout=timeout or REQUEST_TIMEOUT,
-            verify=VERIFY_SSL,
-            **kwargs
-        )
+    def request(self, url, headers=None, timeout=None, proxy_url=None, **kwargs):
+        pool_key = (proxy_url or '', url.partition('://')[0].lower(), extract_url_host(url))
+        session = self.get_session(pool_key)
+        
+        # Headers per keep-alive
+        request_headers = {
+            'Connection': 'keep-alive',
+            'Keep-Alive': f'timeout={KEEP_ALIVE_TIMEOUT}, max={MAX_KEEP_ALIVE_REQUESTS}'
+        }
+        if headers:
+            request_headers.update(headers)
+        
+        timeout = timeout or REQUEST_TIMEOUT
+        UPSTREAM_CONNECT_STATE.connect_time = None
+        UPSTREAM_CONNECT_STATE.pool_timeout = timeout[0] if isinstance(timeout, tuple) else timeout
+        try:
+            response = session.get(
+                url,
+                headers=request_headers,
+                timeout=timeout,
+                verify=VERIFY_SSL,
+                **kwargs
+            )
+        except EmptyPoolError as e:
+            # Tutte le max_per_host connessioni restano occupate: non è un guasto del proxy
+            app.logger.warning(f"Nessuna connessione libera entro {UPSTREAM_CONNECT_STATE.pool_timeout}s per: {self._describe(pool_key)}")
+            with self._lock:
+                metrics = self._metrics.get(pool_key)
+                if metrics is not None:
+                    metrics["pool_exhausted"] += 1
+            raise requests.exceptions.ConnectionError(e)
+        except Exception as e:
+            attempt = getattr(UPSTREAM_CONNECT_STATE, 'attempt', None)
+            if attempt is not None and attempt.cancelled:
+                # Richiesta perdente di un hedge chiusa di proposito: non è un guasto dell'upstream
+                raise
+            app.logger.error(f"Errore nella richiesta persistente: {e}")
+            connect_time = UPSTREAM_CONNECT_STATE.connect_time
+            self._record(pool_key, connect_time, None)
+            if connect_time is not None:
+                UPSTREAM_CONNECT_TIME.record((pool_key[2],), connect_time)
+            if isinstance(timeout, tuple) and "timed out" in str(e).lower():
+                # Il timeout scaduto entra nell'istogramma: i timeout adattivi non possono solo restringersi
+                UPSTREAM_TTFB.record((pool_key[2], get_resource_type(url)), timeout[1])
+            report_proxy_failure(proxy_url)
+            raise
+        ttfb = response.elapsed.total_seconds()
+        connect_time = UPSTREAM_CONNECT_STATE.connect_time
+        self._record(pool_key, connect_time, ttfb)
+        if connect_time is not None:
+            UPSTREAM_CONNECT_TIME.record((pool_key[2],), connect_time)
+        UPSTREAM_TTFB.record((pool_key[2], get_resource_type(url)), ttfb)
+        if proxy_url:
+            if response.status_code == 407:
+                PROXY_SELECTOR.report_failure(proxy_url)
+            else:
+                PROXY_SELECTOR.report_success(proxy_url, ttfb)
         return response
-    except Exception as e:
-        app.logger.error(f"Errore nella richiesta persistente: {e}")
-        # In caso di errore, rimuovi la sessione dal pool
-        with SESSION_LOCK:
-            if proxy_url in SESSION_POOL:
-                del SESSION_POOL[proxy_url]
-        raise
+
+    def _record(self, pool_key, connect_time, ttfb):
+        with self._lock:
+            metrics = self._metrics.get(pool_key)
+            if metrics is None:
+                return
+            metrics["requests"] += 1
+            if ttfb is None:
+                metrics["errors"] += 1
+            if connect_time is not None:
+                metrics["new_connections"] += 1
+                metrics["connect_time"] += connect_time
+                if ttfb is not None:
+                    metrics["ttfb_new"] += ttfb
+                    metrics["ttfb_new_count"] += 1
+            elif ttfb is not None:
+                metrics["ttfb_reused"] += ttfb
+                metrics["ttfb_reused_count"] += 1
+
+    @staticmethod
+    def _describe(pool_key):
+        proxy_url, scheme, host = pool_key
+        return f"{scheme}://{host}" + (f" via {mask_proxy_url(proxy_url)}" if proxy_url else "")
+
+    @staticmethod
+    def _pool_usage(session):
+        """(connessioni in uso, connessioni inattive nel pool, capacità) dei pool urllib3 della sessione"""
+        in_use = idle = capacity = 0
+        adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+        for adapter in adapters.values():
+            for manager in [adapter.poolmanager, *adapter.proxy_manager.values()]:
+                for key in manager.pools.keys():
+                    pool = manager.pools.get(key)
+                    if pool is None or pool.pool is None:
+                        continue
+                    with pool.pool.mutex:
+                        queued = list(pool.pool.queue)
+                    # La coda parte piena di None: ogni slot mancante è una connessione in uso
+                    in_use += max(pool.pool.maxsize - len(queued), 0)
+                    idle += sum(1 for conn in queued if conn is not None)
+                    capacity += pool.pool.maxsize
+        return in_use, idle, capacity
+
+    @staticmethod
+    def _summarize(metrics):
+        requests_count = metrics["requests"]
+        new_connections = metrics["new_connections"]
+        return {
+            "requests": requests_count,
+            "errors": metrics["errors"],
+            "pool_exhausted": metrics["pool_exhausted"],
+            "new_connections": new_connections,
+            "reuse_ratio": round(1 - new_connections / requests_count, 3) if requests_count else None,
+            "avg_connect_ms": round(metrics["connect_time"] / new_connections * 1000, 1) if new_connections else None,
+            "avg_ttfb_new_ms": round(metrics["ttfb_new"] / metrics["ttfb_new_count"] * 1000, 1) if metrics["ttfb_new_count"] else None,
+            "avg_ttfb_reused_ms": round(metrics["ttfb_reused"] / metrics["ttfb_reused_count"] * 1000, 1) if metrics["ttfb_reused_count"] else None
+        }
+
+    def stats(self):
+        with self._lock:
+            pools = [(key, self._sessions[key], dict(self._metrics[key])) for key in self._sessions]
+        
+        totals = self._new_metrics()
+        in_use_total = idle_total = capacity_total = 0
+        per_pool = []
+        for pool_key, session, metrics in pools:
+            for name, value in metrics.items():
+                totals[name] += value
+            in_use, idle, capacity = self._pool_usage(session)
+            in_use_total += in_use
+            idle_total += idle
+            capacity_total += capacity
+            per_pool.append({"pool": self._describe(pool_key), "in_use": in_use, "idle": idle, **self._summarize(metrics)})
+        per_pool.sort(key=lambda entry: entry["requests"], reverse=True)
+        
+        return {
+            "pools": len(pools),
+            "max_pools": self.MAX_POOLS,
+            "evicted_pools": self.evicted_pools,
+            "max_connections_per_host": self.max_per_host,
+            "connections_in_use": in_use_total,
+            "idle_connections": idle_total,
+            "utilization": round(in_use_total / capacity_total, 3) if capacity_total else 0.0,
+            **self._summarize(totals),
+            "by_pool": per_pool[:50]
+        }
+
+UPSTREAM_CONNECTIONS = UpstreamConnectionManager()
+
+def make_persistent_request(url, headers=None, timeout=None, proxy_url=None, **kwargs):
+    """Effettua una richiesta usando connessioni persistenti per (proxy, schema, host)"""
+    return UPSTREAM_CONNECTIONS.request(url, headers=headers, timeout=timeout, proxy_url=proxy_url, **kwargs)
+
+class SegmentHedger:
+    """
+    Richieste "hedged" per i segmenti: se l'upstream non risponde entro il p95
+    del time-to-first-byte osservato per l'host (mai prima di HEDGE_MIN_DELAY_MS),
+    parte una seconda richiesta tramite un altro proxy (o un'altra connessione).
+    Vince la prima risposta, l'altra viene chiusa. Le richieste extra sono
+    limitate a HEDGE_BUDGET_PERCENT delle richieste di segmenti.
+    """
+    MIN_SAMPLES = 20  # Campioni minimi prima di usare il p95 come ritardo
+    DECAY_AFTER = 10000  # Oltre questo numero di richieste i contatori del budget vengono dimezzati
+
+    def __init__(self, max_workers=64, max_hedge_workers=16):
+        # Le richieste hedge hanno un pool separato: non occupano mai i thread delle primarie
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge_primary")
+        self.hedge_executor = ThreadPoolExecutor(max_workers=max_hedge_workers, thread_name_prefix="hedge")
+        self._lock = Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+        self.cancelled = 0
+
+    def get_delay(self, url, config):
+        min_delay = config.get('HEDGE_MIN_DELAY_MS', 300) / 1000
+        p95 = UPSTREAM_TTFB.percentile((extract_url_host(url), get_resource_type(url)), 0.95, self.MIN_SAMPLES)
+        return max(min_delay, p95 or 0.0)
+
+    def _take_budget(self, config):
+        with self._lock:
+            if self.hedges + 1 > self.requests * config.get('HEDGE_BUDGET_PERCENT', 5) / 100:
+                self.budget_denied += 1
+                return False
+            self.hedges += 1
+            return True
+
+    def _cancel(self, future, attempt):
+        """
+        Annulla la richiesta perdente: se è ancora in coda non parte, se attende
+        le header il socket viene chiuso subito; se la risposta è già arrivata
+        viene chiusa, restituendo la connessione al pool.
+        """
+        with self._lock:
+            self.cancelled += 1
+        if future.cancel():
+            return
+        attempt.cancel()
+        def close(done):
+            if not done.cancelled() and done.exception() is None:
+                done.result().close()
+        future.add_done_callback(close)
+
+    def request(self, url, headers, timeout, proxy_key):
+        """Restituisce (response, proxy_key) della prima risposta, primaria o hedge"""
+        config = config_manager.get_config()
+        total_timeout = sum(timeout) if isinstance(timeout, tuple) else timeout
+        with self._lock:
+            self.requests += 1
+            if self.requests > self.DECAY_AFTER:
+                self.requests //= 2
+                self.hedges //= 2
+        
+        def send(proxy_url, attempt):
+            UPSTREAM_CONNECT_STATE.attempt = attempt
+            try:
+                return make_persistent_request(url, headers=headers, timeout=timeout, proxy_url=proxy_url, stream=True, allow_redirects=True)
+            finally:
+                UPSTREAM_CONNECT_STATE.attempt = None
+        
+        primary_attempt = UpstreamAttempt()
+        primary = self.executor.submit(send, proxy_key, primary_attempt)
+        try:
+            return primary.result(timeout=self.get_delay(url, config)), proxy_key
+        except FutureTimeoutError:
+            pass
+        
+        if not self._take_budget(config):
+            try:
+                return primary.result(timeout=total_timeout), proxy_key
+            except FutureTimeoutError:
+                self._cancel(primary, primary_attempt)
+                raise requests.exceptions.Timeout(f"Nessuna risposta upstream per {url}")
+        
+        proxy_config = get_proxy_with_fallback(url, {proxy_key} if proxy_key else ())
+        hedge_key = proxy_config['http'] if proxy_config else None
+        app.logger.info(f"Hedge del segmento TS dopo il p95 di latenza: {url}")
+        hedge_attempt = UpstreamAttempt()
+        hedge = self.hedge_executor.submit(send, hedge_key, hedge_attempt)
+        
+        pending = {primary: (proxy_key, primary_attempt), hedge: (hedge_key, hedge_attempt)}
+        error = None
+        while pending:
+            done, _ = wait(pending, timeout=total_timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                future_proxy, _ = pending.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                for loser, (_, loser_attempt) in pending.items():
+                    self._cancel(loser, loser_attempt)
+                if future is hedge:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return future.result(), future_proxy
+        for loser, (_, loser_attempt) in pending.items():
+            self._cancel(loser, loser_attempt)
+        raise error or requests.exceptions.Timeout(f"Nessuna risposta upstream per {url}")
+
+    def stats(self):
+        config = config_manager.get_config()
+        with self._lock:
+            return {
+                "enabled": config.get('HEDGE_ENABLED', False),
+                "budget_percent": config.get('HEDGE_BUDGET_PERCENT', 5),
+                "min_delay_ms": config.get('HEDGE_MIN_DELAY_MS', 300),
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "budget_denied": self.budget_denied,
+                "cancelled": self.cancelled
+            }
+
+SEGMENT_HEDGER = SegmentHedger()
+
+def request_segment(url, headers, timeout, proxy_key):
+    """Richiesta upstream di un segmento in streaming, con hedging se HEDGE_ENABLED. Restituisce (response, proxy_key)"""
+    if config_manager.get_config().get('HEDGE_ENABLED', False):
+        return SEGMENT_HEDGER.request(url, headers, timeout, proxy_key)
+    return make_persistent_request(url, headers=headers, timeout=timeout, proxy_url=proxy_key, stream=True, allow_redirects=True), proxy_key
+
+TIMEOUT_PERCENTILE = 0.99
+TIMEOUT_PERCENTILE_FACTOR = 3  # Margine sul p99 osservato
+TIMEOUT_MIN_SAMPLES = 20
+STATIC_TIMEOUT_FACTORS = {'ts': 2, 'm3u8': 1.5}  # Moltiplicatori di base_timeout finché mancano misure
 
 def get_dynamic_timeout(url, base_timeout=REQUEST_TIMEOUT):
-    """Calcola timeout dinamico basato sul tipo di risorsa."""
-    if '.ts' in url.lower():
-        return base_timeout * 2  # Timeout doppio per segmenti TS
-    elif '.m3u8' in url.lower():
-        return base_timeout * 1.5  # Timeout aumentato per playlist
+    """
+    Restituisce (connect_timeout, read_timeout) per l'URL. Con abbastanza
+    campioni i valori derivano dal p99 osservato per l'host (connessione) e per
+    host e tipo di risorsa (time-to-first-byte), altrimenti dal timeout statico
+    per tipo di risorsa. Entrambi restano tra i limiti TIMEOUT_*_MIN/MAX.
+    """
+    config = config_manager.get_config()
+    host = extract_url_host(url)
+    resource_type = get_resource_type(url)
+    connect_min, connect_max = config.get('TIMEOUT_CONNECT_MIN', 2), config.get('TIMEOUT_CONNECT_MAX', 10)
+    read_min, read_max = config.get('TIMEOUT_READ_MIN', 3), config.get('TIMEOUT_READ_MAX', 30)
+    
+    connect_p99 = UPSTREAM_CONNECT_TIME.percentile((host,), TIMEOUT_PERCENTILE, TIMEOUT_MIN_SAMPLES)
+    connect_timeout = connect_max if connect_p99 is None else connect_p99 * TIMEOUT_PERCENTILE_FACTOR
+    
+    ttfb_p99 = UPSTREAM_TTFB.percentile((host, resource_type), TIMEOUT_PERCENTILE, TIMEOUT_MIN_SAMPLES)
+    if ttfb_p99 is None:
+        read_timeout = base_timeout * STATIC_TIMEOUT_FACTORS.get(resource_type, 1)
     else:
-        return base_timeout
+        read_timeout = ttfb_p99 * TIMEOUT_PERCENTILE_FACTOR
+    
+    return (
+        round(min(max(connect_timeout, connect_min), connect_max), 2),
+        round(min(max(read_timeout, read_min), read_max), 2)
+    )
 
 # --- Dynamic DaddyLive URL Fetcher ---
-DADDYLIVE_BASE_URL = None
-LAST_FETCH_TIME = 0
+DADDYLIVE_GITHUB_URL = 'https://raw.githubusercontent.com/nzo66/dlhd_url/refs/heads/main/dlhd.xml'
+DADDYLIVE_FALLBACK_URL = "https://daddylive.sx/"
 FETCH_INTERVAL = 3600
+FETCH_RETRY_INTERVAL = 60
 
-def get_daddylive_base_url():
-    """Fetches and caches the dynamic base URL for DaddyLive."""
-    global DADDYLIVE_BASE_URL, LAST_FETCH_TIME
-    current_time = time.time()
-    
-    if DADDYLIVE_BASE_URL and (current_time - LAST_FETCH_TIME < FETCH_INTERVAL):
-        return DADDYLIVE_BASE_URL
-
-    try:
-        app.logger.info("Fetching dynamic DaddyLive base URL from GitHub...")
-        github_url = 'https://raw.githubusercontent.com/nzo66/dlhd_url/refs/heads/main/dlhd.xml'
-        
+class DaddyLiveBaseUrlProvider:
+    """
+    Fornisce il base URL dinamico di DaddyLive letto da GitHub. Solo la prima
+    lettura è bloccante: i rinnovi successivi avvengono in background e, se
+    GitHub non risponde, si continua a usare l'ultimo valore valido.
+    """
+    def __init__(self, refresh_interval=FETCH_INTERVAL, retry_interval=FETCH_RETRY_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.base_url = None
+        self.last_fetch_time = 0
+        self._lock = Lock()
+        self._refresh_in_progress = False
+
+    def _fetch(self):
         # Force direct connection for GitHub (no proxy)
         response = requests.get(
-            github_url,
+            DADDYLIVE_GITHUB_URL,
             timeout=REQUEST_TIMEOUT,
-            proxies=None,  # Force direct connection
+            proxies=None,
             verify=VERIFY_SSL
         )
         response.raise_for_status()
-        content = response.text
-        match = re.search(r'src\s*=\s*"([^"]*)"', content)
-        if match:
-            base_url = match.group(1)
-            if not base_url.endswith('/'):
-                base_url += '/'
-            DADDYLIVE_BASE_URL = base_url
-            LAST_FETCH_TIME = current_time
-            app.logger.info(f"Dynamic DaddyLive base URL updated to: {DADDYLIVE_BASE_URL}")
-            return DADDYLIVE_BASE_URL
-    except requests.RequestException as e:
-        app.logger.error(f"Error fetching dynamic DaddyLive URL: {e}. Using fallback.")
-    
-    DADDYLIVE_BASE_URL = "https://daddylive.sx/"
-    app.logger.info(f"Using fallback DaddyLive URL: {DADDYLIVE_BASE_URL}")
-    return DADDYLIVE_BASE_URL
+        match = re.search(r'src\s*=\s*"([^"]*)"', response.text)
+        if not match:
+            return None
+        base_url = match.group(1)
+        if not base_url.endswith('/'):
+            base_url += '/'
+        return base_url
+
+    def refresh(self):
+        """Rilegge il base URL da GitHub; in caso di errore mantiene il valore precedente"""
+        try:
+            app.logger.info("Fetching dynamic DaddyLive base URL from GitHub...")
+            base_url = self._fetch()
+            if base_url:
+                self.base_url = base_url
+                self.last_fetch_time = time.time()
+                app.logger.info(f"Dynamic DaddyLive base URL updated to: {self.base_url}")
+                return self.base_url
+            app.logger.error("Base URL DaddyLive non trovato in dlhd.xml.")
+        except requests.RequestException as e:
+            app.logger.error(f"Error fetching dynamic DaddyLive URL: {e}.")
+
+        # Riprova dopo retry_interval invece di ritentare ad ogni richiesta
+        self.last_fetch_time = time.time() - self.refresh_interval + self.retry_interval
+        if self.base_url is None:
+            self.base_url = DADDYLIVE_FALLBACK_URL
+            app.logger.info(f"Using fallback DaddyLive URL: {self.base_url}")
+        else:
+            app.logger.info(f"Using stale DaddyLive URL: {self.base_url}")
+        return self.base_url
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            self._refresh_in_progress = False
+
+    def get(self):
+        if self.base_url is None:
+            with self._lock:
+                if self.base_url is None:
+                    self.refresh()
+            return self.base_url
+
+        if time.time() - self.last_fetch_time >= self.refresh_interval and not self._refresh_in_progress:
+            self._refresh_in_progress = True
+            Thread(target=self._background_refresh, daemon=True).start()
+        return self.base_url
+
+daddylive_base_url_provider = DaddyLiveBaseUrlProvider()
+
+def get_daddylive_base_url():
+    """Fetches and caches the dynamic base URL for DaddyLive."""
+    return daddylive_base_url_provider.get()
 
 get_daddylive_base_url()
 
+class DaddyLiveStageCache:
+    """
+    Cache dei singoli stadi della risoluzione DaddyLive. Link Player 2, URL
+    dell'iframe e server_key cambiano raramente, mentre i parametri di
+    autenticazione scadono presto: ogni stadio ha quindi il proprio TTL e una
+    nuova risoluzione ripete solo gli stadi scaduti.
+    """
+    STAGE_TTL_KEYS = {
+        'player': ('DADDY_STAGE_TTL_PLAYER', 3600),
+        'iframe': ('DADDY_STAGE_TTL_IFRAME', 3600),
+        'auth': ('DADDY_STAGE_TTL_AUTH', 300),
+        'server_key': ('DADDY_STAGE_TTL_SERVER_KEY', 600),
+    }
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._entries = {stage: OrderedDict() for stage in self.STAGE_TTL_KEYS}
+        self._counters = {stage: {'hits': 0, 'misses': 0, 'invalidations': 0} for stage in self.STAGE_TTL_KEYS}
+        self._lock = Lock()
+
+    def _get_ttl(self, stage):
+        config_key, default = self.STAGE_TTL_KEYS[stage]
+        return config_manager.get_config().get(config_key, default)
+
+    def get(self, stage, key):
+        with self._lock:
+            entries = self._entries[stage]
+            entry = entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                entries.move_to_end(key)
+                self._counters[stage]['hits'] += 1
+                return entry[0]
+            if entry is not None:
+                del entries[key]
+            self._counters[stage]['misses'] += 1
+            return None
+
+    def set(self, stage, key, value):
+        ttl = self._get_ttl(stage)
+        if ttl <= 0:
+            return
+        with self._lock:
+            entries = self._entries[stage]
+            entries[key] = (value, time.monotonic() + ttl)
+            entries.move_to_end(key)
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+    def invalidate(self, stage, key):
+        with self._lock:
+            if self._entries[stage].pop(key, None) is not None:
+                self._counters[stage]['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            for entries in self._entries.values():
+                entries.clear()
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for stage, counters in self._counters.items():
+                total = counters['hits'] + counters['misses']
+                result[stage] = {
+                    "size": len(self._entries[stage]),
+                    "ttl": self._get_ttl(stage),
+                    **counters,
+                    "hit_ratio": round(counters['hits'] / total, 3) if total else 0.0
+                }
+            return result
+
+daddylive_stage_cache = DaddyLiveStageCache()
+
 def detect_m3u_type(content):
     """Rileva se è un M3U (lista IPTV) o un M3U8 (flusso HLS)"""
     if "#EXTM3U" in content and "#EXTINF" in content:
@@ -1044,11 +3606,11 @@ def replace_key_uri(line, headers_query):
 
 def extract_channel_id(url):
     """Estrae l'ID del canale da vari formati URL"""
-    match_premium = re.search(r'/premium(\d+)/mono\.m3u8$', url)
+    match_premium = DADDYLIVE_PREMIUM_RE.search(url)
     if match_premium:
         return match_premium.group(1)
 
-    match_player = re.search(r'/(?:watch|stream|cast|player)/stream-(\d+)\.php', url)
+    match_player = DADDYLIVE_PLAYER_RE.search(url)
     if match_player:
         return match_player.group(1)
 
@@ -1059,7 +3621,7 @@ def process_daddylive_url(url):
     daddy_base_url = get_daddylive_base_url()
     daddy_domain = urlparse(daddy_base_url).netloc
 
-    match_premium = re.search(r'/premium(\d+)/mono\.m3u8$', url)
+    match_premium = DADDYLIVE_PREMIUM_RE.search(url)
     if match_premium:
         channel_id = match_premium.group(1)
         new_url = f"{daddy_base_url}watch/stream-{channel_id}.php"
@@ -1119,12 +3681,8 @@ def resolve_m3u8_link(url, headers=None):
     #    La risoluzione speciale si attiva solo se l'URL contiene "newkso.ru"
     #    o "/stream-", altrimenti viene passato direttamente.
     
-    is_daddylive_link = (
-        'newkso.ru' in clean_url.lower() or 
-        '/stream-' in clean_url.lower() or
-        # Aggiungiamo anche i pattern del vecchio estrattore per mantenere la compatibilità
-        re.search(r'/premium(\d+)/mono\.m3u8$', clean_url) is not None
-    )
+    #    (include anche i pattern del vecchio estrattore per mantenere la compatibilità)
+    is_daddylive_link = is_daddylive_url(clean_url)
 
     if not is_daddylive_link:
         # --- GESTIONE VAVOO ---
@@ -1168,17 +3726,16 @@ def resolve_m3u8_link(url, headers=None):
     }
     final_headers_for_resolving = {**final_headers, **daddylive_headers}
 
+    # Stadi presi dalla cache: se la risoluzione fallisce vengono invalidati
+    used_cached_stages = []
+
+    def drop_cached_stages():
+        for stage, stage_key in used_cached_stages:
+            daddylive_stage_cache.invalidate(stage, stage_key)
+
     try:
-        github_url = 'https://raw.githubusercontent.com/nzo66/dlhd_url/refs/heads/main/dlhd.xml'
-        main_url_req = requests.get(
-            github_url,
-            timeout=10,  # Timeout ridotto per GitHub
-            proxies=get_proxy_for_url(github_url),
-            verify=VERIFY_SSL
-        )
-        main_url_req.raise_for_status()
-        main_url = main_url_req.text
-        baseurl = re.findall('(?s)src = "([^"]*)', main_url)[0]
+        # Stesso base URL (già in cache) usato da process_daddylive_url
+        baseurl = daddy_base_url
 
         channel_id = extract_channel_id(clean_url)
         if not channel_id:
@@ -1190,84 +3747,127 @@ def resolve_m3u8_link(url, headers=None):
         final_headers_for_resolving['Referer'] = baseurl + '/'
         final_headers_for_resolving['Origin'] = baseurl
 
-        max_retries = 2  # Ridotto da 3 a 2 per velocizzare
-        for retry in range(max_retries):
-            try:
-                proxy_config = get_proxy_with_fallback(stream_url)
-                response = requests.get(stream_url, headers=final_headers_for_resolving, timeout=15, proxies=proxy_config, verify=VERIFY_SSL)  # Timeout ridotto
-                response.raise_for_status()
-                break  # Success, exit retry loop
-            except requests.exceptions.ProxyError as e:
-                if "429" in str(e) and retry < max_retries - 1:
-                    app.logger.warning(f"Proxy rate limited (429), retry {retry + 1}/{max_retries}: {stream_url}")
-                    time.sleep(1)  # Ridotto il backoff
-                    continue
-                else:
-                    raise
-            except requests.RequestException as e:
-                if retry < max_retries - 1:
-                    app.logger.warning(f"Request failed, retry {retry + 1}/{max_retries}: {stream_url}")
-                    time.sleep(0.5)  # Ridotto il backoff
-                    continue
-                else:
-                    raise
+        # Stadio 1: pagina stream -> link Player 2
+        player_key = f"{baseurl}|{channel_id}"
+        url2 = daddylive_stage_cache.get('player', player_key)
+        if url2:
+            used_cached_stages.append(('player', player_key))
+        else:
+            max_retries = 2  # Ridotto da 3 a 2 per velocizzare
+            tried_proxies = set()
+            for retry in range(max_retries):
+                try:
+                    proxy_config = get_proxy_with_fallback(stream_url, tried_proxies)
+                    if proxy_config:
+                        tried_proxies.add(proxy_config['http'])
+                    response = requests.get(stream_url, headers=final_headers_for_resolving, timeout=15, proxies=proxy_config, verify=VERIFY_SSL)  # Timeout ridotto
+                    response.raise_for_status()
+                    break  # Success, exit retry loop
+                except requests.exceptions.ProxyError as e:
+                    if "429" in str(e) and retry < max_retries - 1:
+                        app.logger.warning(f"Proxy rate limited (429), retry {retry + 1}/{max_retries}: {stream_url}")
+                        time.sleep(1)  # Ridotto il backoff
+                        continue
+                    else:
+                        raise
+                except requests.RequestException as e:
+                    if retry < max_retries - 1:
+                        app.logger.warning(f"Request failed, retry {retry + 1}/{max_retries}: {stream_url}")
+                        time.sleep(0.5)  # Ridotto il backoff
+                        continue
+                    else:
+                        raise
 
-        iframes = re.findall(r'<a[^>]*href="([^"]+)"[^>]*>\s*<button[^>]*>\s*Player\s*2\s*</button>', response.text)
-        if not iframes:
-            app.logger.error("Nessun link Player 2 trovato")
-            return {"resolved_url": clean_url, "headers": current_headers}
+            iframes = re.findall(r'<a[^>]*href="([^"]+)"[^>]*>\s*<button[^>]*>\s*Player\s*2\s*</button>', response.text)
+            if not iframes:
+                app.logger.error("Nessun link Player 2 trovato")
+                return {"resolved_url": clean_url, "headers": current_headers}
 
-        url2 = iframes[0]
-        url2 = baseurl + url2
-        url2 = url2.replace('//cast', '/cast')
+            url2 = iframes[0]
+            url2 = baseurl + url2
+            url2 = url2.replace('//cast', '/cast')
+            daddylive_stage_cache.set('player', player_key, url2)
 
         final_headers_for_resolving['Referer'] = url2
         final_headers_for_resolving['Origin'] = url2
-        response = requests.get(url2, headers=final_headers_for_resolving, timeout=15, proxies=get_proxy_for_url(url2), verify=VERIFY_SSL)
-        response.raise_for_status()
 
-        iframes = re.findall(r'iframe src="([^"]*)', response.text)
-        if not iframes:
-            app.logger.error("Nessun iframe trovato nella pagina Player 2")
-            return {"resolved_url": clean_url, "headers": current_headers}
+        # Stadio 2: pagina Player 2 -> URL dell'iframe
+        iframe_url = daddylive_stage_cache.get('iframe', url2)
+        if iframe_url:
+            used_cached_stages.append(('iframe', url2))
+        else:
+            response = requests.get(url2, headers=final_headers_for_resolving, timeout=15, proxies=get_proxy_for_url(url2), verify=VERIFY_SSL)
+            response.raise_for_status()
 
-        iframe_url = iframes[0]
-        response = requests.get(iframe_url, headers=final_headers_for_resolving, timeout=15, proxies=get_proxy_for_url(iframe_url), verify=VERIFY_SSL)
-        response.raise_for_status()
+            iframes = re.findall(r'iframe src="([^"]*)', response.text)
+            if not iframes:
+                app.logger.error("Nessun iframe trovato nella pagina Player 2")
+                drop_cached_stages()
+                return {"resolved_url": clean_url, "headers": current_headers}
 
-        iframe_content = response.text
+            iframe_url = iframes[0]
+            daddylive_stage_cache.set('iframe', url2, iframe_url)
 
-        try:
-            channel_key = re.findall(r'(?s) channelKey = \"([^"]*)', iframe_content)[0]
-            auth_ts_b64 = re.findall(r'(?s)c = atob\("([^"]*)', iframe_content)[0]
-            auth_ts = base64.b64decode(auth_ts_b64).decode('utf-8')
-            auth_rnd_b64 = re.findall(r'(?s)d = atob\("([^"]*)', iframe_content)[0]
-            auth_rnd = base64.b64decode(auth_rnd_b64).decode('utf-8')
-            auth_sig_b64 = re.findall(r'(?s)e = atob\("([^"]*)', iframe_content)[0]
-            auth_sig = base64.b64decode(auth_sig_b64).decode('utf-8')
-            auth_sig = quote_plus(auth_sig)
-            auth_host_b64 = re.findall(r'(?s)a = atob\("([^"]*)', iframe_content)[0]
-            auth_host = base64.b64decode(auth_host_b64).decode('utf-8')
-            auth_php_b64 = re.findall(r'(?s)b = atob\("([^"]*)', iframe_content)[0]
-            auth_php = base64.b64decode(auth_php_b64).decode('utf-8')
-
-
-        except (IndexError, Exception) as e:
-            app.logger.error(f"Errore estrazione parametri: {e}")
-            return {"resolved_url": clean_url, "headers": current_headers}
+        # Stadio 3: autenticazione (iframe + auth.php). È l'unico stadio con token
+        # a breve scadenza: finché è valido non serve rileggere l'iframe
+        iframe_params = daddylive_stage_cache.get('auth', iframe_url)
+        if iframe_params:
+            used_cached_stages.append(('auth', iframe_url))
+        else:
+            response = requests.get(iframe_url, headers=final_headers_for_resolving, timeout=15, proxies=get_proxy_for_url(iframe_url), verify=VERIFY_SSL)
+            response.raise_for_status()
+
+            iframe_content = response.text
+
+            try:
+                channel_key = re.findall(r'(?s) channelKey = \"([^"]*)', iframe_content)[0]
+                auth_ts_b64 = re.findall(r'(?s)c = atob\("([^"]*)', iframe_content)[0]
+                auth_ts = base64.b64decode(auth_ts_b64).decode('utf-8')
+                auth_rnd_b64 = re.findall(r'(?s)d = atob\("([^"]*)', iframe_content)[0]
+                auth_rnd = base64.b64decode(auth_rnd_b64).decode('utf-8')
+                auth_sig_b64 = re.findall(r'(?s)e = atob\("([^"]*)', iframe_content)[0]
+                auth_sig = base64.b64decode(auth_sig_b64).decode('utf-8')
+                auth_sig = quote_plus(auth_sig)
+                auth_host_b64 = re.findall(r'(?s)a = atob\("([^"]*)', iframe_content)[0]
+                auth_host = base64.b64decode(auth_host_b64).decode('utf-8')
+                auth_php_b64 = re.findall(r'(?s)b = atob\("([^"]*)', iframe_content)[0]
+                auth_php = base64.b64decode(auth_php_b64).decode('utf-8')
+                host = re.findall('(?s)m3u8 =.*?:.*?:.*?".*?".*?"([^"]*)', iframe_content)[0]
+                server_lookup = re.findall(r'n fetchWithRetry\(\s*\'([^\']*)', iframe_content)[0]
+
+            except (IndexError, Exception) as e:
+                app.logger.error(f"Errore estrazione parametri: {e}")
+                drop_cached_stages()
+                return {"resolved_url": clean_url, "headers": current_headers}
+
+            auth_url = f'{auth_host}{auth_php}?channel_id={channel_key}&ts={auth_ts}&rnd={auth_rnd}&sig={auth_sig}'
+            auth_response = requests.get(auth_url, headers=final_headers_for_resolving, timeout=15, proxies=get_proxy_for_url(auth_url), verify=VERIFY_SSL)
+            auth_response.raise_for_status()
+
+            iframe_params = {
+                'channel_key': channel_key,
+                'host': host,
+                'server_lookup': server_lookup
+            }
+            daddylive_stage_cache.set('auth', iframe_url, iframe_params)
 
-        auth_url = f'{auth_host}{auth_php}?channel_id={channel_key}&ts={auth_ts}&rnd={auth_rnd}&sig={auth_sig}'
-        auth_response = requests.get(auth_url, headers=final_headers_for_resolving, timeout=15, proxies=get_proxy_for_url(auth_url), verify=VERIFY_SSL)
-        auth_response.raise_for_status()
+        channel_key = iframe_params['channel_key']
+        host = iframe_params['host']
+        iframe_netloc = urlparse(iframe_url).netloc
 
-        host = re.findall('(?s)m3u8 =.*?:.*?:.*?".*?".*?"([^"]*)', iframe_content)[0]
-        server_lookup = re.findall(r'n fetchWithRetry\(\s*\'([^\']*)', iframe_content)[0]
-        server_lookup_url = f"https://{urlparse(iframe_url).netloc}{server_lookup}{channel_key}"
+        # Stadio 4: server_lookup -> server_key del canale
+        server_key_cache_key = f"{iframe_netloc}|{channel_key}"
+        server_key = daddylive_stage_cache.get('server_key', server_key_cache_key)
+        if server_key:
+            used_cached_stages.append(('server_key', server_key_cache_key))
+        else:
+            server_lookup_url = f"https://{iframe_netloc}{iframe_params['server_lookup']}{channel_key}"
 
-        lookup_response = requests.get(server_lookup_url, headers=final_headers_for_resolving, timeout=15, proxies=get_proxy_for_url(server_lookup_url), verify=VERIFY_SSL)
-        lookup_response.raise_for_status()
-        server_data = lookup_response.json()
-        server_key = server_data['server_key']
+            lookup_response = requests.get(server_lookup_url, headers=final_headers_for_resolving, timeout=15, proxies=get_proxy_for_url(server_lookup_url), verify=VERIFY_SSL)
+            lookup_response.raise_for_status()
+            server_data = lookup_response.json()
+            server_key = server_data['server_key']
+            daddylive_stage_cache.set('server_key', server_key_cache_key, server_key)
 
         referer_raw = f'https://{urlparse(iframe_url).netloc}'
         clean_m3u8_url = f'https://{server_key}{host}{server_key}/{channel_key}/mono.m3u8'
@@ -1285,8 +3885,318 @@ def resolve_m3u8_link(url, headers=None):
 
     except Exception as e:
         # In caso di errore nella risoluzione, restituisce l'URL originale
+        drop_cached_stages()
         return {"resolved_url": clean_url, "headers": final_headers}
 
+def get_resolution_provider(url):
+    """Identifica il provider che richiede una catena di risoluzione (None per i link diretti)"""
+    if is_daddylive_url(url):
+        return 'daddylive'
+    if 'vavoo.to' in url.lower():
+        return 'vavoo'
+    return None
+
+def get_resolution_cache_key(url, headers):
+    headers_str = "&".join(sorted([f"{k}={v}" for k, v in headers.items()]))
+    return f"{url}|{headers_str}"
+
+def get_cached_resolution(url, headers):
+    """
+    Risoluzione in cache per url, o None. Una voce che non punta a un .m3u8
+    (risoluzione fallita salvata da versioni precedenti) viene scartata.
+    """
+    if get_resolution_provider(url) is None:
+        return None
+    cache_key = get_resolution_cache_key(url, headers)
+    cached = RESOLVED_LINKS_CACHE.get(cache_key)
+    if cached is None:
+        return None
+    resolved_url = cached.get("resolved_url")
+    if not resolved_url or not resolved_url.endswith('.m3u8'):
+        app.logger.warning(f"Risoluzione in cache non valida scartata: {url}")
+        RESOLVED_LINKS_CACHE.pop(cache_key, None)
+        return None
+    return cached
+
+def resolve_m3u8_link_cached(url, headers=None, force_refresh=False):
+    """
+    Come resolve_m3u8_link, ma riusa il risultato dalla cache dei link risolti.
+    Restituisce (result, from_cache). Vengono cachate solo le risoluzioni
+    DaddyLive/Vavoo andate a buon fine, con il TTL specifico del provider.
+    """
+    headers = headers or {}
+    config = config_manager.get_config()
+    provider = get_resolution_provider(url)
+
+    if not config.cache_enabled or provider is None:
+        return resolve_m3u8_link(url, headers), False
+
+    cache_key = get_resolution_cache_key(url, headers)
+    if not force_refresh:
+        cached = get_cached_resolution(url, headers)
+        if cached is not None:
+            app.logger.info(f"Cache HIT per risoluzione {provider}: {url}")
+            return cached, True
+
+    result = resolve_m3u8_link(url, headers)
+    resolved_url = result.get("resolved_url")
+    # Una risoluzione fallita restituisce l'URL di partenza: non va cachata
+    if resolved_url and resolved_url.endswith('.m3u8'):
+        ttl = config.get(f'CACHE_TTL_RESOLVED_{provider.upper()}', config.get('CACHE_TTL_RESOLVED_LINKS', 3600))
+        RESOLVED_LINKS_CACHE.set(cache_key, result, ttl=ttl)
+    return result, False
+
+class HotChannelRefresher:
+    """
+    Tiene traccia dei canali richiesti di recente tramite /proxy/m3u e li
+    risolve di nuovo in background poco prima che la risoluzione in cache
+    scada, così chi cambia canale trova quasi sempre un link già pronto.
+    Il rinnovo rifà solo gli stadi DaddyLive scaduti (di solito l'autenticazione).
+    I rinnovi falliti vengono ritentati con backoff esponenziale; dopo
+    MAX_FAILURES fallimenti consecutivi il canale non viene più seguito.
+
+    Con più worker gunicorn rinnova solo il worker che tiene il flock sul file
+    .leader in CACHE_SHARED_DIR: i worker si scambiano tramite un file JSON i
+    canali richiesti e le risoluzioni rinnovate, che ciascuno importa nella
+    propria cache. Senza fcntl ogni worker rinnova i propri canali.
+    """
+    CHECK_INTERVAL = 5
+    MAX_BACKOFF = 300
+    MAX_FAILURES = 5
+    SHARED_STATE_NAME = 'tvproxy_hot_channels'
+
+    def __init__(self):
+        self._channels = {}  # {cache_key: {url, headers, last_requested, jitter, failures, retry_at}}
+        self._pending = set()
+        self._lock = Lock()
+        self._executor = None
+        self._max_workers = 0
+        self._leader_fd = None
+        self._leader_pid = None
+        self._published = {}  # {cache_key: (result, scadenza in time.time())} da pubblicare agli altri worker
+        self._dropped_at = {}  # {cache_key: time.time() della sospensione}
+        self.refreshes = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def track(self, url, headers):
+        """Registra una richiesta per il canale; ignora i link che non richiedono risoluzione"""
+        config = config_manager.get_config()
+        if not config.get('HOT_CHANNEL_REFRESH_ENABLED', True) or not config.cache_enabled:
+            return
+        if get_resolution_provider(url) is None:
+            return
+        headers = headers or {}
+        cache_key = get_resolution_cache_key(url, headers)
+        margin = config.get('HOT_CHANNEL_REFRESH_MARGIN', 60)
+        with self._lock:
+            channel = self._channels.get(cache_key)
+            if channel is None:
+                # Jitter per canale: evita che i canali aperti insieme vengano rinnovati insieme
+                channel = {'url': url, 'headers': dict(headers), 'jitter': random.uniform(0, margin / 2), 'failures': 0, 'retry_at': 0}
+                self._channels[cache_key] = channel
+            channel['last_requested'] = time.monotonic()
+
+    def _get_executor(self, max_workers):
+        if self._executor is None or self._max_workers != max_workers:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hot_channel")
+            self._max_workers = max_workers
+        return self._executor
+
+    def _record_result(self, cache_key, success):
+        with self._lock:
+            channel = self._channels.get(cache_key)
+            if channel is None:
+                return
+            if success:
+                channel['failures'] = 0
+                channel['retry_at'] = 0
+                return
+            channel['failures'] += 1
+            if channel['failures'] >= self.MAX_FAILURES:
+                # Canale probabilmente morto: smette di risolverlo finché non viene richiesto di nuovo
+                del self._channels[cache_key]
+                self._dropped_at[cache_key] = time.time()
+                self.dropped += 1
+                app.logger.warning(f"Rinnovo in background sospeso dopo {channel['failures']} fallimenti: {channel['url']}")
+                return
+            channel['retry_at'] = time.monotonic() + min(self.CHECK_INTERVAL * 2 ** channel['failures'], self.MAX_BACKOFF)
+
+    def _refresh(self, cache_key, url, headers):
+        success = False
+        try:
+            result, _ = resolve_m3u8_link_cached(url, headers, force_refresh=True)
+            resolved_url = result.get("resolved_url")
+            if resolved_url and resolved_url.endswith('.m3u8'):
+                success = True
+                self.refreshes += 1
+                expires_in = RESOLVED_LINKS_CACHE.expires_in(cache_key)
+                if expires_in is not None:
+                    with self._lock:
+                        self._published[cache_key] = (result, time.time() + expires_in)
+                app.logger.info(f"Risoluzione rinnovata in background: {url}")
+            else:
+                self.failures += 1
+                app.logger.warning(f"Rinnovo in background non riuscito: {url}")
+        except Exception as e:
+            self.failures += 1
+            app.logger.error(f"Errore nel rinnovo in background di {url}: {e}")
+        finally:
+            self._record_result(cache_key, success)
+            with self._lock:
+                self._pending.discard(cache_key)
+
+    def _get_shared_dir(self, config):
+        if fcntl is None:
+            return None
+        directory = config.get('CACHE_SHARED_DIR', '/dev/shm')
+        if not os.path.isdir(directory):
+            directory = tempfile.gettempdir()
+        return directory
+
+    def _is_leader(self, directory):
+        """
+        Elezione tra i worker: è leader chi ottiene il flock non bloccante sul
+        file .leader e lo tiene per tutta la vita del processo. Viene ritentata
+        a ogni giro, così se il leader termina un altro worker prende il suo posto.
+        """
+        if self._leader_pid == os.getpid():
+            return True
+        fd = os.open(os.path.join(directory, f"{self.SHARED_STATE_NAME}.leader"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._leader_fd, self._leader_pid = fd, os.getpid()
+        app.logger.info(f"Refresher dei canali attivo in questo worker (pid {self._leader_pid})")
+        return True
+
+    def _sync_shared(self, directory, window, is_leader):
+        """
+        Scambia lo stato con gli altri worker: pubblica i canali richiesti a
+        questo worker e le risoluzioni rinnovate, importa nella cache locale le
+        risoluzioni più fresche dei propri canali. Il leader adotta anche i
+        canali richiesti agli altri worker.
+        """
+        now = time.monotonic()
+        now_wall = time.time()
+        with self._lock:
+            local = {
+                cache_key: (channel['url'], channel['headers'], now_wall - (now - channel['last_requested']))
+                for cache_key, channel in self._channels.items()
+            }
+            published, self._published = self._published, {}
+            self._dropped_at = {cache_key: dropped_at for cache_key, dropped_at in self._dropped_at.items() if now_wall - dropped_at <= window}
+
+        fd = os.open(os.path.join(directory, f"{self.SHARED_STATE_NAME}.json"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with os.fdopen(os.dup(fd), 'r+', encoding='utf-8') as f:
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+                for cache_key, (url, headers, last_requested) in local.items():
+                    entry = state.setdefault(cache_key, {'url': url, 'headers': headers, 'last_requested': 0, 'result': None, 'expires_at': 0})
+                    entry['last_requested'] = max(entry['last_requested'], last_requested)
+                for cache_key, (result, expires_at) in published.items():
+                    if cache_key in state:
+                        state[cache_key]['result'] = result
+                        state[cache_key]['expires_at'] = expires_at
+                # I canali che nessun worker richiede più escono dallo stato condiviso
+                state = {cache_key: entry for cache_key, entry in state.items() if now_wall - entry['last_requested'] <= window}
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f, default=str)
+        finally:
+            os.close(fd)
+
+        margin = config_manager.get_config().get('HOT_CHANNEL_REFRESH_MARGIN', 60)
+        for cache_key, entry in state.items():
+            adopt = is_leader and cache_key not in local and entry['last_requested'] > self._dropped_at.get(cache_key, 0)
+            if cache_key not in local and not adopt:
+                continue
+            remaining = entry['expires_at'] - now_wall
+            if entry['result'] and remaining > 0:
+                current = RESOLVED_LINKS_CACHE.expires_in(cache_key)
+                if current is None or current < remaining - 1:
+                    RESOLVED_LINKS_CACHE.set(cache_key, entry['result'], ttl=remaining)
+            if is_leader:
+                last_requested = now - (now_wall - entry['last_requested'])
+                with self._lock:
+                    channel = self._channels.get(cache_key)
+                    if channel is None:
+                        channel = {'url': entry['url'], 'headers': entry['headers'], 'jitter': random.uniform(0, margin / 2), 'failures': 0, 'retry_at': 0, 'last_requested': last_requested}
+                        self._channels[cache_key] = channel
+                    channel['last_requested'] = max(channel['last_requested'], last_requested)
+
+    def run_once(self):
+        config = config_manager.get_config()
+        if not config.get('HOT_CHANNEL_REFRESH_ENABLED', True) or not config.cache_enabled:
+            return
+        if not isinstance(RESOLVED_LINKS_CACHE, ResolutionCache):
+            return
+
+        window = config.get('HOT_CHANNEL_WINDOW', 600)
+        margin = config.get('HOT_CHANNEL_REFRESH_MARGIN', 60)
+        is_leader = True
+        directory = self._get_shared_dir(config)
+        if directory is not None:
+            try:
+                is_leader = self._is_leader(directory)
+                self._sync_shared(directory, window, is_leader)
+            except OSError as e:
+                # Stato condiviso non disponibile: ogni worker rinnova i propri canali
+                app.logger.warning(f"Stato condiviso del refresher non disponibile, rinnovo locale: {e}")
+                is_leader = True
+
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            for cache_key, channel in list(self._channels.items()):
+                if now - channel['last_requested'] > window:
+                    # Nessuno guarda più il canale: smette di rinnovarlo
+                    del self._channels[cache_key]
+                    continue
+                if not is_leader:
+                    continue
+                if cache_key in self._pending or now < channel['retry_at']:
+                    continue
+                expires_in = RESOLVED_LINKS_CACHE.expires_in(cache_key)
+                if expires_in is None or expires_in <= margin + channel['jitter']:
+                    self._pending.add(cache_key)
+                    due.append((cache_key, channel['url'], channel['headers']))
+
+        if due:
+            executor = self._get_executor(max(1, config.get('HOT_CHANNEL_MAX_WORKERS', 4)))
+            for cache_key, url, headers in due:
+                executor.submit(self._refresh, cache_key, url, headers)
+
+    def run(self):
+        while True:
+            time.sleep(self.CHECK_INTERVAL)
+            try:
+                self.run_once()
+            except Exception as e:
+                app.logger.error(f"Errore nel refresher dei canali: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tracked": len(self._channels),
+                "pending": len(self._pending),
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+                "dropped": self.dropped,
+                "leader": self._leader_pid == os.getpid() or fcntl is None
+            }
+
+hot_channel_refresher = HotChannelRefresher()
+Thread(target=hot_channel_refresher.run, daemon=True).start()
+
 # Thread di statistiche rimosso - solo proxy
 
     
@@ -1502,6 +4412,12 @@ def index():
                 <p>Pulisce tutte le cache (richiesta POST)</p>
                 <div class="example">POST /cache/clear</div>
             </div>
+            
+            <div class="endpoint">
+                <h4>🔌 Upstream Stats</h4>
+                <p>Utilizzo dei pool di connessioni upstream per proxy e host, riuso e tempi di connessione</p>
+                <div class="example">/upstream/stats</div>
+            </div>
         </div>
         
         <div class="features">
@@ -1714,40 +4630,66 @@ def proxy_vavoo():
             "error": str(e)
         }), 500
 
-@app.route('/proxy/m3u')
-def proxy_m3u():
-    """Proxy per file M3U e M3U8 con supporto DaddyLive 2025, caching intelligente e pre-buffering"""
-    m3u_url = request.args.get('url', '').strip()
-    if not m3u_url:
-        return "Errore: Parametro 'url' mancante", 400
-
-    cache_key_headers = "&".join(sorted([f"{k}={v}" for k, v in request.args.items() if k.lower().startswith("h_")]))
-    cache_key = f"{m3u_url}|{cache_key_headers}"
-
-    config = config_manager.load_config()
-    cache_enabled = config.get('CACHE_ENABLED', True)
-    
-    if cache_enabled and cache_key in M3U8_CACHE:
-        app.logger.info(f"Cache HIT per M3U8: {m3u_url}")
-        cached_response = M3U8_CACHE[cache_key]
-        return Response(cached_response, content_type="application/vnd.apple.mpegurl")
-
-    app.logger.info(f"Cache MISS per M3U8: {m3u_url} (primo avvio, risposta diretta)")
-
-    request_headers = {
-        unquote(key[2:]).replace("_", "-"): unquote(value).strip()
-        for key, value in request.args.items()
-        if key.lower().startswith("h_")
-    }
+def parse_playlist_timing(content):
+    """Estrae #EXT-X-TARGETDURATION, #EXT-X-MEDIA-SEQUENCE e #EXT-X-ENDLIST da una playlist HLS"""
+    target_duration = None
+    media_sequence = None
+    endlist = False
+    for line in content.splitlines():
+        line = line.strip()
+        try:
+            if line.startswith('#EXT-X-TARGETDURATION:'):
+                target_duration = float(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+                media_sequence = int(line.split(':', 1)[1])
+        except ValueError:
+            continue
+        if line == '#EXT-X-ENDLIST':
+            endlist = True
+    return {"target_duration": target_duration, "media_sequence": media_sequence, "endlist": endlist}
 
-    headers = request_headers
+def get_playlist_cache_ttl(timing, previous_sequence, config):
+    """
+    TTL della playlist in cache: lungo per le VOD (#EXT-X-ENDLIST), circa metà
+    target duration per le live e un quarto se la media sequence non è
+    avanzata dall'ultima lettura (il prossimo aggiornamento è imminente).
+    Senza #EXT-X-TARGETDURATION (es. master playlist) usa CACHE_TTL_M3U8.
+    """
+    if timing["endlist"]:
+        return config.get('CACHE_TTL_M3U8_VOD', 3600)
+    target_duration = timing["target_duration"]
+    if not target_duration:
+        return config.get('CACHE_TTL_M3U8', 5)
+    if previous_sequence is not None and timing["media_sequence"] == previous_sequence:
+        return max(target_duration / 4, 1.0)
+    return max(target_duration / 2, 1.0)
+
+def cache_playlist(cache_key, content, timing):
+    """Salva la playlist riscritta in M3U8_CACHE con il TTL ricavato dai suoi tag"""
+    config = config_manager.get_config()
+    ttl = get_playlist_cache_ttl(timing, M3U8_CACHE.get_media_sequence(cache_key), config)
+    M3U8_CACHE.set(cache_key, content, ttl=ttl, media_sequence=timing["media_sequence"])
+    return ttl
+
+class PlaylistBuildError(Exception):
+    """Errore di risoluzione/validazione della playlist, restituito al client come 500"""
+    pass
+
+def build_m3u8_playlist(m3u_url, headers):
+    """
+    Risolve m3u_url, scarica la playlist e riscrive segmenti e chiavi verso il
+    proxy. Non dipende dalla richiesta Flask, così può essere usata anche dal
+    refresh in background. Restituisce (content, cacheable, timing): le liste
+    M3U IPTV vengono restituite così come sono e non vanno in cache.
+    """
+    cache_enabled = config_manager.get_config().cache_enabled
     processed_url = process_daddylive_url(m3u_url)
 
-    try:
+    for attempt in range(2):
         app.logger.info(f"Chiamata a resolve_m3u8_link per URL processato: {processed_url}")
-        result = resolve_m3u8_link(processed_url, headers)
+        result, from_cache = resolve_m3u8_link_cached(processed_url, headers, force_refresh=attempt > 0)
         if not result["resolved_url"]:
-            return "Errore: Impossibile risolvere l'URL in un M3U8 valido.", 500
+            raise PlaylistBuildError("Errore: Impossibile risolvere l'URL in un M3U8 valido.")
 
         resolved_url = result["resolved_url"]
         current_headers_for_proxy = result["headers"]
@@ -1756,7 +4698,7 @@ def proxy_m3u():
 
         if not resolved_url.endswith('.m3u8'):
             app.logger.error(f"URL risolto non è un M3U8: {resolved_url}")
-            return "Errore: Impossibile ottenere un M3U8 valido dal canale", 500
+            raise PlaylistBuildError("Errore: Impossibile ottenere un M3U8 valido dal canale")
 
         app.logger.info(f"Fetching M3U8 content from clean URL: {resolved_url}")
 
@@ -1771,60 +4713,111 @@ def proxy_m3u():
             proxy_url=proxy_key,
             allow_redirects=True
         )
-        m3u_response.raise_for_status()
 
-        m3u_content = m3u_response.text
-        final_url = m3u_response.url
+        if m3u_response.status_code in (403, 404) and cache_enabled:
+            # L'URL risolto non è più valido: invalida la cache e, se veniva da lì, risolve di nuovo
+            RESOLVED_LINKS_CACHE.invalidate_resolved(resolved_url)
+            if from_cache:
+                app.logger.warning(f"URL risolto in cache non più valido ({m3u_response.status_code}), nuova risoluzione: {resolved_url}")
+                continue
+        break
 
-        file_type = detect_m3u_type(m3u_content)
-        if file_type == "m3u":
-            return Response(m3u_content, content_type="application/vnd.apple.mpegurl")
+    m3u_response.raise_for_status()
+    hot_channel_refresher.track(processed_url, headers)
 
-        parsed_url = urlparse(final_url)
-        base_url = f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path.rsplit('/', 1)[0]}/"
+    m3u_content = m3u_response.text
+    final_url = m3u_response.url
 
-        headers_query = "&".join([f"h_{quote(k)}={quote(v)}" for k, v in current_headers_for_proxy.items()])
+    file_type = detect_m3u_type(m3u_content)
+    if file_type == "m3u":
+        return m3u_content, False, None
 
-        # Genera stream ID per il pre-buffering
-        stream_id = pre_buffer_manager.get_stream_id_from_url(m3u_url)
+    parsed_url = urlparse(final_url)
+    base_url = f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path.rsplit('/', 1)[0]}/"
 
-        modified_m3u8 = []
-        for line in m3u_content.splitlines():
-            line = line.strip()
-            if line.startswith("#EXT-X-KEY") and 'URI="' in line:
-                line = replace_key_uri(line, headers_query)
-            elif line and not line.startswith("#"):
-                segment_url = urljoin(base_url, line)
-                if headers_query:
-                    line = f"/proxy/ts?url={quote(segment_url)}&{headers_query}&stream_id={stream_id}"
-                else:
-                    line = f"/proxy/ts?url={quote(segment_url)}&stream_id={stream_id}"
-            modified_m3u8.append(line)
+    headers_query = "&".join([f"h_{quote(k)}={quote(v)}" for k, v in current_headers_for_proxy.items()])
 
-        modified_m3u8_content = "\n".join(modified_m3u8)
+    # Stream ID per il pre-buffering ricavato dall'URL risolto: tutti i viewer del canale condividono il buffer
+    stream_id = pre_buffer_manager.get_stream_id_from_url(final_url.split('?', 1)[0])
 
-        # Avvia il pre-buffering in background
-        def start_pre_buffering():
-            try:
-                pre_buffer_manager.pre_buffer_segments(m3u_content, base_url, current_headers_for_proxy, stream_id)
-            except Exception as e:
-                app.logger.error(f"Errore nell'avvio del pre-buffering: {e}")
+    modified_m3u8 = []
+    for line in m3u_content.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-KEY") and 'URI="' in line:
+            line = replace_key_uri(line, headers_query)
+        elif line and not line.startswith("#"):
+            segment_url = urljoin(base_url, line)
+            if headers_query:
+                line = f"/proxy/ts?url={quote(segment_url)}&{headers_query}&stream_id={stream_id}"
+            else:
+                line = f"/proxy/ts?url={quote(segment_url)}&stream_id={stream_id}"
+        modified_m3u8.append(line)
 
-        Thread(target=start_pre_buffering, daemon=True).start()
+    modified_m3u8_content = "\n".join(modified_m3u8)
 
-        def cache_later():
-            if not cache_enabled:
-                return
-            try:
-                M3U8_CACHE[cache_key] = modified_m3u8_content
-                app.logger.info(f"M3U8 cache salvata per {m3u_url}")
-            except Exception as e:
-                app.logger.error(f"Errore nel salvataggio cache M3U8: {e}")
+    # Accoda i nuovi segmenti al pre-buffering (il download avviene nel worker dello stream)
+    pre_buffer_manager.pre_buffer_segments(m3u_content, base_url, current_headers_for_proxy, stream_id)
+
+    return modified_m3u8_content, True, parse_playlist_timing(m3u_content)
+
+def refresh_playlist_cache(cache_key, m3u_url, headers):
+    """Refresh in background di una playlist servita stale; la voce vecchia resta valida fino alla fine della grace"""
+    try:
+        content, cacheable, timing = build_m3u8_playlist(m3u_url, headers)
+        if cacheable:
+            ttl = cache_playlist(cache_key, content, timing)
+            app.logger.info(f"M3U8 cache aggiornata in background per {m3u_url} (TTL {ttl}s)")
+    except Exception as e:
+        app.logger.error(f"Errore nel refresh in background della playlist {m3u_url}: {e}")
+    finally:
+        M3U8_CACHE.end_refresh(cache_key)
+
+@app.route('/proxy/m3u')
+def proxy_m3u():
+    """Proxy per file M3U e M3U8 con supporto DaddyLive 2025, caching intelligente e pre-buffering"""
+    m3u_url = request.args.get('url', '').strip()
+    if not m3u_url:
+        return "Errore: Parametro 'url' mancante", 400
+
+    cache_key_headers = "&".join(sorted([f"{k}={v}" for k, v in request.args.items() if k.lower().startswith("h_")]))
+    cache_key = f"{normalize_cache_key(m3u_url)}|{cache_key_headers}"
+
+    config = config_manager.get_config()
+    cache_enabled = config.cache_enabled
+
+    request_headers = {
+        unquote(key[2:]).replace("_", "-"): unquote(value).strip()
+        for key, value in request.args.items()
+        if key.lower().startswith("h_")
+    }
+
+    headers = request_headers
+
+    if cache_enabled:
+        cached_response, is_fresh = M3U8_CACHE.lookup(cache_key)
+        if cached_response is not None:
+            if is_fresh:
+                app.logger.info(f"Cache HIT per M3U8: {m3u_url}")
+            else:
+                # Serve subito la versione scaduta e aggiorna in background (un solo refresh per chiave)
+                app.logger.info(f"Cache STALE per M3U8: {m3u_url}")
+                if M3U8_CACHE.begin_refresh(cache_key):
+                    Thread(target=refresh_playlist_cache, args=(cache_key, m3u_url, headers), daemon=True).start()
+            return Response(cached_response, content_type="application/vnd.apple.mpegurl")
+
+    app.logger.info(f"Cache MISS per M3U8: {m3u_url} (primo avvio, risposta diretta)")
+
+    try:
+        modified_m3u8_content, cacheable, timing = build_m3u8_playlist(m3u_url, headers)
 
-        Thread(target=cache_later, daemon=True).start()
+        if cache_enabled and cacheable:
+            ttl = cache_playlist(cache_key, modified_m3u8_content, timing)
+            app.logger.info(f"M3U8 cache salvata per {m3u_url} (TTL {ttl}s)")
 
         return Response(modified_m3u8_content, content_type="application/vnd.apple.mpegurl")
 
+    except PlaylistBuildError as e:
+        return str(e), 500
     except requests.RequestException as e:
         app.logger.error(f"Errore durante il download o la risoluzione del file: {str(e)}")
         return f"Errore durante il download o la risoluzione del file M3U/M3U8: {str(e)}", 500
@@ -1849,7 +4842,7 @@ def proxy_resolve():
 
     try:
         processed_url = process_daddylive_url(url)
-        result = resolve_m3u8_link(processed_url, headers)
+        result, _ = resolve_m3u8_link_cached(processed_url, headers)
         if not result["resolved_url"]:
             return "Errore: Impossibile risolvere l'URL", 500
 
@@ -1875,89 +4868,106 @@ def proxy_ts():
         return "Errore: Parametro 'url' mancante", 400
 
     # Carica configurazione cache
-    config = config_manager.load_config()
-    cache_enabled = config.get('CACHE_ENABLED', True)
+    config = config_manager.get_config()
+    cache_enabled = config.cache_enabled
+    # Chiave senza i parametri volatili (token, scadenze): l'upstream riceve comunque ts_url
+    cache_key = normalize_cache_key(ts_url)
     
-    # 1. Controlla prima il pre-buffer (più veloce)
-    if stream_id:
-        buffered_content = pre_buffer_manager.get_buffered_segment(ts_url, stream_id)
-        if buffered_content:
-            app.logger.info(f"Pre-buffer HIT per TS: {ts_url}")
-            return Response(buffered_content, content_type="video/mp2t")
+    # 1. Controlla prima il pre-buffer condiviso (più veloce)
+    buffered_content = pre_buffer_manager.get_buffered_segment(cache_key)
+    viewer_id = hashlib.md5(f"{request.remote_addr}|{request.headers.get('User-Agent', '')}".encode()).hexdigest()[:12]
+    pre_buffer_manager.report_playhead(stream_id, cache_key, viewer_id)
+    if buffered_content:
+        app.logger.info(f"Pre-buffer HIT per TS: {ts_url}")
+        return Response(buffered_content, content_type="video/mp2t")
     
     # 2. Controlla la cache normale
-    if cache_enabled and ts_url in TS_CACHE:
+    cached_content = TS_CACHE.get(cache_key) if cache_enabled else None
+    if cached_content:
         app.logger.info(f"Cache HIT per TS: {ts_url}")
-        return Response(TS_CACHE[ts_url], content_type="video/mp2t")
+        return Response(cached_content, content_type="video/mp2t")
 
-    app.logger.info(f"Cache MISS per TS: {ts_url}")
+    # 3. Livello su disco
+    disk_entry = TS_DISK_CACHE.open(cache_key) if cache_enabled and TS_DISK_CACHE else None
+    if disk_entry:
+        app.logger.info(f"Cache disco HIT per TS: {ts_url}")
+        return serve_disk_segment(disk_entry)
 
-    headers = {
-        unquote(key[2:]).replace("_", "-"): unquote(value).strip()
-        for key, value in request.args.items()
-        if key.lower().startswith("h_")
-    }
+    app.logger.info(f"Cache MISS per TS: {ts_url}")
 
-    proxy_config = get_proxy_for_url(ts_url)
-    proxy_key = proxy_config['http'] if proxy_config else None
-    
     ts_timeout = get_dynamic_timeout(ts_url)
-    max_retries = 3
-    
-    for attempt in range(max_retries):
-        try:
-            response = make_persistent_request(
-                ts_url,
-                headers=headers,
-                timeout=ts_timeout,
-                proxy_url=proxy_key,
-                stream=True,
-                allow_redirects=True
-            )
-            response.raise_for_status()
+    ts_wait_timeout = sum(ts_timeout)  # Attesa massima dei dati per le richieste agganciate
 
-            def generate_and_cache():
-                content_parts = []
-                try:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            content_parts.append(chunk)
-                            yield chunk
-                except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
-                    if "Read timed out" in str(e) or "timed out" in str(e).lower():
-                        app.logger.warning(f"Timeout durante il download del segmento TS (tentativo {attempt + 1}): {ts_url}")
-                        return b""  # Return empty bytes instead of None
-                    raise
-                finally:
-                    ts_content = b"".join(content_parts)
-                    if cache_enabled and ts_content and len(ts_content) > 1024:
-                        TS_CACHE[ts_url] = ts_content
-                        app.logger.info(f"Segmento TS cachato ({len(ts_content)} bytes) per: {ts_url}")
+    # 4. Se lo stesso segmento è già in download, aggancia questa richiesta al leader
+    fetch, is_leader = SEGMENT_FLIGHTS.join(cache_key)
+    if not is_leader:
+        app.logger.info(f"Download TS già in corso, richiesta agganciata: {ts_url}")
+        return serve_inflight_fetch(fetch, "video/mp2t", ts_wait_timeout)
+
+    handed_off = False
+    try:
+        # Il download precedente potrebbe essere terminato tra il controllo cache e join()
+        cached_content = TS_CACHE.get(cache_key) if cache_enabled and cache_key in TS_CACHE else None
+        if cached_content:
+            fetch.append(cached_content)
+            fetch.finish()
+            return Response(cached_content, content_type="video/mp2t")
 
-            return Response(generate_and_cache(), content_type="video/mp2t")
+        headers = {
+            unquote(key[2:]).replace("_", "-"): unquote(value).strip()
+            for key, value in request.args.items()
+            if key.lower().startswith("h_")
+        }
+
+        proxy_config = get_proxy_for_url(ts_url)
+        proxy_key = proxy_config['http'] if proxy_config else None
+        
+        max_retries = 3
+        
+        for attempt in range(max_retries):
+            try:
+                response, proxy_key = request_segment(ts_url, headers, ts_timeout, proxy_key)
+                response.raise_for_status()
 
-        except requests.exceptions.ConnectionError as e:
-            if "Read timed out" in str(e) or "timed out" in str(e).lower():
-                app.logger.warning(f"Timeout del segmento TS (tentativo {attempt + 1}/{max_retries}): {ts_url}")
+                # L'upstream viene letto a piena velocità da un worker del pool: i client leggono dal buffer condiviso
+                try:
+                    SEGMENT_DOWNLOAD_EXECUTOR.submit(download_segment_to_fetch, fetch, response, cache_key, ts_url, cache_enabled, proxy_key, headers, ts_timeout)
+                except RuntimeError:
+                    # Executor chiuso (shutdown dell'interprete)
+                    response.close()
+                    raise
+                handed_off = True
+                return serve_inflight_fetch(fetch, "video/mp2t", ts_wait_timeout)
+
+            except requests.exceptions.ConnectionError as e:
+                if "Read timed out" in str(e) or "timed out" in str(e).lower():
+                    app.logger.warning(f"Timeout del segmento TS (tentativo {attempt + 1}/{max_retries}): {ts_url}")
+                    if attempt == max_retries - 1:
+                        return f"Errore: Timeout persistente per il segmento TS dopo {max_retries} tentativi", 504
+                    time.sleep(2 ** attempt)
+                    continue
+                else:
+                    app.logger.error(f"Errore di connessione per il segmento TS: {str(e)}")
+                    return f"Errore di connessione per il segmento TS: {str(e)}", 500
+            except requests.exceptions.ReadTimeout as e:
+                app.logger.warning(f"Read timeout esplicito per il segmento TS (tentativo {attempt + 1}/{max_retries}): {ts_url}")
                 if attempt == max_retries - 1:
-                    return f"Errore: Timeout persistente per il segmento TS dopo {max_retries} tentativi", 504
+                    return f"Errore: Read timeout persistente per il segmento TS dopo {max_retries} tentativi", 504
                 time.sleep(2 ** attempt)
                 continue
-            else:
-                app.logger.error(f"Errore di connessione per il segmento TS: {str(e)}")
-                return f"Errore di connessione per il segmento TS: {str(e)}", 500
-        except requests.exceptions.ReadTimeout as e:
-            app.logger.warning(f"Read timeout esplicito per il segmento TS (tentativo {attempt + 1}/{max_retries}): {ts_url}")
-            if attempt == max_retries - 1:
-                return f"Errore: Read timeout persistente per il segmento TS dopo {max_retries} tentativi", 504
-            time.sleep(2 ** attempt)
-            continue
-        except requests.RequestException as e:
-            app.logger.error(f"Errore durante il download del segmento TS: {str(e)}")
-            return f"Errore durante il download del segmento TS: {str(e)}", 500
-    
-    # If we get here, all retries failed
-    return "Errore: Impossibile scaricare il segmento TS dopo tutti i tentativi", 500
+            except requests.RequestException as e:
+                app.logger.error(f"Errore durante il download del segmento TS: {str(e)}")
+                return f"Errore durante il download del segmento TS: {str(e)}", 500
+        
+        # If we get here, all retries failed
+        return "Errore: Impossibile scaricare il segmento TS dopo tutti i tentativi", 500
+    finally:
+        if not handed_off:
+            # Nessuno streaming avviato: sblocca le richieste agganciate
+            if not fetch.done:
+                fetch.finish(error="download upstream fallito")
+            SEGMENT_FLIGHTS.release(cache_key, fetch)
+
 @app.route('/proxy')
 def proxy():
     """Proxy per liste M3U che aggiunge automaticamente /proxy/m3u?url= con IP prima dei link"""
@@ -2205,15 +5215,26 @@ def proxy_key():
         return "Errore: Parametro 'url' mancante per la chiave", 400
 
     # Carica configurazione cache
-    config = config_manager.load_config()
-    cache_enabled = config.get('CACHE_ENABLED', True)
+    config = config_manager.get_config()
+    cache_enabled = config.cache_enabled
+    cache_key = normalize_cache_key(key_url)
     
-    if cache_enabled and key_url in KEY_CACHE:
+    if cache_enabled and cache_key in KEY_CACHE:
         app.logger.info(f"Cache HIT per KEY: {key_url}")
-        return Response(KEY_CACHE[key_url], content_type="application/octet-stream")
+        return Response(KEY_CACHE[cache_key], content_type="application/octet-stream")
 
     app.logger.info(f"Cache MISS per KEY: {key_url}")
 
+    # Una sola richiesta upstream per chiave, anche con molti client concorrenti
+    fetch, is_leader = KEY_FLIGHTS.join(cache_key)
+    if not is_leader:
+        app.logger.info(f"Download KEY già in corso, richiesta agganciata: {key_url}")
+        if not fetch.wait_until_done(REQUEST_TIMEOUT):
+            return "Errore: Timeout in attesa del download condiviso della chiave", 504
+        if fetch.error is not None:
+            return f"Errore durante il download della chiave AES-128: {fetch.error}", fetch.status_code or 500
+        return Response(fetch.content(), content_type="application/octet-stream")
+
     headers = {
         unquote(key[2:]).replace("_", "-"): unquote(value).strip()
         for key, value in request.args.items()
@@ -2235,41 +5256,72 @@ def proxy_key():
         key_content = response.content
 
         if cache_enabled:
-            KEY_CACHE[key_url] = key_content
+            KEY_CACHE[cache_key] = key_content
+        fetch.append(key_content)
+        fetch.finish()
         return Response(key_content, content_type="application/octet-stream")
 
     except requests.RequestException as e:
         app.logger.error(f"Errore durante il download della chiave AES-128: {str(e)}")
+        fetch.finish(error=str(e), status_code=500)
         return f"Errore durante il download della chiave AES-128: {str(e)}", 500
+    finally:
+        if not fetch.done:
+            fetch.finish(error="download upstream fallito")
+        KEY_FLIGHTS.release(cache_key, fetch)
 
 @app.route('/cache/stats')
 def cache_stats():
     """Mostra le statistiche delle cache"""
     try:
-        config = config_manager.load_config()
-        cache_enabled = config.get('CACHE_ENABLED', True)
+        config = config_manager.get_config()
+        cache_enabled = config.cache_enabled
         
         stats = {
             "cache_enabled": cache_enabled,
             "m3u8_cache": {
                 "size": len(M3U8_CACHE),
                 "maxsize": config.get('CACHE_MAXSIZE_M3U8', 500),
-                "ttl": config.get('CACHE_TTL_M3U8', 5)
+                "ttl": config.get('CACHE_TTL_M3U8', 5),
+                "ttl_vod": config.get('CACHE_TTL_M3U8_VOD', 3600),
+                **(M3U8_CACHE.stats() if isinstance(M3U8_CACHE, PlaylistCache) else {})
             },
             "ts_cache": {
                 "size": len(TS_CACHE),
                 "maxsize": config.get('CACHE_MAXSIZE_TS', 8000),
-                "ttl": config.get('CACHE_TTL_TS', 600)
+                "ttl": config.get('CACHE_TTL_TS', 600),
+                **(TS_CACHE.stats() if isinstance(TS_CACHE, (SegmentCache, SharedSegmentStore)) else {})
             },
+            "ts_disk_cache": TS_DISK_CACHE.stats() if TS_DISK_CACHE else None,
             "key_cache": {
                 "size": len(KEY_CACHE),
                 "maxsize": config.get('CACHE_MAXSIZE_KEY', 1000),
-                "ttl": config.get('CACHE_TTL_KEY', 600)
+                "ttl": config.get('CACHE_TTL_KEY', 600),
+                **(KEY_CACHE.stats() if isinstance(KEY_CACHE, SharedSegmentStore) else {})
             },
             "resolved_links_cache": {
                 "size": len(RESOLVED_LINKS_CACHE),
                 "maxsize": config.get('CACHE_MAXSIZE_RESOLVED_LINKS', 1000),
-                "ttl": config.get('CACHE_TTL_RESOLVED_LINKS', 3600)
+                "ttl": config.get('CACHE_TTL_RESOLVED_LINKS', 3600),
+                "ttl_daddylive": config.get('CACHE_TTL_RESOLVED_DADDYLIVE', 600),
+                "ttl_vavoo": config.get('CACHE_TTL_RESOLVED_VAVOO', 300),
+                **(RESOLVED_LINKS_CACHE.stats() if isinstance(RESOLVED_LINKS_CACHE, ResolutionCache) else {})
+            },
+            "vavoo_signature": vavoo_resolver.signature_stats(),
+            "daddylive_stages": daddylive_stage_cache.stats(),
+            "hot_channels": hot_channel_refresher.stats(),
+            "upstream_router": get_upstream_router().stats(),
+            "cache_key_normalizer": get_cache_key_normalizer().stats(),
+            "inflight": {
+                "ts": SEGMENT_FLIGHTS.stats(),
+                "key": KEY_FLIGHTS.stats()
+            },
+            "prefetch": {
+                **pre_buffer_manager.scheduler.stats(),
+                "buffer_bytes": pre_buffer_manager.total_bytes,
+                "buffer_hits": pre_buffer_manager.buffer_hits,
+                "buffer_misses": pre_buffer_manager.buffer_misses,
+                "memory_percent": pre_buffer_manager.memory_percent
             }
         }
         
@@ -2285,8 +5337,11 @@ def clear_cache():
     try:
         M3U8_CACHE.clear()
         TS_CACHE.clear()
+        if TS_DISK_CACHE:
+            TS_DISK_CACHE.clear()
         KEY_CACHE.clear()
         RESOLVED_LINKS_CACHE.clear()
+        daddylive_stage_cache.clear()
         
         app.logger.info("Tutte le cache sono state pulite")
         return jsonify({"message": "Cache pulite con successo"})
@@ -2295,6 +5350,22 @@ def clear_cache():
         app.logger.error(f"Errore nella pulizia cache: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/upstream/stats')
+def upstream_stats():
+    """Statistiche delle connessioni upstream: utilizzo dei pool, riuso, tempi di connessione"""
+    try:
+        return jsonify({
+            **UPSTREAM_CONNECTIONS.stats(),
+            "proxy_selector": PROXY_SELECTOR.stats(),
+            "hedging": SEGMENT_HEDGER.stats(),
+            "ttfb": UPSTREAM_TTFB.stats(),
+            "connect_time": UPSTREAM_CONNECT_TIME.stats(),
+            "segment_resume": dict(SEGMENT_RESUME_STATS)
+        })
+    except Exception as e:
+        app.logger.error(f"Errore nel recupero statistiche upstream: {e}")
+        return jsonify({"error": str(e)}), 500
+
 def resolve_single_link(args):
     """Funzione helper per risolvere un singolo link in parallelo - OTTIMIZZATA"""
     line, line_index, headers, server_ip, current_stream_headers_params = args
@@ -2311,24 +5382,9 @@ def resolve_single_link(args):
             new_line = f"http://{server_ip}/proxy/m3u?url={encoded_line}{headers_query_string}"
             return (line_index, new_line, False)  # Non risolto ma valido
         
-        # Crea una chiave di cache che include l'URL e gli headers
-        headers_str = "&".join(sorted([f"{k}={v}" for k, v in headers.items()]))
-        cache_key = f"{line}|{headers_str}"
-        
-        # Controlla se il link è già in cache
-        config = config_manager.load_config()
-        cache_enabled = config.get('CACHE_ENABLED', True)
-        
-        if cache_enabled and cache_key in RESOLVED_LINKS_CACHE:
-            result = RESOLVED_LINKS_CACHE[cache_key]
-        else:
-            # Risolve il link usando la logica esistente con timeout ridotto
-            processed_url = process_daddylive_url(line)
-            result = resolve_m3u8_link(processed_url, headers)
-            
-            # Salva in cache se abilitata
-            if cache_enabled and result["resolved_url"]:
-                RESOLVED_LINKS_CACHE[cache_key] = result
+        # Stessa cache di /proxy/m3u: TTL per provider e solo risoluzioni riuscite
+        processed_url = process_daddylive_url(line)
+        result, _ = resolve_m3u8_link_cached(processed_url, headers)
         
         if result["resolved_url"]:
             resolved_url = result["resolved_url"]
@@ -2479,8 +5535,8 @@ def proxy_siptv():
         resolved_count = 0
         
         # Ottimizzazione: Pre-filtra i link che sono già in cache
-        config = config_manager.load_config()
-        cache_enabled = config.get('CACHE_ENABLED', True)
+        config = config_manager.get_config()
+        cache_enabled = config.cache_enabled
         max_workers_config = config.get('PARALLEL_WORKERS_MAX', 50)
         
         # Pre-controlla cache per evitare di processare link già risolti
@@ -2490,11 +5546,9 @@ def proxy_siptv():
         if cache_enabled:
             for link_data in links_to_resolve:
                 line, line_index, headers, server_ip, current_stream_headers_params = link_data
-                headers_str = "&".join(sorted([f"{k}={v}" for k, v in headers.items()]))
-                cache_key = f"{line}|{headers_str}"
+                result = get_cached_resolution(process_daddylive_url(line), headers)
                 
-                if cache_key in RESOLVED_LINKS_CACHE:
-                    result = RESOLVED_LINKS_CACHE[cache_key]
+                if result is not None:
                     if result["resolved_url"]:
                         resolved_url = result["resolved_url"]
                         resolved_headers_params = []
@@ -2602,8 +5656,8 @@ def proxy_siptv():
 # --- Inizializzazione dell'app ---
 
 # Carica e applica la configurazione salvata al startup
-saved_config = config_manager.load_config()
-config_manager.apply_config_to_app(saved_config)
+saved_config = config_manager.get_config()
+config_manager.apply_config_to_app(saved_config.values)
 
 # Valida e aggiorna la configurazione del pre-buffer
 pre_buffer_manager.update_config()
@@ -0,0 +1,580 @@
+"""
+Entry point ASGI di TVProxy.
+
+/proxy/ts, /proxy/key e /proxy/m3u vengono serviti sull'event loop con I/O
+upstream non bloccante (aiohttp, connessioni persistenti per proxy): un
+viewer non occupa più un worker per tutta la durata del download di un
+segmento. Tutte le altre route passano all'app Flask in un pool di thread.
+Route e formato delle query sono gli stessi della modalità WSGI.
+
+Modalità opzionale: Dockerfile e docker-compose avviano l'app WSGI (app:app).
+Avvio:
+    uvicorn asgi:application --host 0.0.0.0 --port 7860
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker -w 4 -b 0.0.0.0:7860
+"""
+import asyncio
+import hashlib
+import os
+import time
+from urllib.parse import parse_qsl, unquote
+
+import aiohttp
+import requests
+from a2wsgi import WSGIMiddleware
+
+try:
+    from aiohttp_socks import ProxyConnector
+except ImportError:
+    ProxyConnector = None
+
+import app as tvproxy
+from app import app as flask_app, config_manager, pre_buffer_manager
+
+# Thread dedicati alle route Flask servite tramite il bridge WSGI
+ASGI_WSGI_WORKERS = int(os.environ.get('ASGI_WSGI_WORKERS', 16))
+
+CHUNK_SIZE = 64 * 1024
+TS_MAX_RETRIES = 3
+
+def get_query_args(scope):
+    """Parametri della query string come request.args di Flask (primo valore per chiave)"""
+    args = {}
+    for key, value in parse_qsl(scope.get('query_string', b'').decode('utf-8', 'replace'), keep_blank_values=True):
+        args.setdefault(key, value)
+    return args
+
+def get_forward_headers(args):
+    """Headers da inoltrare all'upstream, passati come parametri h_<nome>"""
+    return {
+        unquote(key[2:]).replace("_", "-"): unquote(value).strip()
+        for key, value in args.items()
+        if key.lower().startswith("h_")
+    }
+
+def lookup_segment(cache_key, stream_id, viewer_id, cache_enabled):
+    """
+    Pre-buffer e cache in memoria per un segmento. Con il backend condiviso
+    queste chiamate prendono lock e flock e copiano dal mmap: vanno eseguite
+    nel pool di thread, mai sull'event loop.
+    """
+    buffered_content = pre_buffer_manager.get_buffered_segment(cache_key)
+    pre_buffer_manager.report_playhead(stream_id, cache_key, viewer_id)
+    if buffered_content:
+        return buffered_content, "Pre-buffer"
+    cached_content = tvproxy.TS_CACHE.get(cache_key) if cache_enabled else None
+    if cached_content:
+        return cached_content, "Cache"
+    return None, None
+
+def get_request_header(scope, name):
+    name = name.lower().encode('latin-1')
+    for key, value in scope.get('headers', []):
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+async def send_response(send, status, body, content_type="text/html; charset=utf-8"):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')), (b'content-length', str(len(body)).encode('latin-1'))]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+class AsyncInFlightFetch:
+    """
+    Versione asyncio di InFlightFetch: il task di download aggiunge i chunk,
+    ogni client li legge al proprio ritmo. La backpressure è per client
+    (send() attende che il socket si svuoti) e non rallenta il download.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.status_code = None
+        self.condition = asyncio.Condition()
+
+    async def append(self, chunk):
+        async with self.condition:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.condition.notify_all()
+
+    async def finish(self, error=None, status_code=None):
+        async with self.condition:
+            self.done = True
+            self.error = error
+            self.status_code = status_code
+            self.condition.notify_all()
+
+    async def _wait_for(self, predicate, timeout):
+        async with self.condition:
+            try:
+                await asyncio.wait_for(self.condition.wait_for(predicate), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+    async def wait_for_data(self, timeout):
+        return await self._wait_for(lambda: self.chunks or self.done, timeout)
+
+    async def wait_until_done(self, timeout):
+        return await self._wait_for(lambda: self.done, timeout)
+
+    def failed_without_data(self):
+        return self.done and self.error is not None and not self.chunks
+
+    def content(self):
+        return b"".join(self.chunks)
+
+    async def iter_chunks(self, timeout):
+        index = 0
+        while True:
+            if not await self._wait_for(lambda: index < len(self.chunks) or self.done, timeout):
+                tvproxy.app.logger.warning(f"Timeout in attesa di dati dal download condiviso: {self.key}")
+                return
+            pending = self.chunks[index:]
+            done = self.done
+            for chunk in pending:
+                yield chunk
+            index += len(pending)
+            if done and not pending:
+                return
+
+class AsyncSingleFlightRegistry:
+    """Download in corso sull'event loop: una sola richiesta upstream per chiave"""
+    def __init__(self):
+        self._inflight = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key):
+        fetch = self._inflight.get(key)
+        if fetch is not None:
+            self.followers += 1
+            return fetch, False
+        fetch = AsyncInFlightFetch(key)
+        self._inflight[key] = fetch
+        self.leaders += 1
+        return fetch, True
+
+    def release(self, key, fetch):
+        if self._inflight.get(key) is fetch:
+            del self._inflight[key]
+
+    def stats(self):
+        return {
+            "in_flight": len(self._inflight),
+            "upstream_fetches": self.leaders,
+            "coalesced_requests": self.followers
+        }
+
+class AsyncUpstreamPool:
+    """
+    Sessioni aiohttp persistenti, una per proxy più una per le connessioni
+    dirette. I proxy SOCKS richiedono aiohttp-socks; senza, is_supported()
+    restituisce False e la richiesta viene servita dalla route Flask.
+    """
+    def __init__(self):
+        self.sessions = {}
+        self.trace_config = self._create_trace_config()
+
+    @staticmethod
+    def _create_trace_config():
+        """Misura l'apertura delle nuove connessioni per i timeout adattivi (UPSTREAM_CONNECT_TIME)"""
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            context.host = tvproxy.extract_url_host(str(params.url))
+
+        async def on_connection_create_start(session, context, params):
+            context.connect_started = time.monotonic()
+
+        async def on_connection_create_end(session, context, params):
+            tvproxy.UPSTREAM_CONNECT_TIME.record((context.host,), time.monotonic() - context.connect_started)
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        return trace_config
+
+    def is_supported(self, proxy_url):
+        return not (proxy_url and proxy_url.startswith('socks') and ProxyConnector is None)
+
+    def _create_connector(self, proxy_url):
+        options = {
+            'limit': tvproxy.POOL_CONNECTIONS * tvproxy.POOL_MAXSIZE,
+            'limit_per_host': tvproxy.POOL_MAXSIZE,
+            'keepalive_timeout': tvproxy.KEEP_ALIVE_TIMEOUT,
+            'ssl': None if tvproxy.VERIFY_SSL else False
+        }
+        if proxy_url and proxy_url.startswith('socks'):
+            # socks5h:// (DNS remoto) non è uno schema di python-socks: equivale a socks5:// con rdns
+            if proxy_url.startswith('socks5h://'):
+                proxy_url = 'socks5' + proxy_url[len('socks5h'):]
+            return ProxyConnector.from_url(proxy_url, rdns=True, **options)
+        return aiohttp.TCPConnector(ttl_dns_cache=300, **options)
+
+    def get_session(self, proxy_url):
+        pool_key = proxy_url or 'default'
+        session = self.sessions.get(pool_key)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=self._create_connector(proxy_url), trace_configs=[self.trace_config])
+            self.sessions[pool_key] = session
+            tvproxy.app.logger.info(f"Nuova sessione aiohttp creata per: {pool_key}")
+        return session
+
+    def request(self, url, headers, timeout, proxy_url):
+        """
+        Context manager della risposta upstream; i proxy HTTP passano per il
+        parametro proxy di aiohttp. timeout è un numero o (connect, read).
+        """
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        session = self.get_session(proxy_url)
+        http_proxy = proxy_url if proxy_url and not proxy_url.startswith('socks') else None
+        return session.get(
+            url,
+            headers=headers,
+            proxy=http_proxy,
+            allow_redirects=True,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        )
+
+    async def close(self):
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for session in sessions:
+            await session.close()
+
+class AsyncProxyApp:
+    """Applicazione ASGI: route di streaming native, il resto all'app Flask"""
+    def __init__(self, wsgi_app):
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=ASGI_WSGI_WORKERS)
+        self.upstream = AsyncUpstreamPool()
+        self.segment_flights = AsyncSingleFlightRegistry()
+        self.key_flights = AsyncSingleFlightRegistry()
+        # Riferimenti ai task di download in corso: l'event loop ne tiene solo
+        # riferimenti deboli e un task non referenziato può essere raccolto dal GC
+        self._tasks = set()
+        self.routes = {
+            '/proxy/ts': self.proxy_ts,
+            '/proxy/key': self.proxy_key,
+            '/proxy/m3u': self.proxy_m3u
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = self.routes.get(scope['path']) if scope['type'] == 'http' and scope['method'] == 'GET' else None
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+        return await handler(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.upstream.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def stream_fetch(self, fetch, send, content_type, timeout):
+        """Risposta che segue un download condiviso dall'inizio, anche mentre è in corso"""
+        if not await fetch.wait_for_data(timeout):
+            return await send_response(send, 504, "Errore: Timeout in attesa del download condiviso")
+        if fetch.failed_without_data():
+            return await send_response(send, fetch.status_code or 502, f"Errore durante il download condiviso: {fetch.error}")
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', content_type.encode('latin-1'))]})
+        async for chunk in fetch.iter_chunks(timeout):
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def start_task(self, coroutine):
+        """Avvia un task in background mantenendone un riferimento fino al termine"""
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def fetch_upstream(self, fetch, url, headers, timeout, proxy_url, max_retries=1, resume_attempts=0):
+        """
+        Scarica url nel fetch condiviso. Ritenta (con backoff) gli errori prima
+        del primo byte; dopo il primo byte riprende con Range tramite un altro
+        proxy, fino a resume_attempts volte. True se il corpo è arrivato completo
+        e della lunghezza dichiarata.
+        """
+        attempt = 0
+        resumes = 0
+        expected_length = None
+        tried_proxies = {proxy_url}
+        request_headers = headers
+        ttfb_key = (tvproxy.extract_url_host(url), tvproxy.get_resource_type(url))
+        while True:
+            started = time.monotonic()
+            offset = fetch.size
+            skip = 0
+            headers_received = False
+            try:
+                async with self.upstream.request(url, request_headers, timeout, proxy_url) as response:
+                    headers_received = True
+                    ttfb = time.monotonic() - started
+                    tvproxy.UPSTREAM_TTFB.record(ttfb_key, ttfb)
+                    if proxy_url:
+                        tvproxy.PROXY_SELECTOR.report_success(proxy_url, ttfb)
+                    if offset:
+                        skip = tvproxy.get_resume_skip(response.status, response.headers, offset, expected_length)
+                        if skip is None:
+                            tvproxy.report_proxy_failure(proxy_url)
+                            await fetch.finish(error=f"Risposta di ripresa non valida: HTTP {response.status}", status_code=502)
+                            return False
+                        if expected_length is None:
+                            expected_length = tvproxy.get_resumed_length(response.status, response.headers, offset)
+                    elif response.status >= 400:
+                        await fetch.finish(error=f"HTTP {response.status} da upstream", status_code=response.status)
+                        return False
+                    else:
+                        expected_length = tvproxy.get_expected_length(response.headers)
+                    body_started = time.monotonic()
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        if skip:
+                            # Upstream senza supporto Range: scarta la parte già inoltrata ai client
+                            dropped = min(skip, len(chunk))
+                            chunk = chunk[dropped:]
+                            skip -= dropped
+                        if chunk:
+                            await fetch.append(chunk)
+                    if expected_length is not None and fetch.size < expected_length:
+                        raise tvproxy.SegmentTruncatedError(f"ricevuti {fetch.size} byte su {expected_length}")
+                    tvproxy.report_proxy_transfer(proxy_url, fetch.size - offset, time.monotonic() - body_started)
+                    if expected_length is not None and fetch.size != expected_length:
+                        await fetch.finish(error=f"Lunghezza inattesa: {fetch.size} byte invece di {expected_length}", status_code=502)
+                        return False
+                    return True
+            except (aiohttp.ClientError, asyncio.TimeoutError, tvproxy.SegmentTruncatedError) as e:
+                if not headers_received and isinstance(e, asyncio.TimeoutError) and isinstance(timeout, tuple):
+                    # Il timeout scaduto entra nell'istogramma: i timeout adattivi non possono solo restringersi
+                    tvproxy.UPSTREAM_TTFB.record(ttfb_key, timeout[1])
+                if expected_length is not None and fetch.size == expected_length:
+                    # Tutti i byte dichiarati sono arrivati: l'errore è solo in chiusura
+                    tvproxy.report_proxy_transfer(proxy_url, fetch.size - offset, time.monotonic() - started)
+                    return True
+                tvproxy.report_proxy_failure(proxy_url)
+                if fetch.chunks:
+                    if resumes >= resume_attempts:
+                        tvproxy.app.logger.error(f"Errore durante il download upstream di {url}: {e!r}")
+                        await fetch.finish(error=str(e) or type(e).__name__, status_code=502)
+                        return False
+                    resumes += 1
+                    tvproxy.app.logger.warning(f"Download interrotto a {fetch.size} byte, ripresa {resumes}/{resume_attempts}: {url} ({e!r})")
+                    proxy_config = tvproxy.get_proxy_with_fallback(url, tried_proxies)
+                    next_proxy = proxy_config['http'] if proxy_config else None
+                    if self.upstream.is_supported(next_proxy):
+                        proxy_url = next_proxy
+                        tried_proxies.add(proxy_url)
+                    request_headers = dict(headers)
+                    request_headers['Range'] = f'bytes={fetch.size}-'
+                    continue
+                attempt += 1
+                if attempt >= max_retries:
+                    tvproxy.app.logger.error(f"Errore durante il download upstream di {url}: {e!r}")
+                    status_code = 504 if isinstance(e, asyncio.TimeoutError) else 502
+                    await fetch.finish(error=str(e) or type(e).__name__, status_code=status_code)
+                    return False
+                tvproxy.app.logger.warning(f"Errore upstream (tentativo {attempt}/{max_retries}): {url}")
+                await asyncio.sleep(2 ** (attempt - 1))
+
+    async def send_disk_segment(self, scope, send, disk_entry):
+        """
+        Serve un segmento dalla cache su disco senza caricarlo tutto in memoria:
+        con l'estensione ASGI pathsend il server lo invia direttamente dal file,
+        altrimenti viene letto e inviato a blocchi di CHUNK_SIZE.
+        """
+        segment_file, size = disk_entry
+        loop = asyncio.get_running_loop()
+        with segment_file:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'video/mp2t'), (b'content-length', str(size).encode('latin-1'))]
+            })
+            if 'http.response.pathsend' in scope.get('extensions', {}):
+                await send({'type': 'http.response.pathsend', 'path': segment_file.name})
+                return
+            while True:
+                chunk = await loop.run_in_executor(None, segment_file.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+
+    async def download_segment(self, fetch, cache_key, ts_url, headers, timeout, proxy_url, cache_enabled):
+        """Task di download del segmento, indipendente dai client collegati"""
+        try:
+            completed = await self.fetch_upstream(fetch, ts_url, headers, timeout, proxy_url, TS_MAX_RETRIES, tvproxy.SEGMENT_RESUME_ATTEMPTS)
+            if completed and cache_enabled:
+                ts_content = fetch.content()
+                if ts_content:
+                    try:
+                        # Con il livello su disco attivo l'inserimento può scrivere su disco i segmenti espulsi
+                        await asyncio.get_running_loop().run_in_executor(None, tvproxy.TS_CACHE.__setitem__, cache_key, ts_content)
+                        tvproxy.app.logger.info(f"Segmento TS cachato ({len(ts_content)} bytes) per: {ts_url}")
+                    except Exception as e:
+                        # Il segmento è completo: un errore della cache non deve farlo risultare interrotto
+                        tvproxy.app.logger.error(f"Errore nel salvataggio in cache del segmento TS {ts_url}: {e}")
+            if completed:
+                await fetch.finish()
+        except Exception as e:
+            tvproxy.app.logger.error(f"Errore nel download del segmento TS {ts_url}: {e}")
+        finally:
+            if not fetch.done:
+                await fetch.finish(error="download interrotto" if fetch.chunks else "download upstream fallito")
+            self.segment_flights.release(cache_key, fetch)
+
+    async def proxy_ts(self, scope, receive, send):
+        args = get_query_args(scope)
+        ts_url = args.get('url', '').strip()
+        stream_id = args.get('stream_id', '').strip()
+        if not ts_url:
+            return await send_response(send, 400, "Errore: Parametro 'url' mancante")
+
+        config = config_manager.get_config()
+        cache_enabled = config.cache_enabled
+        cache_key = tvproxy.normalize_cache_key(ts_url)
+
+        client_host = scope['client'][0] if scope.get('client') else None
+        viewer_id = hashlib.md5(f"{client_host}|{get_request_header(scope, 'User-Agent')}".encode()).hexdigest()[:12]
+        loop = asyncio.get_running_loop()
+        cached_content, source = await loop.run_in_executor(None, lookup_segment, cache_key, stream_id, viewer_id, cache_enabled)
+        if cached_content:
+            tvproxy.app.logger.info(f"{source} HIT per TS: {ts_url}")
+            return await send_response(send, 200, cached_content, "video/mp2t")
+
+        if cache_enabled and tvproxy.TS_DISK_CACHE:
+            disk_entry = await loop.run_in_executor(None, tvproxy.TS_DISK_CACHE.open, cache_key)
+            if disk_entry:
+                tvproxy.app.logger.info(f"Cache disco HIT per TS: {ts_url}")
+                return await self.send_disk_segment(scope, send, disk_entry)
+
+        tvproxy.app.logger.info(f"Cache MISS per TS: {ts_url}")
+        ts_timeout = tvproxy.get_dynamic_timeout(ts_url)
+
+        fetch, is_leader = self.segment_flights.join(cache_key)
+        if is_leader:
+            proxy_config = tvproxy.get_proxy_for_url(ts_url)
+            proxy_key = proxy_config['http'] if proxy_config else None
+            if not self.upstream.is_supported(proxy_key):
+                self.segment_flights.release(cache_key, fetch)
+                await fetch.finish(error="proxy non supportato in modalità asincrona")
+                return await self.wsgi(scope, receive, send)
+            headers = get_forward_headers(args)
+            self.start_task(self.download_segment(fetch, cache_key, ts_url, headers, ts_timeout, proxy_key, cache_enabled))
+        else:
+            tvproxy.app.logger.info(f"Download TS già in corso, richiesta agganciata: {ts_url}")
+
+        await self.stream_fetch(fetch, send, "video/mp2t", sum(ts_timeout))
+
+    async def download_key(self, fetch, cache_key, key_url, headers, proxy_url, cache_enabled):
+        try:
+            if await self.fetch_upstream(fetch, key_url, headers, tvproxy.REQUEST_TIMEOUT, proxy_url):
+                if cache_enabled:
+                    await asyncio.get_running_loop().run_in_executor(None, tvproxy.KEY_CACHE.__setitem__, cache_key, fetch.content())
+                await fetch.finish()
+        except Exception as e:
+            tvproxy.app.logger.error(f"Errore durante il download della chiave AES-128: {e}")
+        finally:
+            if not fetch.done:
+                await fetch.finish(error="download upstream fallito")
+            self.key_flights.release(cache_key, fetch)
+
+    async def proxy_key(self, scope, receive, send):
+        args = get_query_args(scope)
+        key_url = args.get('url', '').strip()
+        if not key_url:
+            return await send_response(send, 400, "Errore: Parametro 'url' mancante per la chiave")
+
+        config = config_manager.get_config()
+        cache_enabled = config.cache_enabled
+        cache_key = tvproxy.normalize_cache_key(key_url)
+
+        cached_key = await asyncio.get_running_loop().run_in_executor(None, tvproxy.KEY_CACHE.get, cache_key) if cache_enabled else None
+        if cached_key:
+            tvproxy.app.logger.info(f"Cache HIT per KEY: {key_url}")
+            return await send_response(send, 200, cached_key, "application/octet-stream")
+
+        tvproxy.app.logger.info(f"Cache MISS per KEY: {key_url}")
+
+        fetch, is_leader = self.key_flights.join(cache_key)
+        if is_leader:
+            proxy_config = tvproxy.get_proxy_for_url(key_url)
+            proxy_key = proxy_config['http'] if proxy_config else None
+            if not self.upstream.is_supported(proxy_key):
+                self.key_flights.release(cache_key, fetch)
+                await fetch.finish(error="proxy non supportato in modalità asincrona")
+                return await self.wsgi(scope, receive, send)
+            self.start_task(self.download_key(fetch, cache_key, key_url, get_forward_headers(args), proxy_key, cache_enabled))
+        else:
+            tvproxy.app.logger.info(f"Download KEY già in corso, richiesta agganciata: {key_url}")
+
+        if not await fetch.wait_until_done(tvproxy.REQUEST_TIMEOUT):
+            return await send_response(send, 504, "Errore: Timeout in attesa del download condiviso della chiave")
+        if fetch.error is not None:
+            return await send_response(send, fetch.status_code or 500, f"Errore durante il download della chiave AES-128: {fetch.error}")
+        await send_response(send, 200, fetch.content(), "application/octet-stream")
+
+    async def proxy_m3u(self, scope, receive, send):
+        """
+        Le playlist in cache (fresche o stale) sono servite sull'event loop.
+        Risoluzione e riscrittura, che attraversano più stadi sincroni
+        (DaddyLive, Vavoo), girano nel pool di thread senza bloccare il loop.
+        """
+        args = get_query_args(scope)
+        m3u_url = args.get('url', '').strip()
+        if not m3u_url:
+            return await send_response(send, 400, "Errore: Parametro 'url' mancante")
+
+        cache_key_headers = "&".join(sorted([f"{k}={v}" for k, v in args.items() if k.lower().startswith("h_")]))
+        cache_key = f"{tvproxy.normalize_cache_key(m3u_url)}|{cache_key_headers}"
+
+        config = config_manager.get_config()
+        cache_enabled = config.cache_enabled
+        headers = get_forward_headers(args)
+        loop = asyncio.get_running_loop()
+
+        if cache_enabled:
+            cached_response, is_fresh = tvproxy.M3U8_CACHE.lookup(cache_key)
+            if cached_response is not None:
+                if is_fresh:
+                    tvproxy.app.logger.info(f"Cache HIT per M3U8: {m3u_url}")
+                else:
+                    tvproxy.app.logger.info(f"Cache STALE per M3U8: {m3u_url}")
+                    if tvproxy.M3U8_CACHE.begin_refresh(cache_key):
+                        loop.run_in_executor(None, tvproxy.refresh_playlist_cache, cache_key, m3u_url, headers)
+                return await send_response(send, 200, cached_response, "application/vnd.apple.mpegurl")
+
+        tvproxy.app.logger.info(f"Cache MISS per M3U8: {m3u_url} (primo avvio, risposta diretta)")
+
+        try:
+            modified_m3u8_content, cacheable, timing = await loop.run_in_executor(None, tvproxy.build_m3u8_playlist, m3u_url, headers)
+
+            if cache_enabled and cacheable:
+                ttl = tvproxy.cache_playlist(cache_key, modified_m3u8_content, timing)
+                tvproxy.app.logger.info(f"M3U8 cache salvata per {m3u_url} (TTL {ttl}s)")
+
+            await send_response(send, 200, modified_m3u8_content, "application/vnd.apple.mpegurl")
+
+        except tvproxy.PlaylistBuildError as e:
+            await send_response(send, 500, str(e))
+        except requests.RequestException as e:
+            tvproxy.app.logger.error(f"Errore durante il download o la risoluzione del file: {str(e)}")
+            await send_response(send, 500, f"Errore durante il download o la risoluzione del file M3U/M3U8: {str(e)}")
+        except Exception as e:
+            tvproxy.app.logger.error(f"Errore generico nella funzione proxy_m3u: {str(e)}")
+            await send_response(send, 500, f"Errore generico durante l'elaborazione: {str(e)}")
+
+application = AsyncProxyApp(flask_app)
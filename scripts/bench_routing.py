@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark di get_proxy_for_url: confronta il router precompilato con la
+logica precedente (regex e urlparse ad ogni chiamata, substring su NO_PROXY).
+
+Uso: python scripts/bench_routing.py [ripetizioni]
+"""
+import os
+import random
+import re
+import sys
+import time
+from urllib.parse import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# 3 proxy generali, 1 DaddyLive, 4 domini NO_PROXY
+os.environ.setdefault('PROXY', 'http://10.0.0.1:8080,http://10.0.0.2:8080,http://10.0.0.3:8080')
+os.environ.setdefault('DADDY_PROXY', 'http://10.0.0.4:8080')
+os.environ.setdefault('NO_PROXY_DOMAINS', 'github.com,githubusercontent.com,local.lan:8080,example.org')
+os.environ.setdefault('PREBUFFER_ENABLED', 'false')
+
+import logging  # noqa: E402
+import app  # noqa: E402
+
+app.app.logger.setLevel(logging.CRITICAL)
+
+def legacy_get_proxy_for_url(url, config):
+    """Logica di routing precedente al router precompilato (senza logging)"""
+    is_daddylive = (
+        'newkso.ru' in url.lower() or
+        '/stream-' in url.lower() or
+        re.search(r'/premium(\d+)/mono\.m3u8$', url) is not None
+    )
+    if is_daddylive and config.daddy_proxy_list:
+        chosen_proxy = random.choice(config.daddy_proxy_list)
+        return {'http': chosen_proxy, 'https': chosen_proxy}
+    if not config.proxy_list:
+        return None
+    try:
+        parsed_url = urlparse(url)
+        if any(domain in parsed_url.netloc for domain in config.no_proxy_domains):
+            return None
+    except Exception:
+        pass
+    chosen_proxy = random.choice(config.proxy_list)
+    return {'http': chosen_proxy, 'https': chosen_proxy}
+
+def build_urls():
+    """1150 URL misti: segmenti, playlist, chiavi, DaddyLive e domini NO_PROXY"""
+    urls = []
+    for i in range(1000):
+        urls.append(f"https://cdn{i % 40}.example.net/live/ch{i % 25}/seg-{i}.ts?token=abc{i}")
+    for i in range(100):
+        urls.append(f"https://edge{i % 10}.newkso.ru/premium{i % 50}/mono.m3u8")
+    for i in range(30):
+        urls.append(f"https://raw.githubusercontent.com/list/{i}.m3u8")
+    for i in range(20):
+        urls.append(f"http://local.lan:8080/key/{i}.key")
+    return urls
+
+def bench(label, func, urls, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for url in urls:
+            func(url)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed / (repeat * len(urls)) * 1e6:8.2f} us/url")
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    urls = build_urls()
+    config = app.config_manager.get_config()
+    router = app.get_upstream_router()
+    print(f"{len(urls)} URL, {len(config.proxy_list)} proxy, {len(config.no_proxy_domains)} domini NO_PROXY, {repeat} ripetizioni")
+    bench("legacy get_proxy_for_url", lambda url: legacy_get_proxy_for_url(url, config), urls, repeat)
+    bench("get_proxy_for_url", app.get_proxy_for_url, urls, repeat)
+    bench("UpstreamRouter.get_proxy", router.get_proxy, urls, repeat)
+
+if __name__ == '__main__':
+    main()